@@ -10,48 +10,201 @@ see https://github.com/rpi-ws281x/rpi-ws281x-python
 Author: Darren Dunford (djdunford@gmail.com)
 """
 
+import time
+
+START_TIME = time.time()  # recorded before any other imports to measure time to first frame
+
+import asyncio
 import configparser
 import json
 import logging.handlers
 import os
 import sys
-import threading
-import time
-import yaml
-import queue
-from gpiozero import CPUTemperature
 from ledcontroller.deviceshadowhandler import DeviceShadowHandler
-from ledcontroller.effects import LockingPixelStrip, color_wipe, LightEffect, color, clear_strip
-from exceptions import InterruptException, ExitException
+from ledcontroller.effects import LockingPixelStrip, color_wipe, LightEffect, color, clear_strip, EFFECTS
+from ledcontroller.flightrecorder import FlightRecorder
+from ledcontroller.sequencer import validate_program
+from ledcontroller.settings import SettingsStore
+from ledcontroller.statecache import StateCache, reconcile
+from ledcontroller.thermal import ThermalGovernor
+from ledcontroller.timebase import ClockSync
+from ledcontroller.tracing import CommandTrace
+from exceptions import ExitException
 
 # LED strip configuration:
-LED_COUNT = 643  # Number of LED pixels.
+LED_COUNT = 643  # Number of LED pixels, unless set by count in the strip section of the ini file.
 LED_PIN = 18  # GPIO pin connected to the pixels (18 uses PWM!).
 LED_FREQ_HZ = 800000  # LED signal frequency in hertz (usually 800khz)
 LED_DMA = 10  # DMA channel to use for generating signal (try 10)
 LED_BRIGHTNESS = 255  # Set to 0 for darkest and 255 for brightest
 LED_INVERT = False  # True to invert the signal (when using NPN transistor level shift)
 LED_CHANNEL = 0  # set to '1' for GPIOs 13, 19, 41, 45 or 53
+RENDER_AHEAD = 2  # frames rendered ahead of the one being shown, absorbing render stalls
+
+# range of start times accepted in commands, in seconds before and after now, other starts are replaced by now
+MAX_START_AGE = 86400
+MAX_START_DELAY = 3600
+
+# allowed range of each runtime setting, (minimum, maximum)
+SETTINGS_LIMITS = {
+    'post_temperature_interval': (1, 86400),
+    'post_lightstatus_interval': (1, 86400),
+    'thermal_sample_interval': (1, 3600),
+    'thermal_soft_limit': (30.0, 85.0),
+    'thermal_hard_limit': (30.0, 85.0),
+    'max_fps': (1, 200),
+    'min_fps': (1, 200),
+    'brightness': (0, 100),
+    'clock_sync_interval': (10, 86400),
+}
 
 
 # define helper functions
-def post_temperature(interval: int=300):
+def check_settings(candidate: dict):
+    """
+    reject combinations of settings which are individually valid but inconsistent
+
+    :param candidate: complete settings dictionary after a proposed update
+    :return:
+    """
+    if candidate['thermal_hard_limit'] <= candidate['thermal_soft_limit']:
+        raise ValueError("thermal_hard_limit must be above thermal_soft_limit")
+    if candidate['min_fps'] > candidate['max_fps']:
+        raise ValueError("min_fps must not exceed max_fps")
+
+def apply_settings(changes: dict):
+    """
+    apply changed settings to the running strip and thermal governor and report them to the shadow
+
+    called by the settings store after every update, interval changes are picked up by the posting tasks
+    themselves as they are woken by settings_changed
+
+    :param changes: dictionary of changed settings
+    :return:
+    """
+    if 'brightness' in changes:
+        strip.setBrightness(round(changes['brightness'] * 255 / 100))
+    governor.soft_limit = settings.get('thermal_soft_limit')
+    governor.hard_limit = settings.get('thermal_hard_limit')
+    governor.max_fps = settings.get('max_fps')
+    governor.min_fps = settings.get('min_fps')
+    device.settings = settings.snapshot()
+    device.post_param()
+    save_state(settings=settings.snapshot())
+
+    # wake tasks waiting on settings, each wait uses the event current when it started
+    global settings_changed
+    settings_changed.set()
+    settings_changed = asyncio.Event()
+
+def save_state(**changes):
+    """
+    record changed state in the local state cache, if enabled, to resume from after a restart
+
+    :param changes: state keys and values
+    :return:
+    """
+    if state_cache:
+        state_cache.update(**changes)
+
+def record_event(kind: str, **details):
+    """
+    record a control event in the flight recorder, if enabled
+
+    :param kind: event kind
+    :param details: event details
+    :return:
+    """
+    if strip.recorder:
+        strip.recorder.record_event(kind, time.time(), **details)
+
+async def wait_interval(key: str):
     """
-    thread safe daemon function posts temperature every interval seconds
+    wait for the interval given by a setting, re-reading the setting whenever settings change
 
-    :param interval:
+    :param key: name of setting holding interval in seconds
     :return:
     """
+    start = time.time()
+    while True:
+        remaining = start + settings.get(key) - time.time()
+        if remaining <= 0:
+            return
+        try:
+            await asyncio.wait_for(settings_changed.wait(), remaining)
+        except asyncio.TimeoutError:
+            return
+
+def load_programs(filename: str) -> dict:
+    """
+    load light programs from YAML file, using the C YAML parser if available, and discard any invalid programs
+
+    :param filename: path to program YAML file
+    :return: dictionary of program name to list of steps
+    """
+    import yaml  # imported here to keep it off the critical path before the strip is initialised
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(filename, 'r') as stream:
+        try:
+            loaded = yaml.load(stream, Loader=loader)
+        except yaml.YAMLError as exc:
+            LOGGER.error("Invalid program file %s: %s", filename, exc)
+            return {}
+    if not isinstance(loaded, dict):
+        LOGGER.error("Program file %s does not hold a mapping of program names to programs", filename)
+        return {}
+
+    valid = {}
+    for name, program in loaded.items():
+        try:
+            validate_program(program, loaded, EFFECTS)
+            valid[name] = program
+        except (ValueError, KeyError) as exc:
+            LOGGER.error("Invalid program %s: %s", name, exc)
+    return valid
+
+async def post_temperature():
+    """
+    task posts temperature every post_temperature_interval seconds
+
+    :return:
+    """
+    from gpiozero import CPUTemperature  # slow to import, so imported once the lights are running
     while True:
         cpu = CPUTemperature()
         device.post_temperature(cpu.temperature)
-        time.sleep(interval)
+        await wait_interval('post_temperature_interval')
+
+async def govern_temperature():
+    """
+    task samples temperature every thermal_sample_interval seconds to drive the thermal governor, posting
+    governor state at startup and whenever the throttle level changes
+
+    :return:
+    """
+    from gpiozero import CPUTemperature
+    cpu = CPUTemperature()
+    device.post_governor(governor.state())
+    while True:
+        if governor.update(cpu.temperature):
+            device.post_governor(governor.state())
+        await wait_interval('thermal_sample_interval')
+
+async def sync_clock():
+    """
+    task corrects the render clock against the NTP server every clock_sync_interval seconds, so devices given
+    the same start time render the same frame at the same instant
+
+    :return:
+    """
+    while True:
+        await clock.sync()
+        await wait_interval('clock_sync_interval')
 
-def post_lightstatus(interval: int=10):
+async def post_lightstatus():
     """
-    thread safe daemon function posts current status of lights every interval seconds
+    task posts current status of lights every post_lightstatus_interval seconds
 
-    :param interval:
     :return:
     """
     while True:
@@ -70,8 +223,145 @@ def post_lightstatus(interval: int=10):
             "step":strip.step,
             "step_num":strip.step_num,
             "run_program":run_program,
+            "clock":clock.state(),
+            "frames":{"late":lights_thread.late_frames, "dropped":lights_thread.dropped_frames},
         })
-        time.sleep(interval)
+        save_state(step_num=strip.step_num)
+        await wait_interval('post_lightstatus_interval')
+
+def play_selected(command: dict = None, trace: CommandTrace = None):
+    """
+    switch the render thread to the selected program or effect
+
+    a command may carry "start", the Unix time the program starts, and "seed" for its random choices, so that
+    devices given the same command render in step; a start more than MAX_START_AGE before or MAX_START_DELAY after
+    now is replaced by now
+
+    :param command: optional command dictionary holding start and seed
+    :param trace: optional trace of the command, stamped by the render thread up to the first frame
+    :return:
+    """
+    start = (command or {}).get("start")
+    seed = (command or {}).get("seed", 0)
+    if start is not None and (isinstance(start, bool) or not isinstance(start, (int, float))):
+        LOGGER.error("Ignoring invalid start time %s", start)
+        start = None
+    elif start is not None and not -MAX_START_AGE <= start - clock.time() <= MAX_START_DELAY:
+        LOGGER.error("Ignoring start time %s, more than %d s before or %d s after now", start, MAX_START_AGE,
+                     MAX_START_DELAY)
+        start = None
+    if isinstance(seed, bool) or not isinstance(seed, int):
+        LOGGER.error("Ignoring invalid seed %s", seed)
+        seed = 0
+    if start is None:
+        start = clock.time()
+    save_state(run_program=run_program, effect=effect, start=start, seed=seed, step_num=0)
+
+    if run_program != "":
+        device.status_post(f"RUNNING PROGRAM {run_program}")
+        lights_thread.play(program=programs.get(run_program), start=start, seed=seed, trace=trace)
+    else:
+        device.status_post(f"RUNNING EFFECT {effect}")
+        lights_thread.play(effect=effect, start=start, seed=seed, trace=trace)
+
+def handle_event(event: dict):
+    """
+    handle a command or settings event received from the device shadow, or a trace completed by the render thread
+
+    :param event: event dictionary
+    :return:
+    """
+    global run_program, effect
+
+    # record commands and settings received in the flight recorder
+    if event.get("command"):
+        record_event("command", command=event["command"])
+    if event.get("settings"):
+        record_event("settings", settings=event["settings"])
+
+    # parse and handle any commands received, stamping any trace they carry
+    command = event.get("command")
+    trace = event.get("trace")
+    if trace:
+        trace.mark("handled")
+
+    if not command:
+        pass
+
+    elif command == "STOP" or command.get("action") == "STOP":
+        raise ExitException
+
+    elif command.get("action") == "RUN":
+        run_program = command.get("program")
+        play_selected(command, trace)
+
+    elif command.get("action") == "EFFECT":
+        run_program = ""
+        effect = command.get("effect")
+        play_selected(command, trace)
+
+    elif command.get("action") == "OFF":
+        run_program = ""
+        effect = 0
+        play_selected(trace=trace)
+
+    elif command.get("action") == "STREAM":
+        # stream frames from an external renderer, falling back to the selected program or effect on timeout
+        step = {key: command[key] for key in ("port", "protocol", "universe", "timeout") if key in command}
+        step["effect"] = "Stream"
+        fallback = {"program": run_program} if run_program in programs else {"effect": effect}
+        try:
+            validate_program([step], programs, EFFECTS)
+        except ValueError as exc:
+            LOGGER.error("Invalid STREAM command: %s", exc)
+        else:
+            device.status_post("STREAMING")
+            lights_thread.play(program=[step, fallback], trace=trace)
+
+    # report stage latencies of a traced command once its first frame has been shown
+    traced = event.get("traced")
+    if traced:
+        device.post_trace(traced.report())
+
+    # parse and handle settings changes received
+    new_settings = event.get("settings")
+    if new_settings:
+        settings.update(new_settings)
+
+    # reconcile state resumed from the local cache with the shadow fetched after connecting
+    shadow = event.get("shadow")
+    if shadow:
+        reconciled = reconcile(shadow, PERSISTENT_SHADOW)
+        LOGGER.info("Reconciled with shadow: %s", json.dumps(reconciled))
+        if reconciled:
+            handle_event(reconciled)
+
+async def control_loop():
+    """
+    control plane: connects to AWSIoT, runs the periodic posting tasks and handles events until stopped
+
+    events from the SDK callback thread are handed to this loop thread safely, so command handling, settings
+    and posting all run on this one thread, leaving the render thread as the only other thread of our own
+
+    :return:
+    """
+    global settings_changed
+    settings_changed = asyncio.Event()
+
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+    device.on_event = lambda event: loop.call_soon_threadsafe(events.put_nowait, event)
+    lights_thread.on_trace = device.on_event
+    device.start()
+
+    tasks = [loop.create_task(task()) for task in (post_temperature, govern_temperature, post_lightstatus,
+                                                          sync_clock)]
+    try:
+        while True:
+            handle_event(await events.get())
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 # Main program logic follows:
@@ -80,6 +370,10 @@ if __name__ == '__main__':
     # Change CWD to location of this script
     os.chdir(os.path.dirname(sys.argv[0]))
 
+    # hand the GIL between threads every 1 ms rather than 5 ms, so the display thread shows each frame within
+    # 1 ms of its deadline while an effect is rendering
+    sys.setswitchinterval(0.001)
+
     # read config file and settings
     config = configparser.ConfigParser()
     config.read('ledcontroller.ini')
@@ -90,11 +384,22 @@ if __name__ == '__main__':
     AWSIOT_HOST = config['aws']['host']
     AWSIOT_ROOT_CA_PATH = config['aws']['rootcapath']
     AWSIOT_THINGNAME = config['aws']['thingname']
+    AWSIOT_OFFLINE_QUEUE_BYTES = config['aws'].getint('offlinequeuebytes', fallback=65536)
+
+    # number of LED pixels, effects are scaled to the strip whatever its length
+    LED_COUNT = config.getint('strip', 'count', fallback=LED_COUNT)
+    if LED_COUNT < 1:
+        raise ValueError(f"LED count must be at least 1, not {LED_COUNT}")
+
+    # NTP server giving the time base shared by synchronised devices, blank to use the local clock as it is
+    NTP_SERVER = config.get('sync', 'ntpserver', fallback='pool.ntp.org')
 
     # debug flag
     debugdict = config['debug']
     DEBUG = debugdict.getboolean('debug', fallback=False)  # if debug true then additional logging to syslog is enabled
     SYSLOG = debugdict.getboolean('syslog', fallback=True)  # if syslog is false then all output to syslog is suppressed
+    FLIGHT_RECORDER = debugdict.get('flightrecorder', fallback='')  # recorder file of recent frames, blank for none
+    FLIGHT_RECORDER_FRAMES = debugdict.getint('flightrecorderframes', fallback=500)
 
     # setup logging at root level and set log level according to ini file
     LOGGER = logging.getLogger("ledcontroller")
@@ -116,127 +421,106 @@ if __name__ == '__main__':
     # note: explicitly defining parameters here also defines default values and ensures rogue parameters
     # are not injected from an external source
     globs = config['settings']
-    settings = {}
-    settings.update({'post_temperature_interval': globs.getint('post_temperature_interval', fallback=300)})
-    settings.update({'post_lightstatus_interval': globs.getint('post_lightstatus_interval', fallback=30)})
+    PERSISTENT_SHADOW = globs.getboolean('persistentshadow', fallback=False)
+    STATE_FILE = globs.get('statefile', fallback='ledcontroller-state.json')
+    defaults = {}
+    defaults.update({'post_temperature_interval': globs.getint('post_temperature_interval', fallback=300)})
+    defaults.update({'post_lightstatus_interval': globs.getint('post_lightstatus_interval', fallback=30)})
+    defaults.update({'thermal_sample_interval': globs.getint('thermal_sample_interval', fallback=5)})
+    defaults.update({'thermal_soft_limit': globs.getfloat('thermal_soft_limit', fallback=65.0)})
+    defaults.update({'thermal_hard_limit': globs.getfloat('thermal_hard_limit', fallback=78.0)})
+    defaults.update({'max_fps': globs.getint('max_fps', fallback=50)})
+    defaults.update({'min_fps': globs.getint('min_fps', fallback=10)})
+    defaults.update({'brightness': globs.getint('brightness', fallback=100)})
+    defaults.update({'clock_sync_interval': globs.getint('clock_sync_interval', fallback=600)})
 
     # create master set of keys from parameter array
     # used later to prevent injection of any other keys
-    SETTINGS_KEYS = set(settings)
+    SETTINGS_KEYS = set(defaults)
 
     # if debugging then dump params in to syslog
-    LOGGER.info("Parameters loaded: %s", json.dumps(settings, indent=2))
+    LOGGER.info("Parameters loaded: %s", json.dumps(defaults, indent=2))
 
-    # connect to AWSIoT
-    device = DeviceShadowHandler(
-        host=AWSIOT_HOST,
-        root_ca_path=AWSIOT_ROOT_CA_PATH,
-        certificate_path=AWSIOT_CERTIFICATE_PATH,
-        thingname=AWSIOT_THINGNAME,
-        private_key_path=AWSIOT_PRIVATE_KEY_PATH)
+    # live settings store, validated against SETTINGS_KEYS and SETTINGS_LIMITS
+    settings = SettingsStore(defaults, limits=SETTINGS_LIMITS, check=check_settings)
+
+    # resume from the local state cache, which takes precedence over the ini file
+    state_cache = StateCache(STATE_FILE) if STATE_FILE else None
+    resumed = state_cache.load() if state_cache else {}
+    if resumed.get('settings'):
+        settings.update(resumed['settings'])
 
     # Create NeoPixel object with appropriate configuration and initialise library
-    strip = LockingPixelStrip(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT, LED_BRIGHTNESS, LED_CHANNEL)
+    strip = LockingPixelStrip(LED_COUNT, LED_PIN, LED_FREQ_HZ, LED_DMA, LED_INVERT,
+                              round(settings.get('brightness') * LED_BRIGHTNESS / 100), LED_CHANNEL)
     strip.begin()
 
-    # launch daemon thread to post temperature to AWSIoT at required interval
-    temperaturepost_thread = threading.Thread(
-        target=post_temperature,
-        args=(settings.get('post_temperature_interval'),),
-        daemon=True,
-    )
-    temperaturepost_thread.start()
-
-    # set default program to run and set no effect
-    run_program: str = "autostart"
-    effect: int = 0
-
-    # launch daemon thread to post pixel strip status to AWSIoT at required interval
-    lightstatuspost_thread = threading.Thread(
-        target=post_lightstatus,
-        args=(settings.get('post_lightstatus_interval'),),
-        daemon=True,
-    )
-    lightstatuspost_thread.start()
+    # optionally record every frame shown and control events, kept across a crash for diagnosis
+    if FLIGHT_RECORDER:
+        strip.recorder = FlightRecorder(FLIGHT_RECORDER, LED_COUNT, FLIGHT_RECORDER_FRAMES)
+        record_event("start", resumed={key: value for key, value in resumed.items() if key != 'settings'})
 
     # load in light program
-    with open("program.yaml", 'r') as stream:
-        try:
-            programs = yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
+    programs = load_programs("program.yaml")
 
-    lights_thread: LightEffect = LightEffect(strip)
+    # prepare AWSIoT connection, which is made in the background once the lights are running
+    device = DeviceShadowHandler(
+        host=AWSIOT_HOST,
+        root_ca_path=AWSIOT_ROOT_CA_PATH,
+        certificate_path=AWSIOT_CERTIFICATE_PATH,
+        thingname=AWSIOT_THINGNAME,
+        private_key_path=AWSIOT_PRIVATE_KEY_PATH,
+        offline_queue_bytes=AWSIOT_OFFLINE_QUEUE_BYTES)
+
+    # thermal governor steps frame rate and effect detail down as the CPU heats up
+    governor = ThermalGovernor(
+        soft_limit=settings.get('thermal_soft_limit'),
+        hard_limit=settings.get('thermal_hard_limit'),
+        max_fps=settings.get('max_fps'),
+        min_fps=settings.get('min_fps'),
+    )
 
-    # main loop for running lights programs and reacting to events
+    # apply and report settings changes as they arrive, and report initial settings
+    settings.subscribe(apply_settings)
+    device.settings = settings.snapshot()
+    device.post_param()
+
+    # render clock, corrected against the NTP server once the control plane is running
+    clock = ClockSync(NTP_SERVER or None)
+    device.clock = clock.time
+
+    # set program to run: resume the cached program or effect where it would be now, otherwise the default
+    # program and no effect
+    run_program: str = resumed.get('run_program', "autostart")
+    effect: int = resumed.get('effect', 0)
+
+    # start render thread on the selected program
+    start = resumed.get('start') or clock.time()
+    seed = resumed.get('seed', 0)
+    lights_thread: LightEffect = LightEffect(strip, effect=effect, program=programs.get(run_program),
+                                             governor=governor, programs=programs, clock=clock.time,
+                                             start=start, seed=seed, lookahead=RENDER_AHEAD)
+    lights_thread.start()
+    if strip.first_frame.wait(1.0):
+        LOGGER.info("First frame shown %.3f s after start", strip.first_frame_time - START_TIME)
+    if resumed:
+        LOGGER.info("Resumed from %s: %s", STATE_FILE, json.dumps(resumed))
+    save_state(run_program=run_program, effect=effect, start=start, seed=seed, settings=settings.snapshot())
+    device.status_post(f"RUNNING PROGRAM {run_program}" if run_program != "" else f"RUNNING EFFECT {effect}")
+
+    # run control plane until stopped, then cleanup render thread and terminate
     try:
-        while True:
-
-            # main loop for running a specific light program and reacting to events
-            try:
-
-                # select program or effect
-                if run_program != "":
-                    program = programs.get(run_program)
-                    device.status_post(f"RUNNING PROGRAM {run_program}")
-                    lights_thread: LightEffect = LightEffect(strip, program = program)
-                else:
-                    device.status_post(f"RUNNING EFFECT {effect}")
-                    lights_thread: LightEffect = LightEffect(strip, effect = effect)
-                lights_thread.start()
-
-                # react to event queue
-                while True:
-                    try:
-                        event = device.event_queue.get_nowait()
-
-                        # parse and handle any commands received
-                        command = event.get("command")
-                        if command == "STOP" or command.get("action") == "STOP":
-                            raise ExitException
-
-                        elif command.get("action") == "RUN":
-                            run_program = command.get("program")
-                            raise InterruptException
-
-                        elif command.get("action") == "EFFECT":
-                            run_program = ""
-                            effect = command.get("effect")
-                            raise InterruptException
-
-                        elif command.get("action") == "OFF":
-                            run_program = ""
-                            effect = 0
-                            raise InterruptException
-
-                        # parse and handle settings changes received
-                        settings = event.get("settings")
-                        if settings:
-                            pass  # TODO handle settings changes
-
-                    except queue.Empty:
-                        pass
-                    time.sleep(0.1)
-
-            # if program interrupted then clear lights ready for next program
-            except InterruptException:
-                device.status_post("STOPPING CURRENT PROGRAM")
-                try:
-                    lights_thread.stop()
-                    lights_thread.join()
-                except RuntimeError:
-                    pass
-                clear_strip(strip)
-                device.status_post("CURRENT PROGRAM STOPPED")
-
-    # to exit cleanup thread and terminate
+        asyncio.run(control_loop())
     except (KeyboardInterrupt, ExitException):
         device.status_post("STOPPING")
-        try:
-            lights_thread.stop()
-            lights_thread.join()
-        except RuntimeError:
-            pass
+        record_event("stop")
+        lights_thread.stop()
+        lights_thread.join(timeout=1.0)
+        if lights_thread.is_alive():
+            LOGGER.warning("Render thread did not stop within 1 s")
 
         clear_strip(strip)
+        if strip.recorder and not lights_thread.is_alive():
+            strip.recorder.close()
+            strip.recorder = None
         device.status_post("STOPPED")
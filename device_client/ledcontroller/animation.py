@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""Pre-baked animation files for zero-compute playback
+
+animation.py
+
+by Darren Dunford
+
+Effects and programs which are pure functions of time can be rendered offline in to an animation file and then
+played back by the Playback effect, which memory maps the file and copies each frame straight in to the strip
+buffer.
+
+File format (all integers little endian):
+
+    header   4s magic "WSAN", B version, B flags (bit 0 set if delta compressed), H reserved,
+             f frames per second, I pixel count, I frame count
+    index    frame count x (I offset of frame record from start of file, I length of record), the top bit of the
+             length is set for a delta frame
+    frames   key frame:   pixel count x 3 bytes of packed GRB
+             delta frame: runs of changed pixels, each I first pixel, H pixel count, then pixel count x 3 bytes
+                          of packed GRB, applied on top of the previous frame
+
+Usage:
+
+    python3 -m ledcontroller.animation bake --effect RainbowCycle --duration 5.12 rainbow.wsa
+    python3 -m ledcontroller.animation bake --program autostart --duration 60 --delta autostart.wsa
+    python3 -m ledcontroller.animation info rainbow.wsa
+"""
+
+import argparse
+import logging
+import mmap
+import struct
+
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = b"WSAN"
+VERSION = 1
+FLAG_DELTA = 0x01
+DELTA_FRAME = 0x80000000
+
+HEADER = struct.Struct("<4sBBHfII")
+INDEX_ENTRY = struct.Struct("<II")
+RUN = struct.Struct("<IH")
+
+MAX_RUN = 0xFFFF
+RUN_GAP = 2  # unchanged pixels worth bridging rather than starting a new run (a run header is 6 bytes)
+
+
+def pack_grb(frame: numpy.ndarray) -> bytes:
+    """Pack a frame of 24-bit colour values, as produced by effects.color(), in to GRB bytes
+
+    :param frame: numpy uint32 array of colour values
+    :return:
+    """
+    packed = numpy.empty((len(frame), 3), dtype=numpy.uint8)
+    packed[:, 0] = frame >> 16
+    packed[:, 1] = frame >> 8
+    packed[:, 2] = frame
+    return packed.tobytes()
+
+
+def unpack_grb(packed: numpy.ndarray, out: numpy.ndarray):
+    """Unpack GRB bytes in to 24-bit colour values in place, without allocating per frame
+
+    :param packed: numpy uint8 array of pixel count x 3 GRB bytes
+    :param out: numpy uint32 array of pixel count colour values to write to
+    :return:
+    """
+    numpy.copyto(out, packed[0::3])
+    out <<= 8
+    out |= packed[1::3]
+    out <<= 8
+    out |= packed[2::3]
+
+
+def _delta_runs(previous: numpy.ndarray, frame: numpy.ndarray):
+    """Return (first pixel, pixel count) runs covering the pixels which differ between two frames
+
+    :param previous: previous frame colour values
+    :param frame: new frame colour values
+    :return: list of tuples
+    """
+    changed = numpy.flatnonzero(previous != frame)
+    runs = []
+    for i in changed.tolist():
+        if runs and i - (runs[-1][0] + runs[-1][1]) <= RUN_GAP and i - runs[-1][0] < MAX_RUN:
+            runs[-1][1] = i - runs[-1][0] + 1
+        else:
+            runs.append([i, 1])
+    return runs
+
+
+class AnimationWriter:
+    """Writes frames to an animation file"""
+
+    def __init__(self, filename: str, fps: float, num_pixels: int, delta: bool = False, keyframe_interval: int = None):
+        """Open animation file for writing
+
+        :param filename: path of file to write
+        :param fps: playback frames per second
+        :param num_pixels: number of pixels in every frame
+        :param delta: True to delta compress frames against the previous frame
+        :param keyframe_interval: frames between full key frames when delta compressing, defaults to one second
+        """
+        self.fps = fps
+        self.num_pixels = num_pixels
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval or max(int(fps), 1)
+        self._file = open(filename, "wb")
+        self._records = []
+        self._previous = None
+
+    def write(self, frame: numpy.ndarray):
+        """Append a frame
+
+        :param frame: numpy uint32 array of num_pixels colour values
+        :return:
+        """
+        frame = numpy.asarray(frame, dtype=numpy.uint32)
+        record, flag = pack_grb(frame), 0
+        if self.delta and self._previous is not None and len(self._records) % self.keyframe_interval:
+            packed = record
+            delta = b"".join(RUN.pack(first, count) + packed[first * 3:(first + count) * 3]
+                             for first, count in _delta_runs(self._previous, frame))
+            if len(delta) < len(record):
+                record, flag = delta, DELTA_FRAME
+        self._records.append((record, flag))
+        self._previous = frame.copy()
+
+    def close(self):
+        """Write header, index and frames and close the file
+
+        :return:
+        """
+        offset = HEADER.size + INDEX_ENTRY.size * len(self._records)
+        self._file.write(HEADER.pack(MAGIC, VERSION, FLAG_DELTA if self.delta else 0, 0, self.fps, self.num_pixels,
+                                     len(self._records)))
+        for record, flag in self._records:
+            self._file.write(INDEX_ENTRY.pack(offset, len(record) | flag))
+            offset += len(record)
+        for record, flag in self._records:
+            self._file.write(record)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Animation:
+    """Memory mapped animation file, decoding frames in to a preallocated buffer"""
+
+    def __init__(self, filename: str):
+        """Open and memory map animation file
+
+        :param filename: path of animation file
+        """
+        with open(filename, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, flags, _, self.fps, self.num_pixels, self.frame_count = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{filename} is not a version {VERSION} animation file")
+        if self.frame_count < 1:
+            raise ValueError(f"{filename} contains no frames")
+
+        self._bytes = numpy.frombuffer(self._map, dtype=numpy.uint8)
+        self._index = numpy.frombuffer(self._map, dtype="<u4", count=2 * self.frame_count,
+                                       offset=HEADER.size).reshape(-1, 2)
+        self.frame = numpy.zeros(self.num_pixels, dtype=numpy.uint32)  # most recently decoded frame
+        self._current = -1
+
+    @property
+    def duration(self) -> float:
+        """Length of the animation in seconds"""
+        return self.frame_count / self.fps
+
+    def _apply(self, k: int):
+        """Decode frame k on top of the current frame
+
+        :param k: frame number
+        :return:
+        """
+        offset, length = int(self._index[k, 0]), int(self._index[k, 1])
+        if not length & DELTA_FRAME:
+            unpack_grb(self._bytes[offset:offset + length], self.frame)
+            return
+        end = offset + (length & ~DELTA_FRAME)
+        while offset < end:
+            first, count = RUN.unpack_from(self._map, offset)
+            offset += RUN.size
+            unpack_grb(self._bytes[offset:offset + count * 3], self.frame[first:first + count])
+            offset += count * 3
+
+    def seek(self, k: int) -> numpy.ndarray:
+        """Decode frame k in to self.frame
+
+        Moving forward applies each delta frame in between, moving backwards restarts from the last key frame
+        at or before k.
+
+        :param k: frame number
+        :return: self.frame
+        """
+        if k == self._current:
+            return self.frame
+        if k < self._current or self._current < 0:
+            start = k
+            while start > 0 and self._index[start, 1] & DELTA_FRAME:
+                start -= 1
+        else:
+            start = self._current + 1
+        for i in range(start, k + 1):
+            self._apply(i)
+        self._current = k
+        return self.frame
+
+    def close(self):
+        self._bytes = self._index = None
+        self._map.close()
+
+
+def render_frames(program: list, programs: dict, num_pixels: int, fps: float, duration: float):
+    """Render a program offline on a simulated strip, generating one frame array per frame period
+
+    :param program: list of program steps
+    :param programs: dictionary of named programs for sub-program steps
+    :param num_pixels: number of pixels to render
+    :param fps: frames per second
+    :param duration: seconds to render
+    :return: generator of numpy uint32 arrays (the same array is reused for every frame)
+    """
+    from ledcontroller.effects import close_effect, create_effect
+    from ledcontroller.sequencer import timeline
+    from ledcontroller.simulatedstrip import SimulatedPixelStrip
+
+    strip = SimulatedPixelStrip(num_pixels)
+    steps = timeline(program, programs)
+    step = next(steps, None)
+    start = 0.0
+    effect = create_effect(step, num_pixels)
+    rendered = False
+
+    try:
+        for k in range(int(round(duration * fps))):
+            t = k / fps
+
+            # move on to the step in progress at time t
+            while step.get("duration") is not None and t >= start + step["duration"]:
+                following = next(steps, None)
+                if following is None:
+                    break
+                start += step["duration"]
+                close_effect(effect)
+                step, effect, rendered = following, create_effect(following, num_pixels), False
+
+            if effect.frame_interval or not rendered:
+                effect.render(strip, t - start)
+                rendered = True
+            yield strip.pixel_buffer()
+    finally:
+        close_effect(effect)
+
+
+def bake(filename: str, program: list, programs: dict = None, num_pixels: int = 643, fps: float = 50,
+         duration: float = 10, delta: bool = False):
+    """Render a program offline in to an animation file
+
+    :param filename: path of animation file to write
+    :param program: list of program steps
+    :param programs: dictionary of named programs for sub-program steps
+    :param num_pixels: number of pixels to render
+    :param fps: frames per second
+    :param duration: seconds to render
+    :param delta: True to delta compress frames
+    :return:
+    """
+    with AnimationWriter(filename, fps, num_pixels, delta) as writer:
+        for frame in render_frames(program, programs, num_pixels, fps, duration):
+            writer.write(frame)
+
+
+def main(argv=None):
+    """Command line interface, see module docstring
+
+    :param argv: command line arguments, defaults to sys.argv
+    :return:
+    """
+    parser = argparse.ArgumentParser(description="Bake light effects and programs in to animation files")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    bake_parser = commands.add_parser("bake", help="render an effect or program in to an animation file")
+    source = bake_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--effect", help="name or number of registered effect")
+    source.add_argument("--program", help="name of program in the program file")
+    bake_parser.add_argument("--programs", default="program.yaml", help="program file (default program.yaml)")
+    bake_parser.add_argument("--pixels", type=int, default=643, help="number of pixels (default 643)")
+    bake_parser.add_argument("--fps", type=float, default=50, help="frames per second (default 50)")
+    bake_parser.add_argument("--duration", type=float, required=True, help="seconds to render")
+    bake_parser.add_argument("--delta", action="store_true", help="delta compress frames")
+    bake_parser.add_argument("filename")
+
+    info_parser = commands.add_parser("info", help="describe an animation file")
+    info_parser.add_argument("filename")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "bake":
+        programs = {}
+        if args.program:
+            import yaml
+            with open(args.programs) as stream:
+                programs = yaml.safe_load(stream)
+            program = programs[args.program]
+        else:
+            program = [{"effect": args.effect}]
+        bake(args.filename, program, programs, args.pixels, args.fps, args.duration, args.delta)
+
+    animation = Animation(args.filename)
+    deltas = int(numpy.count_nonzero(animation._index[:, 1] & DELTA_FRAME))
+    print(f"{args.filename}: {animation.frame_count} frames of {animation.num_pixels} pixels at {animation.fps:g} fps "
+          f"({animation.duration:.2f} s), {deltas} delta frames, {animation._map.size()} bytes")
+    animation.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Streaming audio analysis for music synchronised effects
+
+audio.py
+
+by Darren Dunford
+
+Audio is read from a WAV file, played back in real time, or from raw signed 16 bit little endian PCM arriving on
+a pipe or FIFO, e.g.
+
+    mkfifo /tmp/ledaudio
+    arecord -f S16_LE -r 44100 -c 2 -t raw > /tmp/ledaudio
+
+Analysis runs in the render thread once per frame over the most recent window of samples, so latency is bounded
+by the window length plus one frame. All sample buffers are allocated up front.
+
+Latency benchmark, audio sample written to show() on a simulated strip:
+
+    python3 -m ledcontroller.audio benchmark
+"""
+
+import argparse
+import logging
+import os
+import threading
+import time
+import wave
+
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AudioAnalyser:
+    """Computes band energies and beat onsets over a sliding window of the latest audio samples"""
+
+    def __init__(self, file: str = None, pipe: str = None, rate: int = 44100, channels: int = 2, window: int = 1024,
+                 bands: int = 8, min_freq: float = 40.0, max_freq: float = 12000.0, beat_threshold: float = 1.5):
+        """Open audio source and allocate analysis buffers
+
+        :param file: path of WAV file to play in real time
+        :param pipe: path of pipe or FIFO supplying raw S16_LE PCM, used if file is not given
+        :param rate: sample rate of raw PCM (WAV files give their own)
+        :param channels: channels of raw PCM (WAV files give their own), mixed down to mono
+        :param window: samples per FFT window
+        :param bands: number of logarithmically spaced frequency bands
+        :param min_freq: lowest band edge in Hz
+        :param max_freq: highest band edge in Hz
+        :param beat_threshold: bass energy relative to its recent average that counts as a beat onset
+        """
+        if file:
+            self._wave = wave.open(file, "rb")
+            if self._wave.getsampwidth() != 2:
+                self._wave.close()
+                raise ValueError(f"{file} is not 16 bit PCM")
+            self.rate = self._wave.getframerate()
+            self.channels = self._wave.getnchannels()
+            self._pipe = None
+        elif pipe:
+            self._wave = None
+            self.rate = rate
+            self.channels = channels
+            # non-blocking, so a frame never waits on the audio source
+            self._pipe = open(pipe, "rb", buffering=0, opener=lambda path, flags: os.open(path, flags | os.O_NONBLOCK))
+        else:
+            raise ValueError("audio needs a file or a pipe")
+
+        self.window = window
+        self.bands = bands
+        self.beat_threshold = beat_threshold
+
+        # preallocated buffers: raw bytes read, latest window of mono samples and the FFT window function
+        self._raw = bytearray(window * self.channels * 2)
+        self._samples = numpy.zeros(window, dtype=numpy.float32)
+        self._taper = numpy.hanning(window).astype(numpy.float32)
+        self._windowed = numpy.zeros(window, dtype=numpy.float32)
+        self._position = 0  # samples consumed from a WAV file
+        self._partial = b""  # bytes of an incomplete sample frame left over from a pipe read
+
+        # band edges as FFT bin indices, log spaced between min and max frequency
+        freqs = numpy.fft.rfftfreq(window, 1.0 / self.rate)
+        edges = numpy.geomspace(min_freq, min(max_freq, self.rate / 2), bands + 1)
+        self._edges = numpy.maximum(numpy.searchsorted(freqs, edges[:-1]), 1)
+        self._stop = numpy.searchsorted(freqs, edges[-1])
+
+        self.energies = numpy.zeros(bands, dtype=numpy.float64)  # normalised band energies 0-1
+        self._peaks = numpy.full(bands, 1e-6)
+        self._bass_average = 0.0
+        self._last_beat = -1.0
+        self.beat = False  # True on the frame a beat onset is detected
+        self.beat_time = None  # stream time (seconds) of the latest beat onset
+        self.sample_time = None  # time.time() at which the newest sample in the window was read
+
+    def _push(self, data: memoryview):
+        """Append interleaved S16_LE sample frames to the window, mixing down to mono
+
+        :param data: bytes of whole sample frames
+        :return:
+        """
+        frames = numpy.frombuffer(data, dtype="<i2").reshape(-1, self.channels)
+        n = len(frames)
+        if n == 0:
+            return
+        if n >= self.window:
+            numpy.mean(frames[-self.window:], axis=1, out=self._samples)
+        else:
+            self._samples[:-n] = self._samples[n:]
+            numpy.mean(frames, axis=1, out=self._samples[-n:])
+        self.sample_time = time.time()
+
+    def read(self, t: float):
+        """Bring the window up to date with the audio source
+
+        :param t: playback time in seconds, used to pace WAV files in real time
+        :return:
+        """
+        frame_bytes = self.channels * 2
+        view = memoryview(self._raw)
+
+        if self._wave is not None:
+            due = int(t * self.rate)
+            if due - self._position > self.window:
+                # fell behind, skip straight to the latest window
+                self._wave.setpos(min(due - self.window, self._wave.getnframes()))
+                self._position = due - self.window
+            while self._position < due:
+                data = self._wave.readframes(min(due - self._position, self.window))
+                if not data:
+                    self._samples[:] = 0  # end of file, silence
+                    break
+                self._position += len(data) // frame_bytes
+                self._push(memoryview(data))
+            return
+
+        # drain everything available on the pipe without blocking, keeping only the latest window
+        while True:
+            keep = len(self._partial)
+            view[:keep] = self._partial
+            n = self._pipe.readinto(view[keep:])
+            if not n:
+                return  # None if nothing available, 0 if the writer has closed the pipe
+            n += keep
+            whole = n - n % frame_bytes
+            self._push(view[:whole])
+            self._partial = bytes(view[whole:n])
+
+    def analyse(self, now: float):
+        """Compute band energies and beat onset for the current window
+
+        :param now: time in seconds, used to debounce beat onsets
+        :return:
+        """
+        numpy.multiply(self._samples, self._taper, out=self._windowed)
+        power = numpy.abs(numpy.fft.rfft(self._windowed)) ** 2
+        energies = numpy.add.reduceat(power[:self._stop], self._edges)
+
+        # automatic gain: each band is normalised to its own slowly decaying peak
+        numpy.maximum(self._peaks * 0.995, energies, out=self._peaks)
+        numpy.divide(energies, self._peaks, out=self.energies)
+
+        # beat onset when bass energy jumps above its recent average
+        bass = float(energies[:max(self.bands // 4, 1)].sum())
+        self.beat = (bass > self._bass_average * self.beat_threshold and bass > 1e3
+                     and now - self._last_beat > 0.15)
+        if self.beat:
+            self._last_beat = self.beat_time = now
+        self._bass_average += 0.1 * (bass - self._bass_average)
+
+    def close(self):
+        if self._wave is not None:
+            self._wave.close()
+        if self._pipe is not None:
+            self._pipe.close()
+
+
+def benchmark(beats: int = 20, fps: float = 100, num_pixels: int = 643):
+    """Measure latency from audio sample written to a pipe to the strip frame reacting to it
+
+    A writer thread feeds silence in real time with a loud bass burst once a second, while the MusicSync effect
+    renders to a simulated strip. Latency is measured from writing the first sample of each burst to the show()
+    of the first frame in which the effect flashes for the beat.
+
+    :param beats: number of bursts to measure
+    :param fps: render frames per second
+    :param num_pixels: number of pixels
+    :return:
+    """
+    import tempfile
+    from ledcontroller.effects import create_effect
+    from ledcontroller.simulatedstrip import SimulatedPixelStrip
+
+    rate, chunk = 44100, 256
+    fifo = os.path.join(tempfile.mkdtemp(), "audio")
+    os.mkfifo(fifo)
+    burst_times = []
+    stop = threading.Event()
+
+    def writer():
+        with open(fifo, "wb", buffering=0) as out:
+            tone = (numpy.sin(2 * numpy.pi * 60 * numpy.arange(rate // 10) / rate) * 30000).astype("<i2")
+            silence = numpy.zeros(chunk, dtype="<i2")
+            start, written, next_burst = time.time(), 0, rate // 2
+            while not stop.is_set():
+                if written >= next_burst:
+                    burst_times.append(time.time())
+                    out.write(tone.tobytes())
+                    written += len(tone)
+                    next_burst += rate
+                else:
+                    out.write(silence.tobytes())
+                    written += chunk
+                delay = start + written / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+    threading.Thread(target=writer, daemon=True).start()
+    strip = SimulatedPixelStrip(num_pixels)
+    effect = create_effect({"effect": "MusicSync", "pipe": fifo, "channels": 1, "rate": rate}, num_pixels)
+
+    latencies, costs = [], []
+    start = time.time()
+    while len(latencies) < beats:
+        now = time.time()
+        render_start = time.perf_counter()
+        effect.render(strip, now - start)
+        strip.show()
+        costs.append(time.perf_counter() - render_start)
+        if effect.analyser.beat and burst_times:
+            latencies.append(time.time() - burst_times[-1])
+        time.sleep(max(1 / fps - (time.time() - now), 0))
+    stop.set()
+    effect.close()
+
+    latencies = numpy.array(latencies[1:]) * 1000  # first burst includes pipe start up
+    costs = numpy.array(costs) * 1000
+    print(f"sample to show() latency over {len(latencies)} beats: median {numpy.median(latencies):.1f} ms, "
+          f"max {latencies.max():.1f} ms")
+    print(f"render cost per frame (read, FFT, map, {num_pixels} pixels): median {numpy.median(costs):.2f} ms, "
+          f"99th percentile {numpy.percentile(costs, 99):.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Audio analysis tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench_parser = commands.add_parser("benchmark", help="measure audio sample to show() latency")
+    bench_parser.add_argument("--beats", type=int, default=20)
+    bench_parser.add_argument("--fps", type=float, default=100)
+    bench_parser.add_argument("--pixels", type=int, default=643)
+    args = parser.parse_args()
+    benchmark(args.beats, args.fps, args.pixels)
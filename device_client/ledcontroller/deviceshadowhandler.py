@@ -9,13 +9,114 @@ by Darren Dunford
 import json
 import logging
 import queue
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTShadowClient
+import threading
+import time
+
+from ledcontroller.publishqueue import CoalescingPublishQueue
+from ledcontroller.tracing import CommandTrace
 
 LOGGER = logging.getLogger(__name__)
 
 
 class DeviceShadowHandler:
 
+    GET_ATTEMPTS = 3  # shadow gets sent after connecting before the offline queue is flushed without a reply
+
+    def _shadow_update(self, payload: dict, timeout: int):
+        """Send update to device shadow if connected, otherwise merge it in to the offline queue
+
+        :param payload: shadow document to send
+        :param timeout: operation timeout in seconds
+        :return:
+        """
+        with self._publish_lock:
+            if self.connected.is_set():
+                try:
+                    self.shadow_handler.shadowUpdate(json.dumps(payload), None, timeout)
+                    return
+                except Exception as exc:
+                    LOGGER.debug("Shadow update failed, queueing: %s", exc)
+            self.offline_queue.put(payload)
+
+    def _flush_offline_queue(self):
+        """Send everything queued while offline as merged shadow documents, then set connected so later updates
+        are sent directly
+
+        Holds the publish lock throughout, so no update can reach the shadow ahead of the older queued values and
+        then be overwritten by them. If the flush fails the queue is kept and updates go on being queued until the
+        next time the connection comes back.
+
+        :return:
+        """
+        with self._publish_lock:
+            documents = self.offline_queue.take()
+            if documents:
+                documents[-1]["state"].setdefault("reported", {})
+                if documents[-1]["state"]["reported"] is not None:
+                    documents[-1]["state"]["reported"]["offline_queue"] = self.offline_queue.stats()
+            for sent, document in enumerate(documents):
+                try:
+                    self.shadow_handler.shadowUpdate(json.dumps(document), None, 20)
+                except Exception as exc:
+                    LOGGER.warning("Offline queue flush failed: %s", exc)
+                    for unsent in documents[sent:]:
+                        self.offline_queue.put(unsent, replace=False)
+                    return
+            if documents:
+                LOGGER.info("Flushed offline queue: %s", json.dumps(self.offline_queue.stats()))
+            self.connected.set()
+
+    def _resync(self):
+        """Fetch the shadow to reconcile with local state, everything queued while offline is sent once the reply
+        has arrived, by custom_shadow_callback_get
+
+        :return:
+        """
+        self._get_attempts = 0
+        self._request_shadow()
+
+    def _on_online(self):
+        """MQTT online callback, resyncs with the shadow in a separate thread to avoid blocking the SDK
+
+        :return:
+        """
+        if self.shadow_handler is not None:
+            threading.Thread(target=self._resync, daemon=True).start()
+
+    def _request_shadow(self):
+        """Ask for the full shadow document, the reply is posted as a "shadow" event by custom_shadow_callback_get
+
+        The offline queue is flushed only once the reply has arrived, as flushing clears the desired state.
+
+        :return:
+        """
+        self._get_attempts += 1
+        try:
+            self.shadow_handler.shadowGet(self.custom_shadow_callback_get, 20)
+        except Exception as exc:
+            LOGGER.warning("Shadow get failed: %s", exc)
+            self._after_get()
+
+    def _after_get(self, timed_out: bool = False):
+        """Called once the shadow get is answered or has failed, retries a get that timed out, otherwise sends
+        everything queued while offline, in a separate thread to avoid blocking the SDK
+
+        :param timed_out: True if the get timed out
+        :return:
+        """
+        if timed_out and self._get_attempts < self.GET_ATTEMPTS:
+            threading.Thread(target=self._request_shadow, daemon=True).start()
+        else:
+            threading.Thread(target=self._flush_offline_queue, daemon=True).start()
+
+    def _on_offline(self):
+        """MQTT offline callback, routes shadow updates to the offline queue until back online
+
+        :return:
+        """
+        LOGGER.info("AWSIoT connection lost")
+        self.connected.clear()
+
     def status_post(self, status, state=None):
         """Post status message and device state to AWSIoT and LOGGER
 
@@ -30,55 +131,115 @@ class DeviceShadowHandler:
             new_payload.update({"state": {"reported": state}})
 
         # update shadow
-        self.shadow_handler.shadowUpdate(json.dumps(new_payload), None, 20)
+        self._shadow_update(new_payload, 20)
 
         # log to syslog
         LOGGER.info(status)
         LOGGER.debug(json.dumps(new_payload))
 
     # constructor
-    def __init__(self, thingname: str, host: str, root_ca_path: str, private_key_path: str, certificate_path: str):
-        """Initiate AWS IoT connection
+    def __init__(self, thingname: str, host: str, root_ca_path: str, private_key_path: str, certificate_path: str,
+                 offline_queue_bytes: int = 65536):
+        """Prepare AWS IoT connection, the connection itself is made in the background by start()
 
         :param thingname: AWSIoT thing name
         :param host: AWSIoT endpoint FQDN
         :param root_ca_path: local file path to Amazon root certificate
         :param private_key_path: local file path to device private key
         :param certificate_path: local file path to device certificate
+        :param offline_queue_bytes: memory cap in bytes for shadow updates held while offline
         """
 
+        self._thingname = thingname
+        self._host = host
+        self._credentials = (root_ca_path, private_key_path, certificate_path)
+        self._connect_thread = None
+        self._get_attempts = 0
+
+        # set while connected with the shadow subscription up and the offline queue flushed, shadow updates are
+        # queued at other times; changes under _publish_lock, which is held while publishing
+        self.connected = threading.Event()
+        self._publish_lock = threading.Lock()
+        self.shadow_handler = None
+        self.offline_queue = CoalescingPublishQueue(offline_queue_bytes)
+
+        # callbacks in this class post events on to this queue, or if set pass them to on_event instead
+        # (called on the SDK's callback thread, so must be thread safe)
+        self.event_queue = queue.SimpleQueue()
+        self.on_event = None
+
+        self.settings = {}
+
+        # clock stamping traced commands as received, replaced by the corrected render clock
+        self.clock = time.time
+
+    def start(self):
+        """Connect to AWS IoT in a background daemon thread, does nothing if already started
+
+        :return:
+        """
+        if self._connect_thread is None:
+            self._connect_thread = threading.Thread(target=self._connect, daemon=True)
+            self._connect_thread.start()
+
+    def _connect(self):
+        """Connect to AWS IoT and subscribe to the device shadow, retrying until successful
+
+        The AWS SDK is imported here rather than at module level as importing it takes a significant time on a
+        Raspberry Pi and is not needed until the lights are already running.
+
+        :return:
+        """
+        from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTShadowClient
+
         # Init Shadow Client MQTT connection
-        self.shadow_client = AWSIoTMQTTShadowClient(thingname)
-        self.shadow_client.configureEndpoint(host, 8883)
-        self.shadow_client.configureCredentials(root_ca_path, private_key_path, certificate_path)
+        self.shadow_client = AWSIoTMQTTShadowClient(self._thingname)
+        self.shadow_client.configureEndpoint(self._host, 8883)
+        self.shadow_client.configureCredentials(*self._credentials)
 
         # AWSIoTMQTTShadowClient configuration
         self.shadow_client.configureAutoReconnectBackoffTime(1, 32, 20)
         self.shadow_client.configureConnectDisconnectTimeout(20)  # 20 sec
         self.shadow_client.configureMQTTOperationTimeout(20)  # 20 sec
 
-        # force shadow client to use offline publish queueing
-        # overriding the default behaviour for shadow clients in the SDK
+        # disable the SDK's own offline publish queueing, which is unbounded and replays every update, in favour
+        # of the coalescing offline queue in this class
         mqtt_client = self.shadow_client.getMQTTConnection()
-        mqtt_client.configureOfflinePublishQueueing(-1)
-
-        # Connect to AWS IoT with a 300 second keepalive
-        self.shadow_client.connect(300)
+        mqtt_client.configureOfflinePublishQueueing(0)
+        mqtt_client.onOnline = self._on_online
+        mqtt_client.onOffline = self._on_offline
+
+        # Connect to AWS IoT with a 300 second keepalive, the SDK only reconnects automatically
+        # after a first successful connection so retry here with the same backoff
+        backoff = 1
+        while True:
+            try:
+                self.shadow_client.connect(300)
+                break
+            except Exception as exc:
+                LOGGER.warning("AWSIoT connection failed, retrying in %d s: %s", backoff, exc)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 32)
 
         # Create a deviceShadow with persistent subscription and register delta handler
-        self.shadow_handler = self.shadow_client.createShadowHandlerWithName(thingname, True)
+        self.shadow_handler = self.shadow_client.createShadowHandlerWithName(self._thingname, True)
         self.shadow_handler.shadowRegisterDeltaCallback(self.custom_shadow_callback_delta)
 
-        # initial status post
-        self.status_post('STARTING')
+        # fetch the shadow to reconcile with state resumed locally, everything queued before the connection was
+        # made is sent once it has arrived, then initial status post
+        self._resync()
+        self.status_post('CONNECTED')
 
-        # dictionary to hold callback responses
-        self._callbackresponses = {}
+    def _post_event(self, event: dict):
+        """Pass event to on_event if set, otherwise put it on the event queue
 
-        # callbacks in this class post events on to this queue
-        self.event_queue = queue.SimpleQueue()
-
-        self.settings = {}
+        :param event: event dictionary
+        :return:
+        """
+        if self.on_event:
+            self.on_event(event)
+        else:
+            self.event_queue.put_nowait(event)
 
     # Custom shadow callback for delta -> remote triggering
     def custom_shadow_callback_delta(self, payload: str, response_status, token):
@@ -98,59 +259,81 @@ class DeviceShadowHandler:
 
         # check for command, if received push event on to queue
         if payload_dict.get('state').get('command'):
-            self.event_queue.put_nowait({"command":payload_dict.get('state').get('command')})
+            command = payload_dict.get('state').get('command')
+            trace = CommandTrace.from_command(command, self.clock)
+            self._post_event({"command": command, "trace": trace} if trace else {"command": command})
             new_payload.update({"state": {"desired": {"command": None}}})
 
         # check for settings, if received push event on to queue
         if payload_dict.get('state').get('settings'):
-            self.event_queue.put_nowait({"settings":payload_dict.get('state').get('settings')})
+            self._post_event({"settings":payload_dict.get('state').get('settings')})
             new_payload.update({"state": {"desired": {"settings": payload_dict.get('state').get('settings')}}})
 
         LOGGER.info("Shadow update: " + json.dumps(new_payload))
 
         # update shadow instance status
-        self.shadow_handler.shadowUpdate(json.dumps(new_payload), None, 5)
+        self._shadow_update(new_payload, 5)
 
     def custom_shadow_callback_get(self, payload, response_status, token):
-        """Callback function records response from get shadow operation
-
-        :param payload:
-        :param response_status:
-        :param token:
-        :return:
-        """
-        self._callbackresponses.update({token: {"payload": json.loads(payload), "responseStatus": response_status}})
-
-    def get_response(self, token):
-        """Return prior get shadow operation response
+        """Callback function posts the document from an accepted get shadow operation as a "shadow" event
 
-        note each response is deleted when returned, i.e. can only be returned once
+        a command left pending in the desired state is cleared, as it will be run from the event
 
+        :param payload: JSON string ready to be parsed using json.loads(...), or a plain message if not accepted
+        :param response_status: "accepted", "rejected" or "timeout"
         :param token:
         :return:
         """
-        return self._callbackresponses.pop(token)
+        if response_status != "accepted":
+            LOGGER.warning("Shadow get %s", response_status)
+            self._after_get(response_status == "timeout")
+            return
+
+        document = json.loads(payload)
+        self._post_event({"shadow": document})
+        if ((document.get("state") or {}).get("desired") or {}).get("command"):
+            self._shadow_update({"state": {"desired": {"command": None}}}, 5)
+        self._after_get()
 
     # post all parameters as a shadow update
     def post_param(self):
         new_payload = {"state": {"reported": {"settings": self.settings}, "desired": None}}
-        self.shadow_handler.shadowUpdate(json.dumps(new_payload), None, 5)
+        self._shadow_update(new_payload, 5)
 
     # post state update to device shadow and, if enabled, syslog
     def post_state(self, state):
 
         # create new JSON payload to update device shadow
         new_payload = {"state": {"reported": {"status": state}, "desired": None}}
-        self.shadow_handler.shadowUpdate(json.dumps(new_payload), None, 20)
+        self._shadow_update(new_payload, 20)
 
         # log to syslog
         LOGGER.info("New state" + json.dumps(state))
 
+    # post latencies of a traced command to device shadow
+    def post_trace(self, report):
+
+        # create new JSON payload to send trace report to shadow
+        new_payload = {"state": {"reported": {"trace": report}}}
+        self._shadow_update(new_payload, 20)
+
+        # log to syslog
+        LOGGER.info("Command trace " + json.dumps(report))
+
     def post_temperature(self, temp):
 
         # create new JSON payload to send device temperature to shadow
         new_payload = {"state": {"reported": {"cputemp": temp}}}
-        self.shadow_handler.shadowUpdate(json.dumps(new_payload), None, 20)
+        self._shadow_update(new_payload, 20)
 
         # log to syslog on debug only
         LOGGER.debug("New temp payload " + json.dumps(new_payload))
+
+    def post_governor(self, state):
+
+        # create new JSON payload to send thermal governor state to shadow
+        new_payload = {"state": {"reported": {"governor": state}}}
+        self._shadow_update(new_payload, 20)
+
+        # log to syslog
+        LOGGER.info("New governor state " + json.dumps(state))
@@ -9,11 +9,33 @@ import logging
 #
 # originally based on strandtest.py by Tony DiCola (tony@tonydicola.com)
 # see https://github.com/rpi-ws281x/rpi-ws281x-python
-import random
+import math
+import struct
 import threading
 
 import time
-from rpi_ws281x import PixelStrip
+
+import numpy
+
+try:
+    from rpi_ws281x import PixelStrip
+    import _rpi_ws281x as ws
+except ImportError:
+    # rpi_ws281x only builds on a Raspberry Pi, so elsewhere fall back to a simulated strip
+    # allowing effects to be rendered offline
+    from ledcontroller.simulatedstrip import SimulatedPixelStrip as PixelStrip
+    ws = None
+
+from ledcontroller.animation import Animation
+from ledcontroller.audio import AudioAnalyser
+from ledcontroller.expressions import ExpressionRenderer, hsv_to_colors
+from ledcontroller.layout import map_design, map_pixels, reference_index, scale_pixels
+from ledcontroller.pipeline import FramePipeline
+from ledcontroller.sequencer import timeline
+from ledcontroller.thermal import ThermalGovernor
+from ledcontroller.timebase import SlotSchedule, hash_choice, hash_random
+from ledcontroller.tracing import CommandTrace
+from ledcontroller.udpstream import StreamReceiver, PROTOCOLS
 
 LOGGER = logging.getLogger(__name__)
 
@@ -25,11 +47,13 @@ XMAS_PATTERNS = {
                 list(range(76, 90)) + list(range(91, 105)) + list(range(106, 125))
 }
 
+XMAS_REFERENCE_PIXELS = 643  # length of the strip the tree patterns are laid out on, scaled to other lengths
 TREE_OFFSET = 117
 for key in XMAS_PATTERNS:
     XMAS_PATTERNS[key][:] = [i + TREE_OFFSET for i in XMAS_PATTERNS[key]]
 
-XMAS_PATTERNS.update({"extended_base": list(range(0, 117)) + list(range(260, 643)) + XMAS_PATTERNS["base"]})
+XMAS_PATTERNS.update({"extended_base": list(range(0, 117)) + list(range(260, XMAS_REFERENCE_PIXELS)) +
+                                      XMAS_PATTERNS["base"]})
 
 
 class LockingPixelStrip(PixelStrip):
@@ -61,6 +85,38 @@ class LockingPixelStrip(PixelStrip):
         self.effect = None
         self.step = None
         self.step_num = 0
+        self.first_frame = threading.Event()
+        self.first_frame_time = None
+        self.recorder = None  # optional FlightRecorder recording every frame shown
+        self._buffer = None
+
+    def pixel_buffer(self):
+        """Return a numpy uint32 array sharing memory with the strip's LED buffer
+
+        Writing a whole frame to this array (e.g. with numpy.copyto) costs no Python work per pixel, unlike
+        setPixelColor. Only valid after begin(), which allocates the buffer.
+
+        :return:
+        """
+        if ws is None:
+            return super().pixel_buffer()
+        if self._buffer is None:
+            import ctypes
+            address = int(ws.ws2811_channel_t_leds_get(self._channel))
+            self._buffer = numpy.ctypeslib.as_array((ctypes.c_uint32 * self.numPixels()).from_address(address))
+        return self._buffer
+
+    def show(self):
+        """Update the LED strip, recording the time the first frame is shown and the frame if recording
+
+        :return:
+        """
+        super().show()
+        if self.recorder:
+            self.recorder.record_frame(self.pixel_buffer(), time.time(), self.getBrightness())
+        if not self.first_frame.is_set():
+            self.first_frame_time = time.time()
+            self.first_frame.set()
 
 
 def color(red: int, green: int, blue: int, white: int = 0):
@@ -80,18 +136,33 @@ def color(red: int, green: int, blue: int, white: int = 0):
     return (white << 24) | (green << 16) | (red << 8) | blue
 
 
-def color_wipe(strip: PixelStrip, color: color, wait_ms: int = 50):
+def _pause(wait_ms: int, stop_event: threading.Event = None) -> bool:
+    """Wait between frames of a blocking effect function, waking early if stop_event is set
+
+    :param wait_ms: time to wait in ms
+    :param stop_event: optional event which ends the wait
+    :return: True if stop_event is set and the effect should return
+    """
+    if stop_event is None:
+        time.sleep(wait_ms / 1000.0)
+        return False
+    return stop_event.wait(wait_ms / 1000.0)
+
+
+def color_wipe(strip: PixelStrip, color: color, wait_ms: int = 50, stop_event: threading.Event = None):
     """Wipe color across display a pixel at a time.
 
     :param strip: PixelStrip object to apply the effect to
     :param color: Color to wipe
     :param wait_ms: blocking time to wait (in ms) before returning
+    :param stop_event: optional event which ends the wipe at the next pixel
     :return:
     """
     for i in range(strip.numPixels()):
         strip.setPixelColor(i, color)
         strip.show()
-        time.sleep(wait_ms / 1000.0)
+        if _pause(wait_ms, stop_event):
+            return
 
 
 def clear_strip(strip: PixelStrip):
@@ -99,382 +170,906 @@ def clear_strip(strip: PixelStrip):
 
     :return:
     """
-    for i in range(strip.numPixels()):
-        strip.setPixelColor(i, color(0, 0, 0))
+    numpy.copyto(strip.pixel_buffer(), 0)
     strip.show()
 
 
+EFFECTS = {}  # registry of effect name (and legacy effect number) to Effect class
+
+
+def register_effect(name: str, number: int = None):
+    """Class decorator registering an Effect class under its name and, optionally, its legacy effect number
+
+    :param name: effect name as used in program.yaml and EFFECT commands
+    :param number: optional legacy effect number
+    :return:
+    """
+    def register(cls):
+        cls.name = name
+        EFFECTS[name] = cls
+        if number is not None:
+            EFFECTS[str(number)] = cls
+        return cls
+    return register
+
+
+def create_effect(step: dict, num_pixels: int, seed: int = 0):
+    """Construct, and so prepare, the effect for a program step
+
+    :param step: program step dictionary
+    :param num_pixels: number of pixels on the strip the effect will be rendered to
+    :param seed: seed for the effect's random choices, the same on synchronised devices
+    :return: Effect object
+    """
+    cls = EFFECTS.get(str(step.get("effect")))
+    if cls is None:
+        LOGGER.warning("Unknown effect %s", step.get("effect"))
+        cls = Effect
+    try:
+        effect = cls(step, num_pixels)
+    except Exception as exc:
+        LOGGER.error("Unable to prepare effect %s: %s", step.get("effect"), exc)
+        effect = Effect(step, num_pixels)
+        effect.finished = not cls.lookahead  # an outside source that cannot be opened ends its step at once
+    effect.seed = seed
+    return effect
+
+
+def close_effect(effect):
+    """Close an effect once its step has ended, logging rather than raising any error
+
+    :param effect: Effect object
+    :return:
+    """
+    try:
+        effect.close()
+    except Exception:
+        LOGGER.exception("Unable to close effect %s", effect.name)
+
+
+class Effect:
+    """Base class for a programmed effect
+
+    An effect is constructed for a program step ahead of the time the step starts, so any expensive preparation
+    (palettes, caches, particle buffers) belongs in the constructor. render() is then called for every frame
+    with the time since the step started and draws the frame on the canvas. The base class draws nothing.
+
+    An effect driven by an outside source sets lookahead False, so its frames are rendered when due rather than
+    ahead of time, may return False from render() when the frame has not changed, so it is not shown, and may
+    set finished to end its step early. Files and sockets opened by an effect are released by close(), called
+    once its step has ended however it ended. Any other effect must draw the same frame for the
+    same time and seed, whatever frames were drawn before, so synchronised devices stay in step: random choices
+    come from timebase.hash_random() of the seed, not from the random module.
+    """
+
+    name = None
+    frame_interval = None  # minimum time between frames in seconds, None for a static effect drawn only once
+    finished = False  # set by the effect to end its step before its duration
+    lookahead = True  # frames may be rendered ahead of time, False for an effect driven by an outside source
+
+    def __init__(self, step: dict, num_pixels: int):
+        """Prepare effect
+
+        :param step: program step dictionary
+        :param num_pixels: number of pixels the effect will be rendered to
+        """
+        self.step = step
+        self.num_pixels = num_pixels
+        self.detail = 1.0  # detail factor (0-1) set by the renderer from the thermal governor before each frame
+        self.seed = 0  # seed for random choices, set by create_effect()
+
+    @classmethod
+    def validate(cls, step: dict):
+        """Check effect specific parameters of a program step at program load, raising ValueError if invalid
+
+        :param step: program step dictionary
+        :return:
+        """
+        pass
+
+    def render(self, canvas: PixelStrip, t: float):
+        """Draw the frame for time t
+
+        :param canvas: PixelStrip, or any object with the same pixel_buffer() interface, to draw on
+        :param t: time in seconds since the step started
+        :return:
+        """
+        pass
+
+    def close(self):
+        """Release anything the effect holds open, called once when its step ends, or when it is prepared for a
+        step that never starts
+
+        :return:
+        """
+        pass
+
+
+# UK emergency blue light effect
+@register_effect("EmergencyBlueLight", 1)
+class EmergencyBlueLight(Effect):
+    frame_interval = 0.01
+
+    def render(self, canvas, t):
+        curr_time = t * 2
+        half = self.num_pixels // 2
+        lit = color(0, 0, 255) if (int(curr_time * 10) % 2) > 0 else color(0, 0, 0)
+        first, second = (lit, color(0, 0, 0)) if int(curr_time % 2) > 0 else (color(0, 0, 0), lit)
+        pixels = canvas.pixel_buffer()
+        pixels[:half] = first
+        pixels[half:] = second
+
+
+# Static rainbow effect, designed for a strip of 50 LEDs and scaled to the strip
+@register_effect("RainbowStatic", 2)
+class RainbowStatic(Effect):
+    REFERENCE_PIXELS = 50
+
+    def __init__(self, step, num_pixels):
+        super().__init__(step, num_pixels)
+        rainbow = [color(255, 0, 0),
+                   color(255, 127, 0),
+                   color(255, 255, 0),
+                   color(0, 255, 0),
+                   color(0, 0, 255),
+                   color(46, 43, 95),
+                   color(139, 0, 255)]
+        length = len(rainbow)
+        design = {}
+        for i in range(length):
+            for j in range(3):
+                design[4 + (i * 3) + j] = rainbow[i]
+                design[22 + ((length - i) * 3) + j] = rainbow[i]
+        self._pixels, self._colours = map_design(design, self.REFERENCE_PIXELS, num_pixels)
+
+    def render(self, canvas, t):
+        canvas.pixel_buffer()[self._pixels] = self._colours
+
+
+# rainbow_cycle effect
+@register_effect("RainbowCycle", 3)
+class RainbowCycle(Effect):
+    frame_interval = 0.02
+
+    def __init__(self, step, num_pixels):
+        super().__init__(step, num_pixels)
+        self._palette = numpy.array([wheel(pos) for pos in range(256)], dtype=numpy.uint32)
+        self._offsets = (numpy.arange(num_pixels) * 256 // num_pixels).astype(numpy.intp)
+        self._index = numpy.empty_like(self._offsets)
+
+    def render(self, canvas, t):
+        j = int(t / self.frame_interval) & 255
+        numpy.add(self._offsets, j, out=self._index)
+        numpy.bitwise_and(self._index, 255, out=self._index)
+        numpy.take(self._palette, self._index, out=canvas.pixel_buffer())
+
+
+# landing strip effect
+@register_effect("LandingStrip", 4)
+class LandingStrip(Effect):
+    frame_interval = 0.05
+
+    def render(self, canvas, t):
+        flash = (t % 1.0) < 0.05
+        pixels = canvas.pixel_buffer()
+        pixels[0::2] = color(200, 200, 200) if flash else color(0, 0, 0)
+        pixels[1::2] = color(200, 200, 200)
+
+
+# test pattern - in blocks of 5 lights
+@register_effect("TestPattern")
+class TestPattern(Effect):
+
+    def __init__(self, step, num_pixels):
+        super().__init__(step, num_pixels)
+        block = numpy.arange(num_pixels) // 5
+        self._pattern = numpy.where(block % 2 == 0, color(0, 0, 255), color(255, 0, 255)).astype(numpy.uint32)
+
+    def render(self, canvas, t):
+        numpy.copyto(canvas.pixel_buffer(), self._pattern)
+
+
+class ChristmasTree(Effect):
+    """Base class for the Christmas effects, drawn on the tree layout of XMAS_PATTERNS
+
+    Each frame is drawn on a frame of the XMAS_REFERENCE_PIXELS reference strip the patterns are laid out on,
+    then mapped on to the strip in one go.
+    """
+
+    frame_interval = 0.01
+
+    def __init__(self, step, num_pixels):
+        super().__init__(step, num_pixels)
+        self._events = SlotSchedule(0.01, 1.0, self._spawn)
+
+        # the trunk, base and branches are static, so draw them once
+        self._static = numpy.zeros(XMAS_REFERENCE_PIXELS, dtype=numpy.uint32)
+        self._static[XMAS_PATTERNS["trunk"]] = color(150, 75, 0)
+        self._draw_base(self._static)
+        self._static[XMAS_PATTERNS["branches"]] = color(0, 255, 0)
+        self._frame = self._static.copy()
+        drawn = sorted(set().union(*XMAS_PATTERNS.values()))
+        self._pixels, self._reference = map_pixels(drawn, XMAS_REFERENCE_PIXELS, num_pixels)
+
+    def _draw_base(self, frame: numpy.ndarray):
+        """Draw the static base of the tree and the strip beyond it
+
+        :param frame: reference frame
+        :return:
+        """
+        pass
+
+    def show_frame(self, canvas):
+        """Map the reference frame on to the canvas, then reset it to the static parts of the tree
+
+        :param canvas: canvas to draw on
+        :return:
+        """
+        canvas.pixel_buffer()[self._pixels] = self._frame[self._reference]
+        numpy.copyto(self._frame, self._static)
+
+
+@register_effect("Christmas1")
+class Christmas1(ChristmasTree):
+
+    twinkle_colours = [
+        color(255, 0, 0),
+        color(0, 0, 255),
+        color(255, 255, 0),
+        color(0, 255, 255),
+        color(255, 0, 127)
+    ]
+
+    def _draw_base(self, frame):
+        frame[XMAS_PATTERNS["extended_base"]] = color(20, 20, 20)
+
+    def _spawn(self, k: int) -> list:
+        """Roll the dice for time slot k: a white or blue snowflake on the base, a twinkle on the tree, or nothing
+
+        :param k: slot number
+        :return: list of events starting in the slot
+        """
+        if hash_random(self.seed, k, 0) >= self.detail:
+            return []
+        dice = 1 + int(hash_random(self.seed, k, 1) * 199)
+        starttime = k * self._events.slot
+        if 20 <= dice <= 148 or 150 <= dice <= 190:
+            return [{"starttime": starttime, "blue": dice >= 150,
+                     "position": hash_choice(XMAS_PATTERNS["extended_base"], self.seed, k, 2)}]
+        if 1 <= dice <= 15:
+            return [{"starttime": starttime, "twinkle": True,
+                     "position": hash_choice(XMAS_PATTERNS["branches"], self.seed, k, 2),
+                     "colour": hash_choice(self.twinkle_colours, self.seed, k, 3)}]
+        return []
+
+    def render(self, canvas, t):
+        frame = self._frame
+
+        # base snowing effect, and twinkling tree lights
+        for event in self._events.active(t):
+            if "twinkle" in event:
+                frame[event["position"]] = event["colour"]
+                continue
+            brightness = int((1 - abs((t - event["starttime"]) * 2 - 1)) * (255 - 20) + 20)
+            if brightness >= 20:
+                if event["blue"]:
+                    frame[event["position"]] = color(20, brightness, brightness)
+                else:
+                    frame[event["position"]] = color(brightness, brightness, brightness)
+
+        # star flashes yellow
+        star_colour_comp = int(abs(t % 2 - 1) * 255)
+        frame[XMAS_PATTERNS["star"]] = color(star_colour_comp, star_colour_comp, 0)
+        self.show_frame(canvas)
+
+
+@register_effect("Christmas2")
+class Christmas2(ChristmasTree):
+
+    twinkle_colours = [
+        color(0, 0, 255),
+        color(255, 0, 127)
+    ]
+
+    def _draw_base(self, frame):
+        base = numpy.array(XMAS_PATTERNS["extended_base"])
+        frame[base] = numpy.where((base // 3) % 2 == 1, color(255, 0, 0), color(0, 255, 0))
+
+    def _spawn(self, k: int) -> list:
+        """Roll the dice for time slot k: two snowflakes on the base, a twinkle on the tree, or nothing
+
+        :param k: slot number
+        :return: list of events starting in the slot
+        """
+        if hash_random(self.seed, k, 0) >= self.detail:
+            return []
+        dice = 1 + int(hash_random(self.seed, k, 1) * 199)
+        starttime = k * self._events.slot
+        if 40 <= dice <= 190:
+            return [{"starttime": starttime, "position": hash_choice(XMAS_PATTERNS["extended_base"], self.seed, k, n)}
+                    for n in (2, 3)]
+        if 1 <= dice <= 30:
+            return [{"starttime": starttime, "twinkle": True,
+                     "position": hash_choice(XMAS_PATTERNS["branches"], self.seed, k, 2),
+                     "colour": hash_choice(self.twinkle_colours, self.seed, k, 3)}]
+        return []
+
+    def render(self, canvas, t):
+        frame = self._frame
+
+        # flakes on the red/green base, and twinkling tree lights
+        for event in self._events.active(t):
+            if "twinkle" in event:
+                frame[event["position"]] = event["colour"]
+                continue
+            brightness = int((1 - abs((t - event["starttime"]) * 2 - 1)) * 255)
+            if 0 <= brightness <= 255:
+                if (event["position"] // 3) % 2 == 1:
+                    frame[event["position"]] = color(255, brightness, 0)
+                else:
+                    frame[event["position"]] = color(brightness, 255, 0)
+
+        # star flashes yellow
+        star_colour_comp = int(abs((t * 2) % 2 - 1) * 255)
+        frame[XMAS_PATTERNS["star"]] = color(star_colour_comp, star_colour_comp, 0)
+        self.show_frame(canvas)
+
+
+# designed for a strip of 50 LEDs: glows are placed over the middle 80% of the strip and spawned in proportion
+# to its length, so they keep their size and density on a longer strip
+@register_effect("Halloween")
+class Halloween(Effect):
+    frame_interval = 0.01
+
+    REFERENCE_PIXELS = 50
+    THUNDER_CHANCE = 1 / 399  # chance of thunder starting in each 0.1 s slot
+    THUNDER_SLOTS = 20  # slots a thunder sequence can last, no new thunder starts within this many slots of one
+    GLOW_SCALE = numpy.array([0.5, 1, 1, 1, 1, 1, 0.5])  # green of each pixel of a glow, fraction * scale + offset
+    GLOW_OFFSET = numpy.array([0.5, 0, 0, 0, 0, 0, 0.5])
+
+    def __init__(self, step, num_pixels):
+        super().__init__(step, num_pixels)
+        self._positions = SlotSchedule(0.1, 2.0, self._spawn_position)
+        self._thunder = SlotSchedule(0.1, 2.0, self._spawn_thunder)
+        self._glows = max(1, round(num_pixels / self.REFERENCE_PIXELS))  # chances of a glow in each slot
+        self._lowest = scale_pixels(5, self.REFERENCE_PIXELS, num_pixels)
+        self._spread = scale_pixels(40, self.REFERENCE_PIXELS, num_pixels)
+        self._flashed = 2 * scale_pixels(24, self.REFERENCE_PIXELS, num_pixels)  # pixels lit and dark in a flash
+
+    def _spawn_position(self, k: int) -> list:
+        """Roll the dice for glowing positions starting in time slot k
+
+        :param k: slot number
+        :return: list of events starting in the slot
+        """
+        positions = []
+        for n in range(self._glows):
+            counter = (k,) if n == 0 else (k, n)
+            if hash_random(self.seed, *counter, 0) < 1 / 9 and hash_random(self.seed, *counter, 1) < self.detail:
+                positions.append({"starttime": k * 0.1,
+                                  "position": self._lowest + int(hash_random(self.seed, *counter, 2) * self._spread)})
+        return positions
+
+    def _thunders(self, k: int) -> bool:
+        return hash_random(self.seed, k, 3) < self.THUNDER_CHANCE
+
+    def _spawn_thunder(self, k: int) -> list:
+        """Schedule a random sequence of thunderflashes starting half a second after time slot k
+
+        :param k: slot number
+        :return: list of (start, end) times of flashes
+        """
+        if not self._thunders(k) or any(self._thunders(j) for j in range(max(k - self.THUNDER_SLOTS, 1), k)):
+            return []
+        flashes = []
+        t = k * 0.1 + 0.5
+        for i in range(2 + int(hash_random(self.seed, k, 4) * 6)):
+            flashes.append((t, t + 0.05))
+            t += 0.08
+        if hash_random(self.seed, k, 5) < 0.5:
+            t += 0.2
+            for i in range(1 + int(hash_random(self.seed, k, 6) * 5)):
+                t += 0.03
+                flashes.append((t, t + 0.05))
+                t += 0.05
+        return flashes
+
+    def render(self, canvas, t):
+        pixels = canvas.pixel_buffer()
+
+        # set all to orange
+        pixels[:] = color(0xFF, 0x33, 0x00)
+
+        # render the positions, seven pixels fading to red, half as much at the ends, later positions drawn on top
+        positions = self._positions.active(t)
+        if positions:
+            fraction = numpy.abs(t - numpy.array([position["starttime"] for position in positions]) - 1) ** 4
+            green = (0x33 * (fraction[:, None] * self.GLOW_SCALE + self.GLOW_OFFSET)).astype(numpy.uint32)
+            index = numpy.array([position["position"] for position in positions])[:, None] + numpy.arange(-3, 4)
+            inside = (index >= 0) & (index < self.num_pixels)
+            pixels[index[inside]] = (green[inside] << 16) | color(0xFF, 0, 0)
+
+        # random thunderflash, lit during a flash and dark between flashes of a sequence
+        flashes = [flash for flash in self._thunder.active(t) if flash[1] > t]
+        if flashes and t >= flashes[0][0] - 0.08:
+            lit = t >= flashes[0][0]
+            pixels[0:self._flashed:2] = color(255, 255, 255) if lit else color(0, 0, 0)
+            pixels[1:self._flashed:2] = color(0, 0, 0)
+
+
+# red, white and blue (for VE day), designed for a strip of 50 LEDs and scaled to the strip
+@register_effect("RedWhiteBlueVEDay", 5)
+class RedWhiteBlueVEDay(Effect):
+    REFERENCE_PIXELS = 50
+
+    def __init__(self, step, num_pixels):
+        super().__init__(step, num_pixels)
+        design = {}
+        for i in range(8):
+            for j, colour in enumerate((color(255, 0, 0), color(255, 255, 255), color(0, 0, 255))):
+                design[i * 6 + j * 2 + 1] = colour
+                design[i * 6 + j * 2 + 2] = colour
+        self._pixels, self._colours = map_design(design, self.REFERENCE_PIXELS, num_pixels)
+
+    def render(self, canvas, t):
+        canvas.pixel_buffer()[self._pixels] = self._colours
+
+
+# blackout
+@register_effect("OFF", 0)
+class Off(Effect):
+
+    def render(self, canvas, t):
+        numpy.copyto(canvas.pixel_buffer(), 0)
+
+
+# playback of a pre-baked animation file, see animation.py
+@register_effect("Playback")
+class Playback(Effect):
+
+    def __init__(self, step, num_pixels):
+        super().__init__(step, num_pixels)
+        self._animation = Animation(step["file"])
+        self._cycle = step.get("cycle", True)  # repeat animation, otherwise hold the last frame
+
+        # the animation's pixel at the same position along the strip as each pixel, so it fills a strip of any length
+        self._reference = reference_index(num_pixels, self._animation.num_pixels)
+        self.frame_interval = 1 / self._animation.fps
+        self.seek(0)
+
+    @classmethod
+    def validate(cls, step):
+        if not isinstance(step.get("file"), str) or not step["file"]:
+            raise ValueError(f"Playback step needs an animation file: {step}")
+        try:
+            Animation(step["file"]).close()
+        except (OSError, ValueError, struct.error) as exc:
+            raise ValueError(f"unable to open animation {step['file']}: {exc}")
+        if not isinstance(step.get("cycle", True), bool):
+            raise ValueError(f"cycle must be true or false: {step}")
+
+    def seek(self, k: int):
+        """Decode frame k ahead of rendering it
+
+        :param k: frame number
+        :return:
+        """
+        count = self._animation.frame_count
+        self._animation.seek(k % count if self._cycle else min(k, count - 1))
+
+    def render(self, canvas, t):
+        self.seek(int(t * self._animation.fps))
+        numpy.take(self._animation.frame, self._reference, out=canvas.pixel_buffer())
+
+    def close(self):
+        self._animation.close()
+
+
+# colour defined by per-pixel expressions of position and time, see expressions.py
+@register_effect("Expression")
+class Expression(Effect):
+
+    def __init__(self, step, num_pixels):
+        super().__init__(step, num_pixels)
+        self._renderer = ExpressionRenderer(step, num_pixels)
+        self.frame_interval = 1 / step.get("fps", 50)
+
+    @classmethod
+    def validate(cls, step):
+        ExpressionRenderer.validate(step)
+        fps = step.get("fps", 50)
+        if isinstance(fps, bool) or not isinstance(fps, (int, float)) or fps <= 0:
+            raise ValueError(f"fps must be a positive number: {step}")
+
+    def render(self, canvas, t):
+        numpy.copyto(canvas.pixel_buffer(), self._renderer.render(t))
+
+
+# music reactive level bars, one strip segment per frequency band, flashing on beats, see audio.py
+@register_effect("MusicSync")
+class MusicSync(Effect):
+
+    def __init__(self, step, num_pixels):
+        super().__init__(step, num_pixels)
+        self.analyser = AudioAnalyser(file=step.get("file"), pipe=step.get("pipe"), rate=step.get("rate", 44100),
+                                      channels=step.get("channels", 2), window=step.get("window", 1024),
+                                      bands=step.get("bands", 8))
+        self.frame_interval = 1 / step.get("fps", 50)
+
+        # segment (band) of each pixel and position within it, so bars fill from the start of each segment
+        scaled = numpy.arange(num_pixels) * self.analyser.bands / num_pixels
+        self._segment = scaled.astype(numpy.int64)
+        self._position = scaled - self._segment
+        self._hue = self._segment / self.analyser.bands
+        self._flash = 0.0
+        self._out = numpy.zeros(num_pixels, dtype=numpy.uint32)
+        self.lookahead = False
+
+    @classmethod
+    def validate(cls, step):
+        if not step.get("file") and not step.get("pipe"):
+            raise ValueError(f"MusicSync step needs a WAV file or a PCM pipe: {step}")
+        for key in ("bands", "channels", "rate", "window"):
+            value = step.get(key, 1)
+            if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+                raise ValueError(f"{key} must be a positive integer: {step}")
+        fps = step.get("fps", 50)
+        if isinstance(fps, bool) or not isinstance(fps, (int, float)) or fps <= 0:
+            raise ValueError(f"fps must be a positive number: {step}")
+
+    def render(self, canvas, t):
+        self.analyser.read(t)
+        self.analyser.analyse(t)
+        self._flash = 1.0 if self.analyser.beat else self._flash * 0.85
+
+        level = self.analyser.energies[self._segment]
+        value = numpy.where(self._position < level, 0.2 + 0.8 * level, 0.0)
+        hsv_to_colors(self._hue, 1.0 - self._flash, numpy.maximum(value, self._flash * 0.6), self._out)
+        numpy.copyto(canvas.pixel_buffer(), self._out)
+
+    def close(self):
+        self.analyser.close()
+
+
+# frames streamed over UDP by an external renderer, ending after a timeout without frames, see udpstream.py
+@register_effect("Stream")
+class Stream(Effect):
+    frame_interval = 0  # show frames as they arrive
+    lookahead = False
+    poll = 0.02  # longest wait for a frame, so the render thread still responds to new programs
+
+    def __init__(self, step, num_pixels):
+        super().__init__(step, num_pixels)
+        self._receiver = StreamReceiver(num_pixels, port=step.get("port"), protocol=step.get("protocol", "native"),
+                                        universe=step.get("universe", 1))
+        self._timeout = step.get("timeout", 10)
+        LOGGER.info("Streaming %s on UDP port %d", self._receiver.protocol, self._receiver.port)
+
+    @classmethod
+    def validate(cls, step):
+        if step.get("protocol", "native") not in PROTOCOLS:
+            raise ValueError(f"protocol must be one of {', '.join(PROTOCOLS)}: {step}")
+        port = step.get("port", 1)
+        if isinstance(port, bool) or not isinstance(port, int) or not 0 < port < 65536:
+            raise ValueError(f"port must be a UDP port number: {step}")
+        universe = step.get("universe", 1)
+        if isinstance(universe, bool) or not isinstance(universe, int) or not 0 < universe < 64000:
+            raise ValueError(f"universe must be an E1.31 universe number: {step}")
+        timeout = step.get("timeout", 10)
+        if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+            raise ValueError(f"timeout must be a positive number of seconds: {step}")
+
+    def render(self, canvas, t):
+        changed = self._receiver.receive(canvas.pixel_buffer(), self.poll)
+        last = self._receiver.last_frame_time or self._receiver.opened
+        if self._receiver.terminated or time.time() - last > self._timeout:
+            LOGGER.info("Stream ended (%s): %s", "terminated" if self._receiver.terminated else "timed out",
+                        self._receiver.stats)
+            self.finished = True
+        return changed
+
+    def close(self):
+        self._receiver.close()
+
+
 class LightEffect(threading.Thread):
-    """Thread object constructed to run a specific effect on a specific PixelStrip
+    """Render thread running effects and programs on a specific PixelStrip
+
+    The thread runs for the life of the controller; play() switches it to a new program at the next frame,
+    clearing the strip in between. Each program is run as a timeline: every step lasts for its duration (or
+    until replaced if it has none), the next step starts exactly when the previous one ends, and the effect for
+    the next step is constructed, so prepared, while the current step is still running.
 
+    Frames are rendered on a grid of frame intervals counted from the program start, for the time of the grid
+    point, so devices given the same start time and seed, with clocks corrected to a shared time base, render
+    the same frame at the same instant. Frames are rendered up to lookahead frames ahead of their grid time and
+    shown at it by the display thread of a FramePipeline, see pipeline.py.
     """
 
-    def __init__(self, strip: LockingPixelStrip, effect: int = 1, program=None):
+    def __init__(self, strip: LockingPixelStrip, effect: int = 1, program=None, governor: ThermalGovernor = None,
+                 programs: dict = None, clock=time.time, start: float = None, seed: int = 0, lookahead: int = 2):
         """Initialise thread with strip object for LED strip
 
         :param strip: PixelStrip to apply the effect to
         :param effect: effect to initiate
+        :param program: list of steps to run instead of a single effect
+        :param governor: optional ThermalGovernor limiting frame rate and effect detail
+        :param programs: dictionary of named programs, for sub-program steps
+        :param clock: function returning the time, e.g. ClockSync.time for a time base shared by devices
+        :param start: time the first program starts, defaults to when it is picked up
+        :param seed: seed for the first program's random choices
+        :param lookahead: frames rendered ahead of the one being shown, 0 to render and show on this thread
         """
 
-        threading.Thread.__init__(self)  # call parent constructor
+        threading.Thread.__init__(self, daemon=True)  # call parent constructor
         self._shutdown_event = threading.Event()  # set event flag to terminate thread
+        self._wake = threading.Event()  # set to wake the thread early, on stop or a new program
         self._strip = strip  # set to rpi_ws281x.PixelStrip object for LED strip to control
-        if program:
-            self._program = program
-        else:
-            self._program = [{"effect": effect}]
+        self._governor = governor
+        self._programs = programs
+        self._pending_lock = threading.Lock()
+        self._pending = None
+        self._clock = clock
+        self.on_trace = None  # called with a "traced" event once a command's first frame is shown, on any thread
+        self._pipeline = FramePipeline(strip, lookahead, clock, on_shown=self._traced)
+        self.play(program, effect, start, seed)
+
+    def play(self, program=None, effect: int = 1, start: float = None, seed: int = 0, trace: CommandTrace = None):
+        """Switch to a new program at the next frame, may be called from any thread
+
+        :param program: list of steps to run
+        :param effect: effect to run if no program is given
+        :param start: time the program starts by the clock, defaults to when it is picked up; in the future to
+                      wait for it, in the past to join it in progress
+        :param seed: seed for the program's random choices
+        :param trace: optional trace of the command, stamped as the program reaches the strip
+        :return:
+        """
+        with self._pending_lock:
+            self._pending = (program if program else [{"effect": effect}], start, seed, trace)
+            self._wake.set()
+        self._pipeline.interrupt()
+
+    @property
+    def late_frames(self) -> int:
+        """Number of frames shown more than 1 ms after their grid time"""
+        return self._pipeline.late
+
+    @property
+    def dropped_frames(self) -> int:
+        """Number of frames rendered but dropped to get back on time"""
+        return self._pipeline.dropped
+
+    def _take_pending(self):
+        """Return and clear the (program, start, seed, trace) waiting to be played, or None
+
+        :return:
+        """
+        with self._pending_lock:
+            program, self._pending = self._pending, None
+            self._wake.clear()
+            return program
+
+    def _interrupted(self) -> bool:
+        """Return True if the running program should end, because the thread is stopping or has a new program
+
+        :return:
+        """
+        return self._shutdown_event.is_set() or self._pending is not None
+
+    def _detail(self) -> float:
+        """Return effect detail factor (0-1) allowed by the thermal governor
+
+        :return:
+        """
+        return self._governor.detail if self._governor else 1.0
+
+    def _frame_interval(self, effect: Effect) -> float:
+        """Return time until the next frame of effect is due, stretched to the governor's frame interval
+
+        :param effect: effect being rendered
+        :return:
+        """
+        if self._governor:
+            return max(effect.frame_interval, self._governor.frame_interval)
+        return effect.frame_interval
+
+    def _traced(self, trace: CommandTrace):
+        """Stamp a trace as shown and pass it on
+
+        :param trace: trace of the command whose first frame has just been shown
+        :return:
+        """
+        trace.mark("shown")
+        if self.on_trace:
+            self.on_trace({"traced": trace})
+
+    def _run_step(self, effect: Effect, start: float, end: float, prepare, trace: CommandTrace = None):
+        """Render frames of an effect from start time until end time or until stopped
+
+        Frames are rendered ahead of their time as far as the pipeline allows, unless the effect is driven by an
+        outside source, and the step returns once its last frame is rendered, closing the effect.
+
+        :param effect: prepared effect for this step
+        :param start: time the step starts
+        :param end: time the step ends, or None to run until stopped
+        :param prepare: function called once after the first frame to prepare the next step's effect
+        :param trace: optional trace of the command that started the program, passed on after the first frame
+        :return:
+        """
+        try:
+            ahead = effect.lookahead and self._pipeline.depth > 0
+            next_frame = start
+            while not self._interrupted() and not effect.finished:
+                now = self._clock()
+                due = next_frame is not None and (now >= next_frame or ahead)
+                if end is not None and (now >= end or (due and next_frame >= end)):
+                    return
+
+                if due:
+                    interval = self._frame_interval(effect) if effect.frame_interval is not None else None
+                    if now < next_frame:
+                        frame_time = next_frame
+                    elif interval:
+                        # latest point on the frame grid, allowing for rounding when woken exactly on it
+                        frame_time = start + math.floor((now - start) / interval + 1e-6) * interval
+                    else:
+                        frame_time = now
+                    canvas = self._pipeline.canvas(self._interrupted)
+                    if canvas is None:
+                        return
+                    effect.detail = self._detail()
+                    try:
+                        rendered = effect.render(canvas, frame_time - start)
+                    except Exception as exc:
+                        # a failing effect must not end the render thread, so go dark for the rest of the step
+                        LOGGER.exception("Effect %s failed, dark for the rest of the step", effect.name)
+                        if self._strip.recorder:
+                            self._strip.recorder.record_event("error", time.time(), effect=effect.name, error=str(exc))
+                        close_effect(effect)
+                        effect = Off(effect.step, effect.num_pixels)
+                        rendered = effect.render(canvas, frame_time - start)
+                        interval = None
+                    if rendered is not False:
+                        self._pipeline.submit(canvas, frame_time, trace, self._interrupted)
+                        trace = None
+                    else:
+                        self._pipeline.release(canvas)
+                    if prepare:
+                        prepare()
+                        prepare = None
+                    next_frame = frame_time + interval if interval is not None else None
+                    if ahead and next_frame is not None:
+                        continue
+
+                # wait for the next frame or the end of the step, whichever is sooner
+                wake = min((w for w in (next_frame, end) if w is not None), default=None)
+                self._wake.wait(None if wake is None else max(wake - self._clock(), 0))
+        finally:
+            close_effect(effect)
 
     def run(self):
-        """Run light effect selected by effect number passed to constructor
+        """Run programs passed to the constructor and play() until stopped
 
         :return:
         """
 
         with self._strip.lock:
-
-            # record program and initialise step_num instance variables, can be accessed outside the class
-            self._strip.program = self._program
-            self._strip.step_num = 0
-
-            # iterate over the steps in the program
-            for step in self._program:
-
-                # record step and effect, can be accessed outside the class
-                self._strip.step = step
-                self._strip.effect = step.get("effect")
-                start_time: float = time.time()
-
-                # UK emergency blue light effect
-                if step.get("effect") == 1 or step.get("effect") == "EmergencyBlueLight":
-                    while (not self._shutdown_event.is_set()) and (
-                            time.time() < start_time + step.get("duration", 86400)):
-                        curr_time = time.time() * 2
-                        for i in range(self._strip.numPixels()):
-                            if int(curr_time % 2) > 0:
-                                if i < (self._strip.numPixels() // 2):
-                                    if (int(curr_time * 10) % 2) > 0:
-                                        self._strip.setPixelColor(i, color(0, 0, 255))
-                                    else:
-                                        self._strip.setPixelColor(i, color(0, 0, 0))
-                                else:
-                                    self._strip.setPixelColor(i, color(0, 0, 0))
-                            else:
-                                if i < (self._strip.numPixels() // 2):
-                                    self._strip.setPixelColor(i, color(0, 0, 0))
-                                else:
-                                    if (int(curr_time * 10) % 2) > 0:
-                                        self._strip.setPixelColor(i, color(0, 0, 255))
-                                    else:
-                                        self._strip.setPixelColor(i, color(0, 0, 0))
-                        self._strip.show()
-                        time.sleep(0.01)
-
-                # Static rainbow effect (requires LED strip of 50 LEDs)
-                elif step.get("effect") == 2 or step.get("effect") == "RainbowStatic":
-                    rainbow = [color(255, 0, 0),
-                               color(255, 127, 0),
-                               color(255, 255, 0),
-                               color(0, 255, 0),
-                               color(0, 0, 255),
-                               color(46, 43, 95),
-                               color(139, 0, 255)]
-                    length = len(rainbow)
-                    for i in range(length):
-                        self._strip.setPixelColor(4 + (i * 3), rainbow[i])
-                        self._strip.setPixelColor(5 + (i * 3), rainbow[i])
-                        self._strip.setPixelColor(6 + (i * 3), rainbow[i])
-                        self._strip.setPixelColor(22 + ((length - i) * 3), rainbow[i])
-                        self._strip.setPixelColor(23 + ((length - i) * 3), rainbow[i])
-                        self._strip.setPixelColor(24 + ((length - i) * 3), rainbow[i])
-
-                    self._strip.show()
-
-                # rainbow_cycle effect
-                elif step.get("effect") == 3 or step.get("effect") == "RainbowCycle":
-
-                    wait_ms: int = 20
-
-                    while (not self._shutdown_event.is_set()) and (
-                            time.time() < start_time + step.get("duration", 86400)):
-                        for j in range(256):
-                            for i in range(self._strip.numPixels()):
-                                self._strip.setPixelColor(i, wheel(
-                                    (int(i * 256 / self._strip.numPixels()) + j) & 255))
-                            self._strip.show()
-                            time.sleep(wait_ms / 1000.0)
-
-                # landing strip effect
-                elif step.get("effect") == 4 or step.get("effect") == "LandingStrip":
-
-                    while (not self._shutdown_event.is_set()) and (
-                            time.time() < start_time + step.get("duration", 86400)):
-                        for i in range(self._strip.numPixels()):
-                            self._strip.setPixelColor(i, color(200, 200, 200))
-                        self._strip.show()
-                        time.sleep(0.05)
-                        for i in range(self._strip.numPixels()):
-                            if (i % 2) == 0:
-                                self._strip.setPixelColor(i, color(0, 0, 0))
-                        self._strip.show()
-                        time.sleep(0.95)
-
-                # test pattern - in blocks of 5 lights
-                elif step.get("effect") == "TestPattern":
-
-                    while not self._shutdown_event.is_set():
-                        for i in range(self._strip.numPixels()):
-                            block = i // 5
-                            if block % 2 == 0:
-                                self._strip.setPixelColor(i, color(0, 0, 255))
-                            else:
-                                self._strip.setPixelColor(i, color(255, 0, 255))
-                        self._strip.show()
-
-
-                elif step.get("effect") == "Christmas1":
-
-                    twinkle_colours = [
-                        color(255, 0, 0),
-                        color(0, 0, 255),
-                        color(255, 255, 0),
-                        color(0, 255, 255),
-                        color(255, 0, 127)
-                    ]
-
-                    effects = {"snowing": [], "twinkles": []}
-                    tick = time.time()
-                    start_time = tick
-
-                    while (not self._shutdown_event.is_set()):
-
-                        # add a twinkle
-                        if time.time() > tick + 0.01:
-                            dice = random.randrange(1, 200)
-                            if dice >= 20 and dice <= 148:
-                                effects["snowing"].append({"starttime": time.time(), "blue": False,
-                                                           "position": random.choice(XMAS_PATTERNS["extended_base"])})
-                            elif dice >= 150 and dice <= 190:
-                                effects["snowing"].append({"starttime": time.time(), "blue": True,
-                                                           "position": random.choice(XMAS_PATTERNS["extended_base"])})
-                            elif dice >= 1 and dice <= 15:
-                                effects["twinkles"].append(
-                                    {"starttime": time.time(), "position": random.choice(XMAS_PATTERNS["branches"]),
-                                     "colour": random.choice(twinkle_colours)})
-                            tick = time.time()
-
-                        # trunk is static
-                        for i in XMAS_PATTERNS.get("trunk"):
-                            self._strip.setPixelColor(i, color(150, 75, 0))
-
-                        # base snowing effect
-                        for i in XMAS_PATTERNS.get("extended_base"):
-                            self._strip.setPixelColor(i, color(20, 20, 20))
-                        for effect in effects["snowing"]:
-                            brightness = int((1 - abs((time.time() - effect["starttime"]) * 2 - 1)) * (255 - 20) + 20)
-                            if brightness >= 20:
-                                if effect["blue"]:
-                                    self._strip.setPixelColor(effect["position"], color(20, brightness, brightness))
-                                else:
-                                    self._strip.setPixelColor(effect["position"],
-                                                              color(brightness, brightness, brightness))
-
-                        # star flashes yellow
-                        # star_colour = twinkle_colours[int(time.time() - start_time) % len(twinkle_colours)]
-                        star_colour_comp = int(abs((time.time() - start_time) % 2 - 1) * 255)
-                        for i in XMAS_PATTERNS.get("star"):
-                            self._strip.setPixelColor(i, color(star_colour_comp, star_colour_comp, 0))
-
-                        # christmas tree lights
-                        for i in XMAS_PATTERNS.get("branches"):
-                            self._strip.setPixelColor(i, color(0, 255, 0))
-                        for effect in effects["twinkles"]:
-                            self._strip.setPixelColor(effect["position"], effect["colour"])
-
-                        self._strip.show()
-
-                        if effects["snowing"] != [] and effects["snowing"][0]["starttime"] + 1 < time.time():
-                            effects["snowing"].pop(0)
-
-                        if effects["twinkles"] != [] and effects["twinkles"][0]["starttime"] + 1 < time.time():
-                            effects["twinkles"].pop(0)
-
-                elif step.get("effect") == "Christmas2":
-
-                    # add offset value to every item in the patterns lists
-
-                    twinkle_colours = [
-                        color(0, 0, 255),
-                        color(255, 0, 127)
-                    ]
-
-                    effects = {"snowing": [], "twinkles": []}
-                    tick = time.time()
-                    start_time = tick
-
-                    while (not self._shutdown_event.is_set()):
-
-                        # add a twinkle
-                        if time.time() > tick + 0.01:
-                            dice = random.randrange(1, 200)
-                            if dice >= 40 and dice <= 190:
-                                effects["snowing"].append({"starttime": time.time(),
-                                                           "position": random.choice(XMAS_PATTERNS["extended_base"])})
-                                effects["snowing"].append({"starttime": time.time(),
-                                                           "position": random.choice(XMAS_PATTERNS["extended_base"])})
-                            elif dice >= 1 and dice <= 30:
-                                effects["twinkles"].append(
-                                    {"starttime": time.time(), "position": random.choice(XMAS_PATTERNS["branches"]),
-                                     "colour": random.choice(twinkle_colours)})
-                            tick = time.time()
-
-                        # trunk is static
-                        for i in XMAS_PATTERNS.get("trunk"):
-                            self._strip.setPixelColor(i, color(150, 75, 0))
-
-                        # base red/green effect
-                        for i in XMAS_PATTERNS.get("extended_base"):
-                            if (i // 3) % 2 == 1:
-                                self._strip.setPixelColor(i, color(255, 0, 0))
-                            else:
-                                self._strip.setPixelColor(i, color(0, 255, 0))
-                        for effect in effects["snowing"]:
-                            brightness = int((1 - abs((time.time() - effect["starttime"]) * 2 - 1)) * 255)
-                            if 0 <= brightness <= 255:
-                                if (effect["position"] // 3) % 2 == 1:
-                                    self._strip.setPixelColor(effect["position"], color(255, brightness, 0))
-                                else:
-                                    self._strip.setPixelColor(effect["position"], color(brightness, 255, 0))
-
-                        # star flashes yellow
-                        # star_colour = twinkle_colours[int(time.time() - start_time) % len(twinkle_colours)]
-                        star_colour_comp = int(abs((time.time() * 2 - start_time * 2) % 2 - 1) * 255)
-                        for i in XMAS_PATTERNS.get("star"):
-                            self._strip.setPixelColor(i, color(star_colour_comp, star_colour_comp, 0))
-
-                        # christmas tree lights
-                        for i in XMAS_PATTERNS.get("branches"):
-                            self._strip.setPixelColor(i, color(0, 255, 0))
-                        for effect in effects["twinkles"]:
-                            self._strip.setPixelColor(effect["position"], effect["colour"])
-
-                        self._strip.show()
-
-                        while effects["snowing"] != [] and effects["snowing"][0]["starttime"] + 1 < time.time():
-                            effects["snowing"].pop(0)
-
-                        while effects["twinkles"] != [] and effects["twinkles"][0]["starttime"] + 1 < time.time():
-                            effects["twinkles"].pop(0)
-
-
-                elif step.get("effect") == "Halloween":
-                    positions = []
-                    tick = time.time()
-                    redoffsets = [0.85, 0.95, 1.0, 1.0, 1.0, 0.95, 0.85]
-                    while (not self._shutdown_event.is_set()):
-
-                        # set all to orange
-                        for i in range(self._strip.numPixels()):
-                            self._strip.setPixelColor(i, color(0xFF, 0x33, 0x00))
-
-                        # add a position (roll the dice!)
-                        if time.time() > tick + 0.1:
-                            if random.randrange(1, 10) == 1:
-                                positions.append({"starttime": time.time(), "position": random.randrange(5, 45)})
-
-                        # render the positions
-                        for position in positions:
-                            fraction = abs(time.time() - position["starttime"] - 1) ** 4
-                            self._strip.setPixelColor(position["position"] - 3,
-                                                      color(0xFF, int(0x33 * (fraction * 0.5 + 0.5)), 0))
-                            self._strip.setPixelColor(position["position"] - 2, color(0xFF, int(0x33 * fraction), 0))
-                            self._strip.setPixelColor(position["position"] - 1, color(0xFF, int(0x33 * fraction), 0))
-                            self._strip.setPixelColor(position["position"], color(0xFF, int(0x33 * fraction), 0))
-                            self._strip.setPixelColor(position["position"] + 1, color(0xFF, int(0x33 * fraction), 0))
-                            self._strip.setPixelColor(position["position"] + 2, color(0xFF, int(0x33 * fraction), 0))
-                            self._strip.setPixelColor(position["position"] + 3,
-                                                      color(0xFF, int(0x33 * (fraction * 0.5 + 0.5)), 0))
-
-                        # update the LED strip
-                        self._strip.show()
-
-                        # remove oldest position if older than 2 seconds
-                        if positions != []:
-                            if positions[0]["starttime"] + 2 < time.time():
-                                positions.pop(0)
-
-                        # random thunderflash
-                        if time.time() > tick + 0.1:
-                            if random.randrange(1, 400) == 1:
-                                time.sleep(0.5)
-                                for i in range(random.randrange(2, 8)):
-                                    for j in range(24):
-                                        self._strip.setPixelColor(j * 2, color(255, 255, 255))
-                                        self._strip.setPixelColor(j * 2 + 1, color(0, 0, 0))
-                                    self._strip.show()
-                                    time.sleep(0.05)
-                                    for j in range(24):
-                                        self._strip.setPixelColor(j * 2, color(0, 0, 0))
-                                    self._strip.show()
-                                    time.sleep(0.03)
-                                if random.randrange(1, 3) != 1:
-                                    time.sleep(0.2)
-                                    for i in range(random.randrange(1, 6)):
-                                        time.sleep(0.03)
-                                        for j in range(24):
-                                            self._strip.setPixelColor(j * 2, color(255, 255, 255))
-                                            self._strip.setPixelColor(j * 2 + 1, color(0, 0, 0))
-                                        self._strip.show()
-                                        time.sleep(0.05)
-                                        for j in range(24):
-                                            self._strip.setPixelColor(j * 2, color(0, 0, 0))
-                                        self._strip.show()
-
-                        # reset tick
-                        if time.time() > tick + 0.1:
-                            tick = time.time()
-
-                # red, white and blue (for VE day) - requires ledstrip of lengt 50
-                elif step.get("effect") == 5 or step.get("effect") == "RedWhiteBlueVEDay":
-
-                    for i in range(8):
-                        self._strip.setPixelColor(i * 6 + 1, color(255, 0, 0))
-                        self._strip.setPixelColor(i * 6 + 2, color(255, 0, 0))
-                        self._strip.setPixelColor(i * 6 + 3, color(255, 255, 255))
-                        self._strip.setPixelColor(i * 6 + 4, color(255, 255, 255))
-                        self._strip.setPixelColor(i * 6 + 5, color(0, 0, 255))
-                        self._strip.setPixelColor(i * 6 + 6, color(0, 0, 255))
-                    self._strip.show()
-
-                # blackout
-                elif step.get("effect") == 0 or step.get("effect") == "OFF":
-
-                    for i in range(self._strip.numPixels()):
-                        self._strip.setPixelColor(i, color(0, 0, 0))
-                    self._strip.show()
-
-                # increment step number
-                self._strip.step_num += 1
-
-            # after program complete, loop until terminate flag received
+            first = True
             while not self._shutdown_event.is_set():
-                pass
+                pending = self._take_pending()
+                if pending is None:
+                    self._wake.wait()
+                    continue
+                trace = pending[3]
+                if trace:
+                    trace.mark("picked_up")
+
+                # drop frames rendered ahead and clear lights left by the previous program
+                if not first:
+                    self._pipeline.clear()
+                    if trace:
+                        trace.mark("cleared")
+                first = False
+                self._run_program(*pending)
+
+            # go dark as soon as the current frame is finished, rather than waiting for the caller to join
+            self._pipeline.clear()
+            self._pipeline.close()
+
+    def _run_program(self, program: list, start: float = None, seed: int = 0, trace: CommandTrace = None):
+        """Run a program until it is interrupted
+
+        :param program: list of steps
+        :param start: time the program starts, defaults to now
+        :param seed: seed for the program's random choices
+        :param trace: optional trace of the command that started the program
+        :return:
+        """
+
+        # record program and initialise step_num instance variables, can be accessed outside the class
+        self._strip.program = program
+        self._strip.step_num = 0
+
+        # joining a program in progress: skip the steps already over without preparing their effects
+        start = self._clock() if start is None else start
+        position = {"seconds": max(self._clock() - start, 0.0)}
+        steps = timeline(program, self._programs, skip=position)
+        step = next(steps, None)
+        start += position["skipped"]
+        self._strip.step_num = position["steps"]
+
+        effect = create_effect(step, self._strip.numPixels(), seed) if step else None
+        if trace:
+            trace.mark("prepared")
+
+        # iterate over the steps in the program
+        upcoming = {}
+        while step is not None and not self._interrupted():
+
+            # record step and effect, can be accessed outside the class
+            self._strip.step = step
+            self._strip.effect = step.get("effect")
+            if self._strip.recorder:
+                self._strip.recorder.record_event("step", time.time(), step_num=self._strip.step_num, step=step)
+            duration = step.get("duration")
+            end = start + duration if duration is not None else None
+
+            # look ahead to the next step and prepare its effect while this one runs
+            upcoming = {}
+
+            def prepare():
+                upcoming["step"] = next(steps, None)
+                if upcoming["step"] is not None:
+                    upcoming["effect"] = create_effect(upcoming["step"], self._strip.numPixels(), seed)
+
+            self._run_step(effect, start, end, prepare if end is not None else None, trace)
+            trace = None
+            finished, effect = effect.finished, None  # closed by _run_step
+            if self._interrupted() or (end is None and not finished):
+                break
+
+            # next step starts exactly when this one was scheduled to end, or now if the effect finished early
+            if "step" not in upcoming:
+                prepare()
+            step, effect = upcoming["step"], upcoming.pop("effect", None)
+            start = end if end is not None else self._clock()
+
+            # increment step number
+            self._strip.step_num += 1
+
+        # close effects prepared for steps that never started
+        for unused in (effect, upcoming.get("effect")):
+            if unused is not None:
+                close_effect(unused)
+
+        # after program complete, wait until interrupted
+        while not self._interrupted():
+            self._wake.wait()
 
     def stop(self):
-        """Set stop flag for thread
+        """Set stop flag for thread, the strip is cleared once the frame being rendered is finished
+
+        Every wait in the thread is on the wake event or woken by the pipeline, so the thread ends within one
+        frame of being stopped.
 
         :return:
         """
 
         self._shutdown_event.set()
+        self._wake.set()
+        self._pipeline.interrupt()
 
 
 # TODO reimplement theater_chase within run as an effect
-def theater_chase(strip: PixelStrip, color: color, wait_ms: int = 50, iterations: int = 10):
+def theater_chase(strip: PixelStrip, color: color, wait_ms: int = 50, iterations: int = 10,
+                  stop_event: threading.Event = None):
     """Movie theater light style chaser animation.
 
     :param strip:
     :param color:
     :param wait_ms:
+    :param stop_event: optional event which ends the animation at the next frame
     :param iterations:
     :return:
     """
@@ -483,7 +1078,8 @@ def theater_chase(strip: PixelStrip, color: color, wait_ms: int = 50, iterations
             for i in range(0, strip.numPixels(), 3):
                 strip.setPixelColor(i + q, color)
             strip.show()
-            time.sleep(wait_ms / 1000.0)
+            if _pause(wait_ms, stop_event):
+                return
             for i in range(0, strip.numPixels(), 3):
                 strip.setPixelColor(i + q, 0)
 
@@ -504,11 +1100,12 @@ def wheel(pos: int):
 
 
 # TODO reimplement rainbow within run as an effect
-def rainbow(strip: PixelStrip, wait_ms: int = 20, iterations: int = 1):
+def rainbow(strip: PixelStrip, wait_ms: int = 20, iterations: int = 1, stop_event: threading.Event = None):
     """Draw rainbow that fades across all pixels at once.
 
     :param strip:
     :param wait_ms:
+    :param stop_event: optional event which ends the animation at the next frame
     :param iterations:
     :return:
     """
@@ -516,15 +1113,17 @@ def rainbow(strip: PixelStrip, wait_ms: int = 20, iterations: int = 1):
         for i in range(strip.numPixels()):
             strip.setPixelColor(i, wheel((i + j) & 255))
         strip.show()
-        time.sleep(wait_ms / 1000.0)
+        if _pause(wait_ms, stop_event):
+            return
 
 
 # TODO reimplement rainbow_cycle within run as an effect
-def rainbow_cycle(strip: PixelStrip, wait_ms: int = 20, iterations: int = 5):
+def rainbow_cycle(strip: PixelStrip, wait_ms: int = 20, iterations: int = 5, stop_event: threading.Event = None):
     """Draw rainbow that uniformly distributes itself across all pixels.
 
     :param strip:
     :param wait_ms:
+    :param stop_event: optional event which ends the animation at the next frame
     :param iterations:
     :return:
     """
@@ -533,15 +1132,17 @@ def rainbow_cycle(strip: PixelStrip, wait_ms: int = 20, iterations: int = 5):
             strip.setPixelColor(i, wheel(
                 (int(i * 256 / strip.numPixels()) + j) & 255))
         strip.show()
-        time.sleep(wait_ms / 1000.0)
+        if _pause(wait_ms, stop_event):
+            return
 
 
 # TODO reimplement theater_chase_rainbow within run as an effect
-def theater_chase_rainbow(strip: PixelStrip, wait_ms: int = 50):
+def theater_chase_rainbow(strip: PixelStrip, wait_ms: int = 50, stop_event: threading.Event = None):
     """Rainbow movie theater light style chaser animation.
 
     :param strip:
     :param wait_ms:
+    :param stop_event: optional event which ends the animation at the next frame
     :return:
     """
     for j in range(256):
@@ -549,6 +1150,7 @@ def theater_chase_rainbow(strip: PixelStrip, wait_ms: int = 50):
             for i in range(0, strip.numPixels(), 3):
                 strip.setPixelColor(i + q, wheel((i + j) % 255))
             strip.show()
-            time.sleep(wait_ms / 1000.0)
+            if _pause(wait_ms, stop_event):
+                return
             for i in range(0, strip.numPixels(), 3):
                 strip.setPixelColor(i + q, 0)
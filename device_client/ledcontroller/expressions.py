@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""Per-pixel colour expressions compiled to vectorized numpy evaluators
+
+expressions.py
+
+by Darren Dunford
+
+Expressions are written in a small subset of Python expression syntax, for example
+
+    hue: (i/N + t*0.1) % 1
+
+and are evaluated once per frame over numpy arrays holding every pixel, never pixel by pixel. Variables:
+
+    i   pixel index              N   number of pixels
+    x   position along strip 0-1 t   time in seconds since the step started
+    s   segment index            S   number of segments
+    u   position within segment 0-1
+
+Functions: sin, cos, tan, abs, floor, ceil, sqrt, exp, log, min, max, clip(v, lo, hi), frac(v) (fractional part),
+tri(v) (triangle wave 0-1-0 over each unit), rand(v) (repeatable pseudo-random 0-1 from v). Constants pi and e.
+Comparisons give 1 or 0, and "a if condition else b" is supported.
+"""
+
+import ast
+import functools
+import logging
+
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+VARIABLES = {"i", "N", "x", "t", "s", "S", "u"}
+
+FUNCTIONS = {
+    "sin": numpy.sin,
+    "cos": numpy.cos,
+    "tan": numpy.tan,
+    "abs": numpy.abs,
+    "floor": numpy.floor,
+    "ceil": numpy.ceil,
+    "sqrt": lambda v: numpy.sqrt(numpy.maximum(v, 0)),
+    "exp": numpy.exp,
+    "log": lambda v: numpy.log(numpy.maximum(v, 1e-9)),
+    "min": numpy.minimum,
+    "max": numpy.maximum,
+    "clip": numpy.clip,
+    "frac": lambda v: numpy.mod(v, 1.0),
+    "tri": lambda v: 1.0 - numpy.abs(numpy.mod(v, 1.0) * 2.0 - 1.0),
+    "rand": lambda v: numpy.mod(numpy.sin(numpy.multiply(v, 12.9898)) * 43758.5453, 1.0),
+}
+
+# number of arguments each function takes
+ARITY = {name: 1 for name in FUNCTIONS}
+ARITY.update({"min": 2, "max": 2, "clip": 3})
+
+CONSTANTS = {"pi": numpy.pi, "e": numpy.e}
+
+_BINARY_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+_UNARY_OPERATORS = (ast.UAdd, ast.USub)
+_COMPARISONS = (ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+
+# helpers inserted in to the compiled expression, not available to expression authors
+_HELPERS = {
+    "_number": lambda v: numpy.asarray(v, dtype=numpy.float64) if numpy.ndim(v) else float(v),
+    "_where": numpy.where,
+}
+
+
+class _Validator(ast.NodeVisitor):
+    """Rejects any syntax outside the supported subset"""
+
+    def generic_visit(self, node):
+        raise ValueError(f"unsupported syntax: {type(node).__name__}")
+
+    def visit_Expression(self, node):
+        self.visit(node.body)
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise ValueError(f"unsupported constant: {node.value!r}")
+
+    # Python 3.7 parses numbers as Num and True, False and None as NameConstant rather than Constant
+    def visit_Num(self, node):
+        if not isinstance(node.n, (int, float)):
+            raise ValueError(f"unsupported constant: {node.n!r}")
+
+    def visit_NameConstant(self, node):
+        raise ValueError(f"unsupported constant: {node.value!r}")
+
+    def visit_Name(self, node):
+        if node.id not in VARIABLES and node.id not in CONSTANTS:
+            raise ValueError(f"unknown name: {node.id}")
+
+    def visit_BinOp(self, node):
+        if not isinstance(node.op, _BINARY_OPERATORS):
+            raise ValueError(f"unsupported operator: {type(node.op).__name__}")
+        self.visit(node.left)
+        self.visit(node.right)
+
+    def visit_UnaryOp(self, node):
+        if not isinstance(node.op, _UNARY_OPERATORS):
+            raise ValueError(f"unsupported operator: {type(node.op).__name__}")
+        self.visit(node.operand)
+
+    def visit_Compare(self, node):
+        if len(node.ops) != 1 or not isinstance(node.ops[0], _COMPARISONS):
+            raise ValueError("only single comparisons (a < b) are supported")
+        self.visit(node.left)
+        self.visit(node.comparators[0])
+
+    def visit_IfExp(self, node):
+        self.visit(node.test)
+        self.visit(node.body)
+        self.visit(node.orelse)
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS:
+            raise ValueError("unknown function: " + (node.func.id if isinstance(node.func, ast.Name) else "?"))
+        if node.keywords:
+            raise ValueError("keyword arguments are not supported")
+        if len(node.args) != ARITY[node.func.id]:
+            raise ValueError(f"{node.func.id}() takes {ARITY[node.func.id]} argument(s), not {len(node.args)}")
+        for arg in node.args:
+            self.visit(arg)
+
+
+class _Vectorizer(ast.NodeTransformer):
+    """Rewrites comparisons and conditionals so they evaluate element-wise over numpy arrays, and makes every
+    constant a float, so integer arithmetic such as 9**9**9 cannot run unbounded"""
+
+    def visit_Constant(self, node):
+        return ast.copy_location(ast.Constant(value=float(node.value)), node)
+
+    def visit_Num(self, node):
+        return ast.copy_location(ast.Constant(value=float(node.n)), node)
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        return ast.Call(func=ast.Name(id="_number", ctx=ast.Load()), args=[node], keywords=[])
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return ast.Call(func=ast.Name(id="_where", ctx=ast.Load()), args=[node.test, node.body, node.orelse],
+                        keywords=[])
+
+
+def compile_expression(source: str):
+    """Parse, validate and compile an expression, raising ValueError if it is invalid
+
+    Compiled expressions are cached, so validating a program at load time also compiles it.
+
+    :param source: expression source text, or a number
+    :return: function taking a dictionary of variables and returning the value (scalar or numpy array)
+    """
+    if isinstance(source, bool) or not isinstance(source, (str, int, float)):
+        raise ValueError(f"expression must be text or a number: {source!r}")
+    return _compile(str(source))
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(source: str):
+    """Parse, validate and compile an expression, cached by compile_expression
+
+    :param source: expression source text
+    :return: function taking a dictionary of variables and returning the value (scalar or numpy array)
+    """
+    try:
+        tree = ast.parse(source.strip(), mode="eval")
+    except SyntaxError as exc:
+        raise ValueError(f"invalid expression {source!r}: {exc.msg}")
+    try:
+        _Validator().visit(tree)
+    except ValueError as exc:
+        raise ValueError(f"invalid expression {source!r}: {exc}")
+
+    tree = ast.fix_missing_locations(_Vectorizer().visit(tree))
+    code = compile(tree, "<expression>", "eval")
+    namespace = {"__builtins__": {}, **FUNCTIONS, **CONSTANTS, **_HELPERS}
+
+    def evaluate(variables: dict):
+        return eval(code, namespace, variables)
+
+    return evaluate
+
+
+def hsv_to_colors(hue: numpy.ndarray, saturation: numpy.ndarray, value: numpy.ndarray, out: numpy.ndarray):
+    """Convert arrays of hue, saturation and value (0-1) to 24-bit colour values, as produced by effects.color()
+
+    :param hue: hue 0-1, wrapped
+    :param saturation: saturation 0-1, clipped
+    :param value: value (brightness) 0-1, clipped
+    :param out: numpy uint32 array to write colour values to
+    :return:
+    """
+    h = numpy.mod(hue, 1.0) * 6.0
+    s = numpy.clip(saturation, 0.0, 1.0)
+    v = numpy.clip(value, 0.0, 1.0) * 255.0
+    sector = h.astype(numpy.int64) % 6
+    f = h - numpy.floor(h)
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    r = v * (1.0 - s * (1.0 - f))
+    red = numpy.choose(sector, (v, q, p, p, r, v))
+    green = numpy.choose(sector, (r, v, v, q, p, p))
+    blue = numpy.choose(sector, (p, p, r, v, v, q))
+    rgb_to_colors(red / 255.0, green / 255.0, blue / 255.0, out)
+
+
+def rgb_to_colors(red: numpy.ndarray, green: numpy.ndarray, blue: numpy.ndarray, out: numpy.ndarray):
+    """Convert arrays of red, green and blue (0-1) to 24-bit colour values, as produced by effects.color()
+
+    :param red: red component 0-1, clipped
+    :param green: green component 0-1, clipped
+    :param blue: blue component 0-1, clipped
+    :param out: numpy uint32 array to write colour values to
+    :return:
+    """
+    def channel(component):
+        return (numpy.clip(component, 0.0, 1.0) * 255.0 + 0.5).astype(numpy.uint32)
+
+    numpy.copyto(out, channel(green) << 16)
+    out |= channel(red) << 8
+    out |= channel(blue)
+
+
+def pixel_variables(num_pixels: int, segments: int = 1) -> dict:
+    """Return the variables of an expression for every pixel of a strip, with t 0
+
+    :param num_pixels: number of pixels
+    :param segments: number of segments the strip is divided in to
+    :return: dictionary of variable name to numpy array or scalar
+    """
+    index = numpy.arange(num_pixels, dtype=numpy.float64)
+    segment_length = num_pixels / segments
+    segment = numpy.floor(index / segment_length)
+    return {
+        "i": index,
+        "N": numpy.float64(num_pixels),
+        "x": index / num_pixels,
+        "s": segment,
+        "S": numpy.float64(segments),
+        "u": (index - segment * segment_length) / segment_length,
+        "t": numpy.float64(0.0),
+    }
+
+
+class ExpressionRenderer:
+    """Evaluates the colour expressions of a program step over all pixels of a frame"""
+
+    HSV = ("hue", "saturation", "value")
+    RGB = ("red", "green", "blue")
+    TRIAL_PIXELS = 16  # pixels and times each expression is evaluated over when validated
+    TRIAL_TIMES = (0.0, 0.5, 60.0, 86400.0)
+
+    def __init__(self, step: dict, num_pixels: int):
+        """Compile expressions and precompute per-pixel variables
+
+        :param step: program step holding hue/saturation/value or red/green/blue expressions
+        :param num_pixels: number of pixels to evaluate
+        """
+        self.validate(step)
+        self._model = self.RGB if any(key in step for key in self.RGB) else self.HSV
+        defaults = {"saturation": "1", "value": "1", "red": "0", "green": "0", "blue": "0"}
+        self._evaluators = [compile_expression(step.get(key, defaults.get(key))) for key in self._model]
+
+        self._variables = pixel_variables(num_pixels, int(step.get("segments", 1)))
+        self._out = numpy.zeros(num_pixels, dtype=numpy.uint32)
+
+    @classmethod
+    def validate(cls, step: dict):
+        """Check the expressions of a step, raising ValueError if invalid
+
+        :param step: program step dictionary
+        :return:
+        """
+        hsv = [key for key in cls.HSV if key in step]
+        rgb = [key for key in cls.RGB if key in step]
+        if hsv and rgb:
+            raise ValueError("use either hue/saturation/value or red/green/blue expressions, not both")
+        if not hsv and not rgb:
+            raise ValueError("expression step needs hue/saturation/value or red/green/blue expressions")
+        if "hue" not in step and hsv:
+            raise ValueError("expression step needs a hue expression")
+        segments = step.get("segments", 1)
+        if isinstance(segments, bool) or not isinstance(segments, int) or segments < 1:
+            raise ValueError("segments must be a positive integer")
+        variables = pixel_variables(cls.TRIAL_PIXELS, segments)
+        for key in hsv + rgb:
+            evaluator = compile_expression(step[key])
+            for t in cls.TRIAL_TIMES:
+                variables["t"] = numpy.float64(t)
+                try:
+                    with numpy.errstate(all="ignore"):
+                        numpy.broadcast_to(evaluator(variables), (cls.TRIAL_PIXELS,))
+                except Exception as exc:
+                    raise ValueError(f"expression {step[key]!r} fails at t={t:g}: {exc}")
+
+    def render(self, t: float) -> numpy.ndarray:
+        """Evaluate the expressions at time t
+
+        :param t: time in seconds
+        :return: numpy uint32 array of colour values, reused for every frame
+        """
+        self._variables["t"] = numpy.float64(t)  # numpy scalar, so overflow gives inf rather than an exception
+        with numpy.errstate(all="ignore"):
+            components = [evaluator(self._variables) for evaluator in self._evaluators]
+            if self._model == self.HSV:
+                hsv_to_colors(*components, self._out)
+            else:
+                rgb_to_colors(*components, self._out)
+        return self._out
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""Flight recorder of the frames shown and control events, for reconstructing what the strip showed
+
+flightrecorder.py
+
+by Darren Dunford
+
+The recorder is a fixed size file, memory mapped shared, holding rings of the last frames shown and the last
+control events (commands, settings, step changes, starts and stops). Writes go straight to the mapped pages, so
+the recording survives the controller crashing or being killed; it is reopened and carried on after a restart
+if the pixel count and ring sizes are unchanged. Each frame is copied in with a single numpy.take in to its
+slot, so recording allocates nothing per frame.
+
+File format (all integers little endian):
+
+    header   4s magic "WSFR", B version, B flags, H reserved, I pixel count, I frame slots, I event slots,
+             I reserved, Q frames written, Q events written, padded to 64 bytes
+    frames   frame slots x (Q sequence number, d time shown, I brightness, I reserved,
+             pixel count x 3 bytes of packed GRB, padded to a multiple of 8 bytes)
+    events   event slots x (Q sequence number, d time, H length, length bytes of JSON, padded to EVENT_SIZE)
+
+Frame n (counting from 1) is written to slot (n - 1) % frame slots, and events likewise. A slot's sequence
+number is zeroed before it is rewritten and set once it is complete, so a slot torn by a crash mid-write is
+skipped when reading.
+
+Export the last seconds of a recording, as JSON, as a PPM image with one row per frame, or as an animation file
+to replay on the simulated strip with the Playback effect:
+
+    python3 -m ledcontroller.flightrecorder export ledcontroller-flight.bin --seconds 10 --json glitch.json
+    python3 -m ledcontroller.flightrecorder export ledcontroller-flight.bin --seconds 10 --ppm glitch.ppm
+    python3 -m ledcontroller.flightrecorder export ledcontroller-flight.bin --seconds 10 --animation glitch.wsa
+"""
+
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+MAGIC = b"WSFR"
+VERSION = 1
+
+HEADER = struct.Struct("<4sBBHIIIIQQ")
+HEADER_SIZE = 64
+COUNTS_OFFSET = 24  # offset of frames written and events written in the header
+FRAME_HEADER = struct.Struct("<QdII")
+EVENT_HEADER = struct.Struct("<QdH")
+EVENT_SIZE = 256
+
+
+def _layout(num_pixels: int, frame_slots: int, event_slots: int):
+    """Return (frame slot size, offset of events, file size) in bytes
+
+    :param num_pixels: pixels per frame
+    :param frame_slots: frames held
+    :param event_slots: events held
+    :return:
+    """
+    frame_size = (FRAME_HEADER.size + num_pixels * 3 + 7) & ~7
+    events_offset = HEADER_SIZE + frame_size * frame_slots
+    return frame_size, events_offset, events_offset + EVENT_SIZE * event_slots
+
+
+class _Rings:
+    """Views of the frame and event rings in a mapped recorder file"""
+
+    def __init__(self, buffer, num_pixels: int, frame_slots: int, event_slots: int):
+        """
+        :param buffer: mapped file
+        :param num_pixels: pixels per frame
+        :param frame_slots: frames held
+        :param event_slots: events held
+        """
+        self.num_pixels = num_pixels
+        self.frame_slots = frame_slots
+        self.event_slots = event_slots
+        frame_size, events_offset, _ = _layout(num_pixels, frame_slots, event_slots)
+
+        def column(dtype, offset, stride, count, shape=()):
+            return numpy.ndarray((count,) + shape, dtype=dtype, buffer=buffer, offset=offset,
+                                 strides=(stride,) + ((1,) if shape else ()))
+
+        self.counts = numpy.ndarray((2,), dtype="<u8", buffer=buffer, offset=COUNTS_OFFSET)
+        self.frame_seq = column("<u8", HEADER_SIZE, frame_size, frame_slots)
+        self.frame_time = column("<f8", HEADER_SIZE + 8, frame_size, frame_slots)
+        self.frame_brightness = column("<u4", HEADER_SIZE + 16, frame_size, frame_slots)
+        self.frame_pixels = column(numpy.uint8, HEADER_SIZE + FRAME_HEADER.size, frame_size, frame_slots,
+                                   (num_pixels * 3,))
+        self.event_seq = column("<u8", events_offset, EVENT_SIZE, event_slots)
+        self.event_time = column("<f8", events_offset + 8, EVENT_SIZE, event_slots)
+        self.event_length = column("<u2", events_offset + 16, EVENT_SIZE, event_slots)
+        self.event_data = column(numpy.uint8, events_offset + EVENT_HEADER.size, EVENT_SIZE, event_slots,
+                                 (EVENT_SIZE - EVENT_HEADER.size,))
+
+
+class FlightRecorder:
+    """Records frames and events in to a memory mapped ring buffer file"""
+
+    def __init__(self, filename: str, num_pixels: int, frame_slots: int = 500, event_slots: int = 256):
+        """Open the recorder file, carrying on an existing recording of the same shape, otherwise starting anew
+
+        :param filename: path of recorder file
+        :param num_pixels: pixels per frame
+        :param frame_slots: number of most recent frames held
+        :param event_slots: number of most recent events held
+        """
+        _, _, size = _layout(num_pixels, frame_slots, event_slots)
+        header = HEADER.pack(MAGIC, VERSION, 0, 0, num_pixels, frame_slots, event_slots, 0, 0, 0)
+
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            existing = os.pread(fd, COUNTS_OFFSET, 0)
+            if os.fstat(fd).st_size != size or existing != header[:COUNTS_OFFSET]:
+                LOGGER.info("Starting new flight recording %s", filename)
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, header, 0)
+            self._map = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+
+        self._rings = _Rings(self._map, num_pixels, frame_slots, event_slots)
+        self._slots = list(self._rings.frame_pixels)  # a view per slot, made once rather than per frame
+        self._order = (numpy.arange(num_pixels)[:, None] * 4 + [2, 1, 0]).ravel()  # GRB bytes of each uint32
+        self._source = None
+        self._source_bytes = None
+        self._event_lock = threading.Lock()
+
+    def record_frame(self, pixels: numpy.ndarray, t: float, brightness: int):
+        """Record a frame as it is shown, called by the render thread
+
+        :param pixels: numpy uint32 array of the strip's colour values
+        :param t: time the frame was shown
+        :param brightness: strip brightness 0-255
+        :return:
+        """
+        if pixels is not self._source:
+            self._source, self._source_bytes = pixels, pixels.view(numpy.uint8)
+        rings = self._rings
+        n = int(rings.counts[0]) + 1
+        slot = (n - 1) % rings.frame_slots
+        rings.frame_seq[slot] = 0
+        numpy.take(self._source_bytes, self._order, out=self._slots[slot], mode="clip")
+        rings.frame_time[slot] = t
+        rings.frame_brightness[slot] = brightness
+        rings.frame_seq[slot] = n
+        rings.counts[0] = n
+
+    def record_event(self, kind: str, t: float, **details):
+        """Record a control event, may be called from any thread
+
+        :param kind: event kind, e.g. "command", "step", "stop"
+        :param t: time of the event
+        :param details: JSON serialisable details, truncated to fit the event slot
+        :return:
+        """
+        data = json.dumps(dict(details, kind=kind), default=str).encode()[:EVENT_SIZE - EVENT_HEADER.size]
+        rings = self._rings
+        with self._event_lock:
+            n = int(rings.counts[1]) + 1
+            slot = (n - 1) % rings.event_slots
+            rings.event_seq[slot] = 0
+            rings.event_data[slot, :len(data)] = numpy.frombuffer(data, dtype=numpy.uint8)
+            rings.event_length[slot] = len(data)
+            rings.event_time[slot] = t
+            rings.event_seq[slot] = n
+            rings.counts[1] = n
+
+    def close(self):
+        """Flush the recording to disk and unmap it
+
+        :return:
+        """
+        self._rings = self._slots = self._source = self._source_bytes = None
+        self._map.flush()
+        self._map.close()
+
+
+class FlightRecording:
+    """Read only view of a recorder file, which may still be being written"""
+
+    def __init__(self, filename: str):
+        """Open and memory map a recorder file
+
+        :param filename: path of recorder file
+        """
+        with open(filename, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, _, num_pixels, frame_slots, event_slots, _, _, _ = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{filename} is not a version {VERSION} flight recording")
+        self.num_pixels = num_pixels
+        self._rings = _Rings(self._map, num_pixels, frame_slots, event_slots)
+
+    def frames(self, since: float = None) -> list:
+        """Return complete frames held, oldest first
+
+        :param since: optional time, earlier frames are left out
+        :return: list of (sequence number, time, brightness, numpy uint32 array of colour values)
+        """
+        from ledcontroller.animation import unpack_grb
+        rings = self._rings
+        frames = []
+        for slot in numpy.argsort(rings.frame_seq):
+            seq, t = int(rings.frame_seq[slot]), float(rings.frame_time[slot])
+            if seq == 0 or (since is not None and t < since):
+                continue
+            pixels = numpy.zeros(self.num_pixels, dtype=numpy.uint32)
+            unpack_grb(rings.frame_pixels[slot], pixels)
+            frames.append((seq, t, int(rings.frame_brightness[slot]), pixels))
+        return frames
+
+    def events(self, since: float = None) -> list:
+        """Return complete events held, oldest first
+
+        :param since: optional time, earlier events are left out
+        :return: list of (sequence number, time, event dictionary)
+        """
+        rings = self._rings
+        events = []
+        for slot in numpy.argsort(rings.event_seq):
+            seq, t = int(rings.event_seq[slot]), float(rings.event_time[slot])
+            if seq == 0 or (since is not None and t < since):
+                continue
+            data = rings.event_data[slot, :int(rings.event_length[slot])].tobytes()
+            try:
+                event = json.loads(data)
+            except ValueError:
+                event = {"kind": "truncated", "data": data.decode(errors="replace")}
+            events.append((seq, t, event))
+        return events
+
+    def latest(self) -> float:
+        """Return time of the latest frame or event held, or None if the recording is empty
+
+        :return:
+        """
+        rings = self._rings
+        times = [float(rings.frame_time[rings.frame_seq.argmax()])] if rings.counts[0] else []
+        times += [float(rings.event_time[rings.event_seq.argmax()])] if rings.counts[1] else []
+        return max(times, default=None)
+
+    def close(self):
+        self._rings = None
+        self._map.close()
+
+
+def export(filename: str, seconds: float = 10, json_file: str = None, ppm_file: str = None,
+           animation_file: str = None):
+    """Export the last seconds of a recording
+
+    :param filename: path of recorder file
+    :param seconds: length of window ending at the latest frame or event
+    :param json_file: optional path of JSON file to write frames and events to
+    :param ppm_file: optional path of PPM image to write, one row of pixels per frame
+    :param animation_file: optional path of animation file to write, for the Playback effect
+    :return:
+    """
+    recording = FlightRecording(filename)
+    latest = recording.latest()
+    since = None if latest is None else latest - seconds
+    frames, events = recording.frames(since), recording.events(since)
+    recording.close()
+    print(f"{filename}: {len(frames)} frames and {len(events)} events in the last {seconds:g} s")
+
+    if json_file:
+        with open(json_file, "w") as stream:
+            json.dump({
+                "num_pixels": recording.num_pixels,
+                "frames": [{"seq": seq, "time": t, "brightness": brightness, "pixels": pixels.tolist()}
+                           for seq, t, brightness, pixels in frames],
+                "events": [dict(event, seq=seq, time=t) for seq, t, event in events],
+            }, stream)
+
+    if ppm_file and frames:
+        with open(ppm_file, "wb") as stream:
+            stream.write(f"P6 {recording.num_pixels} {len(frames)} 255\n".encode())
+            for _, _, _, pixels in frames:
+                rgb = numpy.empty((len(pixels), 3), dtype=numpy.uint8)
+                rgb[:, 0] = pixels >> 8
+                rgb[:, 1] = pixels >> 16
+                rgb[:, 2] = pixels
+                stream.write(rgb.tobytes())
+
+    if animation_file and frames:
+        # resample on to a fixed frame rate, holding each frame until the next was shown, as static effects
+        # show a single frame however long they run; a frame shown less than a frame period after the one
+        # before can be lost, the JSON export keeps every frame with its exact time
+        from ledcontroller.animation import AnimationWriter
+        times = numpy.array([t for _, t, _, _ in frames])
+        intervals = numpy.diff(times)
+        fps = min(1 / float(numpy.median(intervals)), 100.0) if len(intervals) else 1.0
+        grid = times[0] + numpy.arange(int(numpy.ceil((times[-1] - times[0]) * fps)) + 1) / fps
+        with AnimationWriter(animation_file, fps, recording.num_pixels, delta=True) as writer:
+            for i in numpy.searchsorted(times, grid, side="right") - 1:
+                writer.write(frames[i][3])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flight recorder tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="export the last seconds of a recording")
+    export_parser.add_argument("filename")
+    export_parser.add_argument("--seconds", type=float, default=10, help="window ending at the latest record")
+    export_parser.add_argument("--json", help="JSON file of frames and events")
+    export_parser.add_argument("--ppm", help="PPM image, one row per frame")
+    export_parser.add_argument("--animation", help="animation file for the Playback effect")
+    args = parser.parse_args()
+    export(args.filename, args.seconds, args.json, args.ppm, args.animation)
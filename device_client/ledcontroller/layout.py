@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Resolution independent layout of effects on strips of any length
+
+layout.py
+
+by Darren Dunford
+
+Effects are defined over normalised position along the strip, 0 at the first pixel and 1 at the end, rather
+than over pixel numbers of one particular strip. A design drawn for a reference strip, such as the tree patterns
+laid out on the 643 pixel Christmas installation or the 50 pixel bunting effects, is mapped on to any other
+length by giving each pixel the colour of the reference pixel at the same normalised position; on the reference
+strip itself the mapping is the identity, so it renders exactly as before. Effects draw each frame with numpy
+operations over the whole strip rather than setPixelColor() per pixel, so frame time stays small and grows
+linearly with the number of pixels.
+
+Frame time benchmark of every effect at several strip lengths on the simulated strip:
+
+    python3 -m ledcontroller.layout benchmark --pixels 643 2000 5000
+"""
+
+import argparse
+import logging
+import time
+
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+
+def positions(num_pixels: int) -> numpy.ndarray:
+    """Return the normalised position (0-1) of the centre of each pixel
+
+    :param num_pixels: number of pixels on the strip
+    :return: numpy float64 array
+    """
+    return (numpy.arange(num_pixels) + 0.5) / num_pixels
+
+
+def reference_index(num_pixels: int, reference_pixels: int) -> numpy.ndarray:
+    """Return, for each pixel, the pixel at the same normalised position on a reference strip
+
+    :param num_pixels: number of pixels on the strip
+    :param reference_pixels: number of pixels on the reference strip the design is drawn for
+    :return: numpy intp array, non-decreasing, the identity if the strip is the reference length
+    """
+    return numpy.minimum((positions(num_pixels) * reference_pixels).astype(numpy.intp), reference_pixels - 1)
+
+
+def map_pixels(drawn, reference_pixels: int, num_pixels: int):
+    """Find the pixels of the strip at the positions of pixels drawn on a reference strip
+
+    :param drawn: reference pixels the design draws, other pixels are left as they are
+    :param reference_pixels: number of pixels on the reference strip
+    :param num_pixels: number of pixels on the strip
+    :return: (pixels, reference) numpy arrays of the strip's pixels and the reference pixel each shows
+    """
+    reference = reference_index(num_pixels, reference_pixels)
+    pixels = numpy.flatnonzero(numpy.isin(reference, numpy.asarray(drawn, dtype=numpy.intp)))
+    return pixels, reference[pixels]
+
+
+def map_design(design: dict, reference_pixels: int, num_pixels: int):
+    """Map a static design on a reference strip on to the strip
+
+    :param design: dictionary of reference pixel number to colour
+    :param reference_pixels: number of pixels on the reference strip
+    :param num_pixels: number of pixels on the strip
+    :return: (pixels, colours) numpy arrays, drawn with pixel_buffer()[pixels] = colours
+    """
+    colours = numpy.zeros(reference_pixels, dtype=numpy.uint32)
+    colours[list(design)] = list(design.values())
+    pixels, reference = map_pixels(list(design), reference_pixels, num_pixels)
+    return pixels, colours[reference]
+
+
+def scale_pixels(pixels: float, reference_pixels: int, num_pixels: int) -> int:
+    """Scale a pixel count or position on a reference strip to a strip of num_pixels
+
+    :param pixels: pixel count or position on the reference strip
+    :param reference_pixels: number of pixels on the reference strip
+    :param num_pixels: number of pixels on the strip
+    :return:
+    """
+    return int(pixels * num_pixels / reference_pixels)
+
+
+def benchmark(pixel_counts=(643, 2000, 5000), seconds: float = 2.0):
+    """Measure mean frame time of every effect that needs no outside input at several strip lengths
+
+    :param pixel_counts: strip lengths to measure
+    :param seconds: rendering time for each effect and length
+    :return:
+    """
+    from ledcontroller.effects import EFFECTS, create_effect
+    from ledcontroller.simulatedstrip import SimulatedPixelStrip
+
+    names = sorted({cls.name for cls in EFFECTS.values()} - {"Playback", "MusicSync", "Stream", "Expression",
+                                                             "PipelineBenchmark"})
+    print("frame time in ms (per 1000 pixels)")
+    print(f"{'effect':20}" + "".join(f"{count:>20}" for count in pixel_counts))
+    for name in names:
+        row = f"{name:20}"
+        for count in pixel_counts:
+            strip = SimulatedPixelStrip(count)
+            effect = create_effect({"effect": name}, count, seed=1234)
+            interval = effect.frame_interval or 0.01
+            frames, t = 0, 0.0
+            start = time.perf_counter()
+            while time.perf_counter() - start < seconds:
+                effect.render(strip, t)
+                frames += 1
+                t += interval
+            cost = (time.perf_counter() - start) / frames * 1000
+            row += f"{cost:10.3f} ({cost * 1000 / count:6.3f})"
+        print(row)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Strip layout tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench_parser = commands.add_parser("benchmark", help="measure frame time of every effect at several lengths")
+    bench_parser.add_argument("--pixels", type=int, nargs="+", default=[643, 2000, 5000])
+    bench_parser.add_argument("--seconds", type=float, default=2.0, help="rendering time per effect and length")
+    args = parser.parse_args()
+    benchmark(args.pixels, args.seconds)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""Render-ahead pipeline decoupling frame rendering from show()
+
+pipeline.py
+
+by Darren Dunford
+
+show() on a real strip blocks for the wire time of the frame, about 19 ms for 643 pixels, so rendering a frame
+and then showing it on one thread leaves each frame's render time and wire time adding up, and any stall of
+the render thread (garbage collection, another thread holding the GIL) delays the frame on the strip.
+
+FramePipeline splits the two: the render thread draws frames for future grid times on off-screen canvases,
+taken from a fixed pool, and queues them; a display thread copies each queued frame in to the strip buffer and
+shows it at its deadline. Rendering the next frame overlaps showing the current one, and a stall shorter than
+the frames queued ahead is absorbed. The pool bounds how far rendering runs ahead, and the queue is dropped
+whenever the program changes or the controller stops, so a switch still reaches the strip within a frame.
+
+Effects driven by an outside source (audio, UDP streams) are not rendered ahead, as that would add latency; they
+are rendered when due and shown at once, still overlapping the previous frame's show().
+
+Deadline benchmark, a simulated strip with real wire time and an effect with periodic render stalls:
+
+    python3 -m ledcontroller.pipeline benchmark
+"""
+
+import argparse
+import collections
+import logging
+import sys
+import threading
+import time
+
+import numpy
+
+from ledcontroller.simulatedstrip import SimulatedPixelStrip
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FramePipeline:
+    """Pool of off-screen canvases, queue of rendered frames and the display thread showing them"""
+
+    def __init__(self, strip, depth: int = 2, clock=time.time, on_shown=None):
+        """Allocate canvases and start the display thread
+
+        :param strip: LockingPixelStrip to show frames on
+        :param depth: frames queued ahead of the one being shown, 0 to show each frame on the render thread as
+                      soon as it is due, as before the pipeline
+        :param clock: function returning the time deadlines are given in
+        :param on_shown: optional function called with the trace of each traced frame once shown
+        """
+        self.depth = depth
+        self._strip = strip
+        self._clock = clock
+        self._on_shown = on_shown
+        num_pixels = strip.numPixels()
+        self._free = [SimulatedPixelStrip(num_pixels) for _ in range(depth + 1)]
+        self._queue = collections.deque()  # (canvas, deadline, trace) in deadline order
+        self._last = numpy.zeros(num_pixels, dtype=numpy.uint32)  # most recent frame rendered
+        self._changed = threading.Condition()
+        self._show_lock = threading.Lock()  # held by whichever thread is writing to the strip
+        self._generation = 0  # incremented by interrupt(), so waits in progress give up
+        self._closed = False
+        self.late = 0  # frames shown more than 1 ms after their deadline
+        self.dropped = 0  # frames dropped by the display thread to get back on time
+        self._display = None
+        if depth:
+            self._display = threading.Thread(target=self._run_display, daemon=True)
+            self._display.start()
+
+    def canvas(self, interrupted):
+        """Return a free canvas to render the next frame on, holding the last frame rendered
+
+        Waits while every canvas is queued, which bounds how far rendering runs ahead.
+
+        :param interrupted: function returning True if the render thread should give up waiting
+        :return: canvas, or None if interrupted
+        """
+        with self._changed:
+            while not self._free:
+                if interrupted() or self._closed:
+                    return None
+                self._changed.wait()
+            canvas = self._free.pop()
+        numpy.copyto(canvas.pixel_buffer(), self._last)
+        return canvas
+
+    def release(self, canvas):
+        """Return a canvas to the pool
+
+        :param canvas: canvas from canvas()
+        :return:
+        """
+        with self._changed:
+            self._free.append(canvas)
+            self._changed.notify_all()
+
+    def submit(self, canvas, deadline: float, trace=None, interrupted=None):
+        """Queue a rendered frame to be shown at its deadline
+
+        With no depth the frame is shown on the calling thread, after waiting for the deadline.
+
+        :param canvas: canvas from canvas(), drawn on
+        :param deadline: time the frame is to be shown by the clock
+        :param trace: optional CommandTrace passed to on_shown once the frame is shown
+        :param interrupted: function returning True if the render thread should give up waiting, with no depth
+        :return:
+        """
+        numpy.copyto(self._last, canvas.pixel_buffer())
+        if self._display is None:
+            with self._changed:
+                generation = self._generation
+                while not (interrupted and interrupted()) and generation == self._generation:
+                    remaining = deadline - self._clock()
+                    if remaining <= 0:
+                        break
+                    self._changed.wait(remaining)
+            with self._show_lock:
+                self._show(canvas, deadline)
+            if trace and self._on_shown:
+                self._on_shown(trace)
+            return
+        with self._changed:
+            self._queue.append((canvas, deadline, trace))
+            self._changed.notify_all()
+
+    def _show(self, canvas, deadline: float):
+        """Copy a frame to the strip, return its canvas to the pool and show it, called holding _show_lock
+
+        :param canvas: canvas holding the frame
+        :param deadline: time the frame was due
+        :return:
+        """
+        numpy.copyto(self._strip.pixel_buffer(), canvas.pixel_buffer())
+        self.release(canvas)  # free for the next frame while this one is on the wire
+        if self._clock() - deadline > 0.001:
+            self.late += 1
+        self._strip.show()
+
+    def _run_display(self):
+        """Display thread, shows each queued frame at its deadline
+
+        :return:
+        """
+        while True:
+            with self._changed:
+                while not self._closed:
+                    if self._queue:
+                        self._drop_late()
+                        remaining = self._queue[0][1] - self._clock()
+                        if remaining <= 0:
+                            break
+                        self._changed.wait(remaining)
+                    else:
+                        self._changed.wait()
+                if self._closed:
+                    return
+                canvas, deadline, trace = self._queue.popleft()
+
+                # held from taking the frame until it is shown, so clear() waits for a show in progress
+                self._show_lock.acquire()
+
+            try:
+                self._show(canvas, deadline)
+            finally:
+                self._show_lock.release()
+            if trace and self._on_shown:
+                self._on_shown(trace)
+
+    def _drop_late(self):
+        """Drop frames more than half a frame late with a later frame queued, called holding _changed
+
+        show() takes most of a frame interval on a long strip, so a late frame would otherwise leave every
+        following frame late too; dropping it lets the next frame be shown on time.
+
+        :return:
+        """
+        now = self._clock()
+        while len(self._queue) > 1 and now - self._queue[0][1] > (self._queue[1][1] - self._queue[0][1]) / 2:
+            canvas, _, trace = self._queue.popleft()
+            self._free.append(canvas)
+            self.dropped += 1
+            if trace:
+                following, deadline, _ = self._queue[0]
+                self._queue[0] = (following, deadline, trace)
+        self._changed.notify_all()
+
+    def interrupt(self):
+        """Drop frames not yet shown and wake the render thread, called when the program changes or on stop
+
+        :return:
+        """
+        with self._changed:
+            while self._queue:
+                self._free.append(self._queue.popleft()[0])
+            self._generation += 1
+            self._changed.notify_all()
+
+    def clear(self):
+        """Drop frames not yet shown and clear the strip, once any show() in progress has finished
+
+        :return:
+        """
+        with self._changed:
+            while self._queue:
+                self._free.append(self._queue.popleft()[0])
+            self._last[:] = 0
+            self._changed.notify_all()
+        with self._show_lock:
+            numpy.copyto(self._strip.pixel_buffer(), 0)
+            self._strip.show()
+
+    def close(self):
+        """Stop the display thread, dropping frames not yet shown
+
+        :return:
+        """
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+        if self._display is not None:
+            self._display.join()
+
+
+def benchmark(seconds: float = 10, fps: float = 50, num_pixels: int = 643, render_ms: float = 8,
+              stall_ms: float = 40, stall_every: int = 50):
+    """Compare deadline misses with and without render-ahead on a strip with real wire time
+
+    The simulated strip's show() takes the WS281x wire time of 30 us per pixel. The effect renders a moving
+    gradient, busy for render_ms per frame, and stalls for stall_ms every stall_every frames, standing in for a
+    garbage collection or another thread's hiccup.
+
+    :param seconds: seconds to run each depth
+    :param fps: target frames per second
+    :param num_pixels: number of pixels
+    :param render_ms: render cost per frame in milliseconds
+    :param stall_ms: length of each stall in milliseconds
+    :param stall_every: frames between stalls
+    :return:
+    """
+    from ledcontroller.effects import Effect, LightEffect, LockingPixelStrip, register_effect
+
+    @register_effect("PipelineBenchmark")
+    class PipelineBenchmark(Effect):
+        frame_interval = 1 / fps
+
+        def __init__(self, step, num_pixels):
+            super().__init__(step, num_pixels)
+            self._ramp = numpy.arange(num_pixels, dtype=numpy.uint32)
+            self._frames = 0
+
+        def render(self, canvas, t):
+            busy = time.perf_counter() + render_ms / 1000
+            while time.perf_counter() < busy:
+                pass
+            self._frames += 1
+            if self._frames % stall_every == 0:
+                time.sleep(stall_ms / 1000)
+            numpy.add(self._ramp, int(t * 100), out=canvas.pixel_buffer())
+            canvas.pixel_buffer()[:] &= 0xFF
+
+    class WireTimeStrip(LockingPixelStrip):
+        """Simulated strip whose show() blocks for the wire time, recording when each frame was shown"""
+
+        def __init__(self):
+            super().__init__(num_pixels, 18, 800000, 10, False, 255, 0)
+            self.shown_at = []
+
+        def show(self):
+            self.shown_at.append(time.time())
+            time.sleep(num_pixels * 30e-6)
+            super().show()
+
+    print(f"{num_pixels} pixels ({num_pixels * 0.03:.1f} ms wire time), target {fps:g} fps, render "
+          f"{render_ms:g} ms, {stall_ms:g} ms stall every {stall_every} frames")
+    for depth in (0, 1, 2, 3):
+        strip = WireTimeStrip()
+        start = time.time() + 0.2
+        lights = LightEffect(strip, program=[{"effect": "PipelineBenchmark"}], start=start, lookahead=depth)
+        lights.start()
+        time.sleep(seconds + 0.2)
+        lights.stop()
+        lights.join()
+        shown = numpy.array(strip.shown_at[1:-1])
+        lateness = ((shown - start) * fps % 1) / fps * 1000  # ms after the grid point each frame was shown
+        gaps = numpy.diff(shown) * 1000
+        print(f"  lookahead {depth}: {len(shown) / seconds:5.1f} fps, dropped {lights.dropped_frames:3d}, longest gap "
+              f"{gaps.max():5.1f} ms, shown after grid time median {numpy.median(lateness):4.1f} ms, 95th "
+              f"percentile {numpy.percentile(lateness, 95):4.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render pipeline tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench_parser = commands.add_parser("benchmark", help="compare deadline misses with and without render-ahead")
+    bench_parser.add_argument("--seconds", type=float, default=10)
+    bench_parser.add_argument("--fps", type=float, default=50)
+    bench_parser.add_argument("--pixels", type=int, default=643)
+    bench_parser.add_argument("--render-ms", type=float, default=8, help="render cost per frame")
+    bench_parser.add_argument("--stall-ms", type=float, default=40, help="length of each stall")
+    bench_parser.add_argument("--stall-every", type=int, default=50, help="frames between stalls")
+    args = parser.parse_args()
+    sys.setswitchinterval(0.001)  # as the controller does
+    benchmark(args.seconds, args.fps, args.pixels, args.render_ms, args.stall_ms, args.stall_every)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Bounded offline queue for device shadow updates
+
+publishqueue.py
+
+by Darren Dunford
+"""
+
+import json
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class CoalescingPublishQueue:
+    """Holds shadow updates made while offline, keeping only the latest value of each state key
+
+    Shadow documents put on the queue are merged key by key in to a single pending document, so however long
+    the outage only one value per reported (or desired) key is held and a single merged document is sent on
+    reconnection. A null section, which clears the whole section in the shadow, supersedes the values pending
+    before it and is sent in a document of its own ahead of any values put after it. The serialised size of the
+    pending values is capped; if a new value would exceed the cap the largest pending values are dropped until
+    it fits.
+    """
+
+    def __init__(self, max_bytes: int = 65536):
+        """Initialise empty queue
+
+        :param max_bytes: maximum total serialised size of pending values in bytes
+        """
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pending = {}  # section ("reported"/"desired") to dict of key to value
+        self._cleared = set()  # sections to clear in the shadow before the pending values are applied
+        self._sizes = {}  # (section, key) to serialised size of pending value
+        self.superseded = 0  # values replaced by a newer value for the same key
+        self.dropped = 0  # values dropped to keep within max_bytes
+        self.dropped_bytes = 0
+
+    def __len__(self):
+        return len(self._sizes)
+
+    @property
+    def size(self) -> int:
+        """Total serialised size of pending values in bytes"""
+        return sum(self._sizes.values())
+
+    def _drop_largest(self):
+        """Drop the largest pending value, caller must hold the lock
+
+        :return:
+        """
+        section, key = max(self._sizes, key=self._sizes.get)
+        self.dropped += 1
+        self.dropped_bytes += self._sizes.pop((section, key))
+        del self._pending[section][key]
+        LOGGER.warning("Offline queue full, dropped %s.%s", section, key)
+
+    def put(self, document: dict, replace: bool = True):
+        """Merge a shadow document in to the pending document
+
+        :param document: shadow document of the form {"state": {"reported": {...}, "desired": {...}}}
+        :param replace: if False, values already pending are kept in preference to those in document,
+            used to return a document to the queue after a failed flush
+        :return:
+        """
+        with self._lock:
+            for section, values in document.get("state", {}).items():
+
+                # a null section clears the whole section in the shadow, superseding everything before it, or
+                # when returned to the queue, coming before everything pending
+                if values is None:
+                    if replace:
+                        for key in self._pending.pop(section, {}):
+                            self.superseded += 1
+                            del self._sizes[(section, key)]
+                    self._cleared.add(section)
+                    continue
+
+                pending = self._pending.setdefault(section, {})
+
+                for key, value in values.items():
+                    if key in pending:
+                        if not replace:
+                            continue
+                        self.superseded += 1
+                        del self._sizes[(section, key)]
+                        del pending[key]
+
+                    size = len(key) + len(json.dumps(value))
+                    if size > self.max_bytes:
+                        self.dropped += 1
+                        self.dropped_bytes += size
+                        LOGGER.warning("Offline queue value too large, dropped %s.%s", section, key)
+                        continue
+                    while self._sizes and self.size + size > self.max_bytes:
+                        self._drop_largest()
+                    pending[key] = value
+                    self._sizes[(section, key)] = size
+
+    def take(self) -> list:
+        """Remove and return the pending documents, to be sent in order
+
+        This is a single merged document, unless a section is to be cleared and also has values put after the
+        clear, when the clear is sent first in a document of its own.
+
+        :return: list of shadow documents, empty if nothing is pending
+        """
+        with self._lock:
+            clears = {section: None for section in self._cleared}
+            values = {section: pending for section, pending in self._pending.items() if pending}
+            self._cleared = set()
+            self._pending = {}
+            self._sizes = {}
+        if clears.keys() & values.keys():
+            return [{"state": clears}, {"state": values}]
+        if clears or values:
+            return [{"state": {**values, **clears}}]
+        return []
+
+    def stats(self) -> dict:
+        """Return drop accounting as a dictionary suitable for reporting to the device shadow
+
+        :return:
+        """
+        return {"superseded": self.superseded, "dropped": self.dropped, "dropped_bytes": self.dropped_bytes}
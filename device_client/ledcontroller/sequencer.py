@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Timeline sequencing of light programs
+
+sequencer.py
+
+by Darren Dunford
+
+A program is a list of steps. As well as effect steps, a program can contain
+
+    - loop steps, which repeat a nested list of steps: {"loop": [...], "repeat": 3}
+    - sub-program steps, which run another named program: {"program": "xmas", "repeat": 2}
+
+repeat is optional for both and defaults to forever for a loop and once for a sub-program. Effect steps run for
+"duration" seconds if given, otherwise until the program is stopped.
+"""
+
+import logging
+
+LOGGER = logging.getLogger(__name__)
+
+MAX_NESTING = 8  # maximum depth of nested loops and sub-programs
+
+
+def timeline(program: list, programs: dict = None, depth: int = 0, skip: dict = None):
+    """Generate the effect steps of a program in order, expanding loops and sub-programs
+
+    When joining a program in progress, skip holds the seconds since it started. Steps and whole passes of loops
+    over by then are passed over without being generated, so joining takes the same time however long ago the
+    program started. skip is updated with the seconds and number of steps passed over.
+
+    :param program: list of steps
+    :param programs: dictionary of named programs for sub-program steps
+    :param depth: nesting depth, used internally to stop runaway recursion
+    :param skip: optional dictionary {"seconds": seconds since the program started}, to which "skipped" (seconds)
+                 and "steps" (number of steps) passed over are added
+    :return: generator of effect step dictionaries
+    """
+    if depth > MAX_NESTING:
+        raise ValueError(f"program nested more than {MAX_NESTING} deep")
+    if skip is not None:
+        skip.setdefault("skipped", 0.0)
+        skip.setdefault("steps", 0)
+
+    for step in program:
+
+        if "loop" in step or "program" in step:
+            if "loop" in step:
+                steps = step["loop"]
+                repeat = step.get("repeat")
+            else:
+                steps = (programs or {})[step["program"]]
+                repeat = step.get("repeat", 1)
+
+            count = 0
+            if skip is not None and skip["seconds"] > 0:
+                length = period(steps, programs, depth + 1)
+                if length is not None:
+                    passes = int(skip["seconds"] // length[0])
+                    count = passes if repeat is None else min(passes, repeat)
+                    skip["seconds"] -= count * length[0]
+                    skip["skipped"] += count * length[0]
+                    skip["steps"] += count * length[1]
+            while repeat is None or count < repeat:
+                yield from timeline(steps, programs, depth + 1, skip)
+                count += 1
+
+        else:
+            if skip is not None and skip["seconds"] > 0:
+                duration = step.get("duration")
+                if duration is not None and duration <= skip["seconds"]:
+                    skip["seconds"] -= duration
+                    skip["skipped"] += duration
+                    skip["steps"] += 1
+                    continue
+                skip["seconds"] = 0  # reached the step in progress, later steps are generated as they come
+            yield step
+
+
+def period(program: list, programs: dict = None, depth: int = 0):
+    """Return the length of one pass through a list of steps
+
+    :param program: list of steps
+    :param programs: dictionary of named programs for sub-program steps
+    :param depth: nesting depth, used internally to stop runaway recursion
+    :return: (seconds, number of effect steps), or None if a step has no duration or a loop repeats forever
+    """
+    if depth > MAX_NESTING:
+        raise ValueError(f"program nested more than {MAX_NESTING} deep")
+    seconds, count = 0.0, 0
+    for step in program:
+        if "loop" in step or "program" in step:
+            if "loop" in step:
+                steps, repeat = step["loop"], step.get("repeat")
+            else:
+                steps, repeat = (programs or {})[step["program"]], step.get("repeat", 1)
+            length = None if repeat is None else period(steps, programs, depth + 1)
+            if length is None:
+                return None
+            seconds += length[0] * repeat
+            count += length[1] * repeat
+        elif step.get("duration") is None:
+            return None
+        else:
+            seconds += step["duration"]
+            count += 1
+    return (seconds, count) if seconds > 0 else None
+
+
+def validate_program(program, programs: dict = None, effects: dict = None, depth: int = 0):
+    """Check a program is well formed, raising ValueError describing the first problem found
+
+    :param program: list of steps
+    :param programs: dictionary of named programs for sub-program steps
+    :param effects: optional dictionary of valid effect names, if given effect steps are checked against it
+    :param depth: nesting depth, used internally to detect recursive sub-programs
+    :return:
+    """
+    if depth > MAX_NESTING:
+        raise ValueError(f"program nested more than {MAX_NESTING} deep (recursive sub-program?)")
+    if not isinstance(program, list) or not program:
+        raise ValueError("program must be a non-empty list of steps")
+
+    for step in program:
+        if not isinstance(step, dict):
+            raise ValueError(f"step must be a dictionary: {step}")
+
+        repeat = step.get("repeat")
+        if repeat is not None and (not isinstance(repeat, int) or repeat < 1):
+            raise ValueError(f"repeat must be a positive integer: {step}")
+
+        if "loop" in step:
+            validate_program(step["loop"], programs, effects, depth + 1)
+            if repeat is None and not any("duration" in s or "loop" in s or "program" in s for s in step["loop"]):
+                LOGGER.warning("Endless loop without durations will never pass its first step: %s", step)
+
+        elif "program" in step:
+            if not isinstance(step["program"], str):
+                raise ValueError(f"sub-program must be a program name: {step}")
+            if step["program"] not in (programs or {}):
+                raise ValueError(f"unknown sub-program: {step['program']}")
+            validate_program(programs[step["program"]], programs, effects, depth + 1)
+
+        else:
+            if "effect" not in step:
+                raise ValueError(f"step has no effect, loop or program: {step}")
+            if effects is not None:
+                if str(step["effect"]) not in effects:
+                    raise ValueError(f"unknown effect: {step['effect']}")
+                effects[str(step["effect"])].validate(step)
+            duration = step.get("duration")
+            if duration is not None and (isinstance(duration, bool) or not isinstance(duration, (int, float))
+                                         or duration <= 0):
+                raise ValueError(f"duration must be a positive number of seconds: {step}")
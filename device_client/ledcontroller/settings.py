@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""Validated runtime settings store shared between the controller threads
+
+settings.py
+
+by Darren Dunford
+"""
+
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SettingsStore:
+    """Thread safe store of runtime settings
+
+    The keys and types of the settings are fixed by the defaults passed to the constructor, so settings
+    received from an external source can only change existing settings and only to values of the right type
+    and within the configured limits. Listeners are called with the changed settings after every update.
+    """
+
+    def __init__(self, defaults: dict, limits: dict = None, check=None):
+        """Initialise store from default settings
+
+        :param defaults: dictionary of setting name to default value, also defines the allowed keys and types
+        :param limits: optional dictionary of setting name to (minimum, maximum) tuple
+        :param check: optional function called with the complete candidate settings dictionary before an
+            update is applied, raises ValueError to reject settings that are invalid in combination
+        """
+        self._settings = dict(defaults)
+        self._limits = limits or {}
+        self._check = check
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    @property
+    def keys(self) -> set:
+        """Set of valid setting names"""
+        return set(self._settings)
+
+    def get(self, key: str):
+        """Return current value of a setting
+
+        :param key: setting name
+        :return:
+        """
+        return self._settings[key]
+
+    def snapshot(self) -> dict:
+        """Return a copy of all current settings
+
+        :return:
+        """
+        with self._lock:
+            return dict(self._settings)
+
+    def subscribe(self, listener):
+        """Register a function to be called with a dictionary of changed settings after each update
+
+        :param listener: function taking a single dictionary argument
+        :return:
+        """
+        self._listeners.append(listener)
+
+    def _validate(self, key: str, value):
+        """Return value coerced to the type of the existing setting, raising ValueError if invalid
+
+        :param key: setting name
+        :param value: proposed new value
+        :return:
+        """
+        if key not in self._settings:
+            raise ValueError(f"unknown setting {key}")
+
+        current = self._settings[key]
+        if isinstance(current, bool):
+            if not isinstance(value, bool):
+                raise ValueError(f"setting {key} must be true or false")
+        elif isinstance(current, int):
+            if isinstance(value, bool) or not float(value).is_integer():
+                raise ValueError(f"setting {key} must be an integer")
+            value = int(value)
+        elif isinstance(current, float):
+            if isinstance(value, bool):
+                raise ValueError(f"setting {key} must be a number")
+            value = float(value)
+
+        minimum, maximum = self._limits.get(key, (None, None))
+        if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+            raise ValueError(f"setting {key} must be between {minimum} and {maximum}")
+
+        return value
+
+    def update(self, changes: dict) -> dict:
+        """Validate and apply changes to settings, invalid changes are logged and ignored
+
+        :param changes: dictionary of setting name to new value
+        :return: dictionary of settings actually changed
+        """
+        applied = {}
+        with self._lock:
+            for key, value in changes.items():
+                try:
+                    value = self._validate(key, value)
+                except (TypeError, ValueError) as exc:
+                    LOGGER.warning("Rejected setting change: %s", exc)
+                    continue
+                if value != self._settings[key]:
+                    applied[key] = value
+
+            if applied and self._check:
+                try:
+                    self._check({**self._settings, **applied})
+                except ValueError as exc:
+                    LOGGER.warning("Rejected setting changes %s: %s", applied, exc)
+                    applied = {}
+
+            if applied:
+                self._settings.update(applied)
+
+        if applied:
+            LOGGER.info("Settings changed: %s", applied)
+            for listener in self._listeners:
+                listener(applied)
+        return applied
+
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Simulated WS281X LED strip
+
+simulatedstrip.py
+
+by Darren Dunford
+
+Stands in for rpi_ws281x.PixelStrip where the hardware library is not available, so effects can be rendered
+offline (e.g. baked to animation files) or the controller run on a development machine.
+"""
+
+import logging
+import threading
+
+import numpy
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SimulatedPixelStrip:
+    """In-memory LED strip with the same interface as rpi_ws281x.PixelStrip
+
+    Pixels are held in a numpy array of 24-bit colour values as produced by effects.color(), which is also
+    exposed directly by pixel_buffer() for effects that render a whole frame at a time.
+    """
+
+    def __init__(self, num: int, pin: int = 18, freq_hz: int = 800000, dma: int = 10, invert: bool = False,
+                 brightness: int = 255, channel: int = 0, strip_type=None, gamma=None):
+        """Initialise simulated strip, parameters other than num and brightness are accepted and ignored
+
+        :param num: number of LEDs on string
+        :param brightness: global brightness setting (0 darkest 255 brightest)
+        """
+        self._pixels = numpy.zeros(num, dtype=numpy.uint32)
+        self._brightness = brightness
+        self.frames_shown = 0
+        self.shown = threading.Condition()
+
+    def begin(self):
+        pass
+
+    def show(self):
+        """Count frame and wake anything waiting on the shown condition
+
+        :return:
+        """
+        with self.shown:
+            self.frames_shown += 1
+            self.shown.notify_all()
+
+    def setPixelColor(self, n: int, color: int):
+        self._pixels[n] = color
+
+    def setPixelColorRGB(self, n: int, red: int, green: int, blue: int, white: int = 0):
+        self._pixels[n] = (white << 24) | (green << 16) | (red << 8) | blue
+
+    def getPixelColor(self, n: int) -> int:
+        return int(self._pixels[n])
+
+    def numPixels(self) -> int:
+        return len(self._pixels)
+
+    def setBrightness(self, brightness: int):
+        self._brightness = brightness
+
+    def getBrightness(self) -> int:
+        return self._brightness
+
+    def pixel_buffer(self) -> numpy.ndarray:
+        """Return the uint32 array of pixel colours, writes to it change the strip on the next show()
+
+        :return:
+        """
+        return self._pixels
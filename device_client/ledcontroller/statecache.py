@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Local cache of controller state for instant resume after a restart
+
+statecache.py
+
+by Darren Dunford
+
+The selected program or effect, its start time and seed, the live settings and the step reached are kept in a
+small JSON file, replaced atomically on every change so a power cut leaves either the old or the new file. On
+boot the controller resumes from the file before the network is up, then reconciles with the cloud shadow in the
+background once connected. Precedence:
+
+    1. the cache overrides the defaults in the ini file at boot
+    2. a command still pending in the shadow's desired state (issued while the device was offline) is newer
+       than anything cached and is run as if it had just arrived
+    3. settings in the shadow override cached settings only if persistentshadow is on in both the ini file and
+       the shadow's desired state, otherwise the cached settings stand and are reported back to the shadow
+"""
+
+import json
+import logging
+import os
+import tempfile
+
+LOGGER = logging.getLogger(__name__)
+
+
+class StateCache:
+    """Small JSON state file written atomically"""
+
+    def __init__(self, filename: str):
+        """
+        :param filename: path of the state file
+        """
+        self.filename = filename
+        self.state = {}
+        self._written = None
+
+    def load(self) -> dict:
+        """Read the state file, an empty state if it is missing or unreadable
+
+        :return: state dictionary, also kept in self.state
+        """
+        try:
+            with open(self.filename, "r") as stream:
+                self._written = stream.read()
+            self.state = json.loads(self._written)
+            if not isinstance(self.state, dict):
+                raise ValueError("state is not a dictionary")
+        except FileNotFoundError:
+            self.state = {}
+        except (OSError, ValueError) as exc:
+            LOGGER.warning("Ignoring unreadable state file %s: %s", self.filename, exc)
+            self.state = {}
+        return self.state
+
+    def update(self, **changes) -> bool:
+        """Merge changes in to the state and write it if anything changed
+
+        :param changes: state keys and values
+        :return: True if the file was written
+        """
+        self.state.update(changes)
+        return self.save()
+
+    def save(self) -> bool:
+        """Write the state if it differs from what was last written, via a synced temporary file and rename
+
+        :return: True if the file was written
+        """
+        text = json.dumps(self.state, sort_keys=True)
+        if text == self._written:
+            return False
+
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        temporary = None
+        try:
+            fd, temporary = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(self.filename),
+                                             suffix=".tmp")
+            with os.fdopen(fd, "w") as stream:
+                stream.write(text)
+                stream.flush()
+                os.fsync(stream.fileno())
+            os.replace(temporary, self.filename)
+
+            # make the rename itself durable
+            directory_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(directory_fd)
+            finally:
+                os.close(directory_fd)
+        except OSError as exc:
+            LOGGER.warning("Unable to write state file %s: %s", self.filename, exc)
+            if temporary is not None and os.path.exists(temporary):
+                os.unlink(temporary)
+            return False
+
+        self._written = text
+        return True
+
+
+def reconcile(document: dict, persistent_shadow: bool) -> dict:
+    """Decide what to take from the shadow document fetched after connecting, see precedence above
+
+    :param document: shadow document from a shadow get
+    :param persistent_shadow: persistentshadow setting from the ini file
+    :return: event dictionary, with "command" and/or "settings", to handle as if received from the shadow
+    """
+    state = document.get("state") or {}
+    desired = state.get("desired") or {}
+    event = {}
+    if desired.get("command"):
+        event["command"] = desired["command"]
+    if persistent_shadow and desired.get("persistentshadow"):
+        settings = desired.get("settings") or (state.get("reported") or {}).get("settings")
+        if settings:
+            event["settings"] = settings
+    return event
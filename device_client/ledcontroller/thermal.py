@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Thermal governor for WS281X LED effects
+
+thermal.py
+
+by Darren Dunford
+"""
+
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ThermalGovernor:
+    """Steps the render frame rate and effect detail down smoothly as the CPU approaches its throttling
+    temperature, and back up again as it cools
+
+    The governor is fed temperature samples by a daemon thread and is read by the effects on every frame,
+    so a sample only ever moves the throttle level by a limited step. Between the soft and hard limits the
+    level rises linearly from 0 (full frame rate, full detail) to 1 (minimum frame rate, minimum detail).
+    """
+
+    def __init__(self, soft_limit: float = 65.0, hard_limit: float = 78.0, max_fps: int = 50, min_fps: int = 10,
+                 min_detail: float = 0.25, smoothing: float = 0.3, max_step: float = 0.1):
+        """Initialise governor at full frame rate and detail
+
+        :param soft_limit: temperature (Celsius) at which the governor starts to step down
+        :param hard_limit: temperature (Celsius) at which frame rate and detail reach their minimums,
+            should be a few degrees below the firmware throttling temperature (80C on a Pi)
+        :param max_fps: target frames per second when cool
+        :param min_fps: target frames per second at or above the hard limit
+        :param min_detail: detail factor (0-1) at or above the hard limit, e.g. particle spawn rate multiplier
+        :param smoothing: weighting (0-1) given to each new sample in the moving average temperature
+        :param max_step: largest change in throttle level (0-1) allowed per sample
+        """
+
+        if hard_limit <= soft_limit:
+            raise ValueError("hard_limit must be above soft_limit")
+
+        self.soft_limit = soft_limit
+        self.hard_limit = hard_limit
+        self.max_fps = max_fps
+        self.min_fps = min(min_fps, max_fps)
+        self.min_detail = min_detail
+        self.smoothing = smoothing
+        self.max_step = max_step
+
+        self._lock = threading.Lock()
+        self.temperature = None
+        self.level = 0.0
+
+    def update(self, temperature: float):
+        """Feed a new temperature sample to the governor
+
+        :param temperature: CPU temperature in Celsius
+        :return: True if the throttle level changed
+        """
+
+        with self._lock:
+
+            # exponential moving average smooths out single sample spikes
+            if self.temperature is None:
+                self.temperature = temperature
+            else:
+                self.temperature += self.smoothing * (temperature - self.temperature)
+
+            # linear target level between soft and hard limits, approached a limited step at a time
+            target = (self.temperature - self.soft_limit) / (self.hard_limit - self.soft_limit)
+            target = min(max(target, 0.0), 1.0)
+            step = min(max(target - self.level, -self.max_step), self.max_step)
+            self.level = round(self.level + step, 3)
+
+        if step:
+            LOGGER.debug("Thermal governor level %.3f at %.1fC", self.level, self.temperature)
+        return step != 0
+
+    @property
+    def fps(self) -> float:
+        """Target frames per second at the current throttle level"""
+        return self.max_fps - self.level * (self.max_fps - self.min_fps)
+
+    @property
+    def frame_interval(self) -> float:
+        """Minimum time in seconds between frames at the current throttle level"""
+        return 1.0 / self.fps
+
+    @property
+    def detail(self) -> float:
+        """Effect detail factor (min_detail to 1) at the current throttle level"""
+        return 1.0 - self.level * (1.0 - self.min_detail)
+
+    def state(self) -> dict:
+        """Return governor state as a dictionary suitable for reporting to the device shadow
+
+        :return:
+        """
+        return {
+            "temperature": None if self.temperature is None else round(self.temperature, 1),
+            "level": self.level,
+            "fps": round(self.fps, 1),
+            "detail": round(self.detail, 2),
+        }
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""Shared time base for synchronised rendering across devices
+
+timebase.py
+
+by Darren Dunford
+
+Several strings, each on its own device, look like one installation when they render the same frame at the same
+instant. A RUN command carries the start time of the program as a Unix epoch and a seed; each device renders on
+a frame grid counted from that start, using its own clock corrected by ClockSync, and every effect is a
+deterministic function of time and seed: random choices come from hash_random() of the seed and a time slot
+counter rather than from a random number generator whose state depends on the frames rendered so far.
+
+Inter-device skew can be measured locally by running several simulated devices with deliberately wrong clocks
+against a stand-in NTP server:
+
+    python3 -m ledcontroller.timebase skew --devices 3 --seconds 5
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+import socket
+import struct
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+NTP_EPOCH = 2208988800  # seconds from 1900, the NTP epoch, to 1970
+NTP_PACKET = struct.Struct(">BBbb11I")  # flags, stratum, poll, precision, then 32-bit words
+NTP_CLIENT = 0x23  # leap indicator 0, version 4, mode 3 (client)
+NTP_SERVER = 0x24  # leap indicator 0, version 4, mode 4 (server)
+
+
+def _mix(z: int) -> int:
+    """splitmix64 finaliser, scrambling a 64-bit integer
+
+    :param z: integer
+    :return: scrambled 64-bit integer
+    """
+    z = (z + 0x9E3779B97F4A7C15) & MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+
+def hash_random(seed: int, *counters: int) -> float:
+    """Return a repeatable pseudo-random number 0-1 for a seed and counters, the same on every device
+
+    :param seed: seed shared by synchronised devices
+    :param counters: integers identifying the choice, e.g. time slot and which choice within it
+    :return: float in [0, 1)
+    """
+    h = _mix(seed & MASK64)
+    for counter in counters:
+        h = _mix(h ^ (counter & MASK64))
+    return (h >> 11) / float(1 << 53)
+
+
+def hash_choice(sequence, seed: int, *counters: int):
+    """Return a repeatable pseudo-random element of a sequence, see hash_random()
+
+    :param sequence: sequence to choose from
+    :param seed: seed shared by synchronised devices
+    :param counters: integers identifying the choice
+    :return: element of sequence
+    """
+    return sequence[int(hash_random(seed, *counters) * len(sequence))]
+
+
+class SlotSchedule:
+    """Events drawn per fixed time slot, so the events live at time t depend only on t and the seed
+
+    Time is divided in to slots, and spawn(k) returns the list of events starting in slot k (a pure function of
+    k, using hash_random). active(t) returns the events of every slot within lifetime of t. Slots are cached, so
+    each is only drawn once while rendering forwards.
+    """
+
+    def __init__(self, slot: float, lifetime: float, spawn):
+        """
+        :param slot: slot length in seconds
+        :param lifetime: how long an event lasts in seconds
+        :param spawn: function of slot number returning a list of events
+        """
+        self.slot = slot
+        self._span = int(math.ceil(lifetime / slot))
+        self._spawn = spawn
+        self._cache = {}
+
+    def active(self, t: float) -> list:
+        """Return events started in slots within lifetime of time t, oldest first
+
+        :param t: time in seconds
+        :return: list of events
+        """
+        last = int(math.floor(t / self.slot))
+        first = max(last - self._span, 1)
+        for k in [k for k in self._cache if k < first or k > last]:
+            del self._cache[k]
+        events = []
+        for k in range(first, last + 1):
+            if k not in self._cache:
+                self._cache[k] = self._spawn(k)
+            events.extend(self._cache[k])
+        return events
+
+
+def _to_ntp(t: float):
+    """Split a Unix time in to NTP seconds and fraction words"""
+    return int(t) + NTP_EPOCH, int((t % 1.0) * (1 << 32))
+
+
+def _from_ntp(seconds: int, fraction: int) -> float:
+    """Join NTP seconds and fraction words in to a Unix time"""
+    return seconds - NTP_EPOCH + fraction / float(1 << 32)
+
+
+class ClockSync:
+    """Estimates the offset of the local clock from an NTP server, giving a time base shared by devices"""
+
+    def __init__(self, server: str = "pool.ntp.org", port: int = 123, samples: int = 8, smoothing: float = 0.3,
+                 local_clock=time.time):
+        """
+        :param server: NTP server host name, or None to use the local clock uncorrected
+        :param port: NTP server port
+        :param samples: exchanges per sync, the one with the shortest round trip is used
+        :param smoothing: weight given to each new offset estimate after the first
+        :param local_clock: function returning local Unix time, replaced when simulating skewed clocks
+        """
+        self.server = server
+        self.port = port
+        self.samples = samples
+        self.smoothing = smoothing
+        self._local_clock = local_clock
+        self.offset = 0.0  # seconds to add to the local clock
+        self.delay = None  # round trip of the best exchange of the last sync in seconds
+        self.synced = None  # local time of the last successful sync
+
+    def time(self) -> float:
+        """Return corrected Unix time
+
+        :return:
+        """
+        return self._local_clock() + self.offset
+
+    def _request(self) -> (bytes, float):
+        """Build a client request, carrying its send time as the transmit timestamp
+
+        :return: (packet, send time)
+        """
+        sent = self._local_clock()
+        return NTP_PACKET.pack(NTP_CLIENT, 0, 0, 0, *([0] * 9), *_to_ntp(sent)), sent
+
+    @staticmethod
+    def measure(request: bytes, response: bytes, sent: float, received: float):
+        """Compute clock offset and round trip delay from one exchange
+
+        :param request: packet sent
+        :param response: packet received
+        :param sent: local time the request was sent
+        :param received: local time the response was received
+        :return: (offset, delay) in seconds, or None if the response does not answer the request
+        """
+        if len(response) < NTP_PACKET.size:
+            return None
+        fields = NTP_PACKET.unpack_from(response)
+        if fields[0] & 0x07 != 4 or fields[1] == 0 or response[24:32] != request[40:48]:
+            return None  # not a server reply, kiss-of-death, or a reply to another request
+        server_received = _from_ntp(fields[11], fields[12])
+        server_sent = _from_ntp(fields[13], fields[14])
+        offset = ((server_received - sent) + (server_sent - received)) / 2
+        delay = (received - sent) - (server_sent - server_received)
+        return offset, delay
+
+    async def sync(self, timeout: float = 1.0) -> bool:
+        """Exchange packets with the server and update the offset estimate
+
+        :param timeout: seconds to wait for each reply
+        :return: True if the offset was updated
+        """
+        if not self.server:
+            return False
+        loop = asyncio.get_running_loop()
+        try:
+            addresses = await loop.getaddrinfo(self.server, self.port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+            address = addresses[0][4]
+        except OSError as exc:
+            LOGGER.warning("Unable to resolve NTP server %s: %s", self.server, exc)
+            return False
+
+        best = None
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.connect(address)
+            for _ in range(self.samples):
+                request, sent = self._request()
+                try:
+                    await loop.sock_sendall(sock, request)
+                    response = await asyncio.wait_for(loop.sock_recv(sock, 512), timeout)
+                except (OSError, asyncio.TimeoutError):
+                    continue
+                sample = self.measure(request, response, sent, self._local_clock())
+                if sample and (best is None or sample[1] < best[1]):
+                    best = sample
+                await asyncio.sleep(0.05)
+
+        if best is None:
+            LOGGER.warning("No reply from NTP server %s", self.server)
+            return False
+        offset, self.delay = best
+        self.offset = offset if self.synced is None else self.offset + self.smoothing * (offset - self.offset)
+        self.synced = self._local_clock()
+        LOGGER.debug("Clock offset %.1f ms, round trip %.1f ms", self.offset * 1000, self.delay * 1000)
+        return True
+
+    def state(self) -> dict:
+        """Return a dictionary describing the clock correction, for reporting
+
+        :return:
+        """
+        return {
+            "server": self.server,
+            "offset_ms": round(self.offset * 1000, 2),
+            "delay_ms": None if self.delay is None else round(self.delay * 1000, 2),
+            "synced": self.synced is not None,
+        }
+
+
+def serve_ntp(sock: socket.socket, clock=time.time):
+    """Answer NTP client requests on a bound UDP socket from the given clock, for local testing
+
+    :param sock: bound UDP socket
+    :param clock: reference clock
+    :return:
+    """
+    while True:
+        try:
+            request, address = sock.recvfrom(512)
+        except OSError:
+            return
+        received = clock()
+        if len(request) < NTP_PACKET.size:
+            continue
+        origin = NTP_PACKET.unpack_from(request)[13:15]
+        reply = NTP_PACKET.pack(NTP_SERVER, 1, 0, -20, 0, 0, 0, 0, 0, *origin, *_to_ntp(received), *_to_ntp(clock()))
+        sock.sendto(reply, address)
+
+
+def measure_skew(devices: int = 3, seconds: float = 5, effect: str = "Christmas1", max_skew: float = 0.05,
+                 num_pixels: int = 643):
+    """Run simulated devices with skewed clocks on one program and measure when each shows the same frame
+
+    Each device gets a local clock wrong by up to max_skew seconds and corrects it against a stand-in NTP
+    server on localhost. All devices are given the same start epoch and seed, as a RUN command would.
+
+    :param devices: number of simulated devices
+    :param seconds: how long to run
+    :param effect: effect to run
+    :param max_skew: largest clock error in seconds
+    :param num_pixels: pixels per device
+    :return:
+    """
+    import random
+    import threading
+    import zlib
+    from ledcontroller.effects import LightEffect, LockingPixelStrip
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    threading.Thread(target=serve_ntp, args=(server,), daemon=True).start()
+
+    class RecordingStrip(LockingPixelStrip):
+        """Simulated strip recording the true time each distinct frame is shown"""
+
+        def __init__(self):
+            super().__init__(num_pixels, 18, 800000, 10, False, 255, 0)
+            self.frames = {}
+
+        def show(self):
+            super().show()
+            self.frames.setdefault(zlib.crc32(self.pixel_buffer().tobytes()), time.time())
+
+    for corrected in (False, True):
+        strips, threads = [], []
+        start = time.time() + 1.0
+        for n in range(devices):
+            skew = random.uniform(-max_skew, max_skew)
+            clock = ClockSync("127.0.0.1", server.getsockname()[1],
+                              local_clock=lambda skew=skew: time.time() + skew)
+            if corrected:
+                asyncio.run(clock.sync())
+            strip = RecordingStrip()
+            thread = LightEffect(strip, program=[{"effect": effect}], clock=clock.time, start=start, seed=1234)
+            strips.append(strip)
+            threads.append(thread)
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds + 1.0)
+        for thread in threads:
+            thread.stop()
+        for thread in threads:
+            thread.join()
+
+        common = set.intersection(*(set(strip.frames) for strip in strips))
+        skews = sorted(max(s.frames[f] for s in strips) - min(s.frames[f] for s in strips) for f in common)
+        shown = max(len(strip.frames) for strip in strips)
+        label = "corrected  " if corrected else "uncorrected"
+        if skews:
+            print(f"{label}: {len(common)}/{shown} frames shown by all {devices} devices, skew median "
+                  f"{skews[len(skews) // 2] * 1000:.2f} ms, max {skews[-1] * 1000:.2f} ms")
+        else:
+            print(f"{label}: no frame shown by all {devices} devices")
+    server.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synchronised rendering tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    skew_parser = commands.add_parser("skew", help="measure inter-device frame skew with simulated devices")
+    skew_parser.add_argument("--devices", type=int, default=3)
+    skew_parser.add_argument("--seconds", type=float, default=5)
+    skew_parser.add_argument("--effect", default="Christmas1")
+    skew_parser.add_argument("--max-skew", type=float, default=0.05, help="largest clock error in seconds")
+    args = parser.parse_args()
+    measure_skew(args.devices, args.seconds, args.effect, args.max_skew)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Command-to-photon latency tracing across the control path
+
+tracing.py
+
+by Darren Dunford
+
+A command may carry a trace, {"id": ..., "issued": ...}, added by the API when it writes the command to the
+shadow. The device stamps the trace at each stage the command passes through on its way to the strip
+
+    issued      API Lambda, before update_thing_shadow
+    received    shadow delta callback, on the SDK's thread
+    handled     control loop, as the command is handled
+    picked_up   render thread, as it takes the new program
+    cleared     render thread, previous program's lights cleared
+    prepared    render thread, first effect of the new program constructed
+    shown       render thread, first frame of the new program shown
+
+and reports the time spent reaching each stage from the one before in the shadow's reported state. Device
+stages are stamped with the clock corrected by ClockSync, so the broker stage is comparable with the API's own
+timestamp only to within the clock correction.
+
+The whole path from shadow update to first frame can be exercised locally against a stand-in broker and a
+simulated strip:
+
+    python3 -m ledcontroller.tracing harness --commands 20
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import threading
+import time
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+STAGES = ("issued", "received", "handled", "picked_up", "cleared", "prepared", "shown")
+
+
+class CommandTrace:
+    """Timestamps of one traced command at each stage of the control path"""
+
+    def __init__(self, trace: dict, clock=time.time):
+        """
+        :param trace: trace dictionary carried by the command, with "id" and optionally "issued" (Unix time)
+        :param clock: function returning the time used to stamp stages
+        """
+        self.id = str(trace.get("id"))[:64]
+        self._clock = clock
+        self.times = {}
+        issued = trace.get("issued")
+        if isinstance(issued, (int, float)) and not isinstance(issued, bool):
+            self.times["issued"] = float(issued)
+
+    @classmethod
+    def from_command(cls, command, clock=time.time):
+        """Return a trace for a command carrying one, stamped as received, otherwise None
+
+        :param command: command dictionary
+        :param clock: function returning the time used to stamp stages
+        :return: CommandTrace or None
+        """
+        if not isinstance(command, dict) or not isinstance(command.get("trace"), dict):
+            return None
+        trace = cls(command["trace"], clock)
+        trace.mark("received")
+        return trace
+
+    def mark(self, stage: str):
+        """Record the time a stage is reached
+
+        :param stage: one of STAGES
+        :return:
+        """
+        self.times[stage] = self._clock()
+
+    def report(self) -> dict:
+        """Return milliseconds taken to reach each stage from the previous stage recorded, for the shadow
+
+        :return:
+        """
+        stages = {}
+        reached = [stage for stage in STAGES if stage in self.times]
+        for previous, stage in zip(reached, reached[1:]):
+            stages[stage] = round((self.times[stage] - self.times[previous]) * 1000, 1)
+        total = round((self.times[reached[-1]] - self.times[reached[0]]) * 1000, 1) if reached else None
+        return {"id": self.id, "stages_ms": stages, "total_ms": total, "from": reached[0] if reached else None}
+
+
+class StandInBroker:
+    """Stands in for the shadow service and the device's shadow handler, for running the path locally
+
+    update_thing_shadow() takes a desired state document as the API Lambda sends it and, after a simulated
+    broker delay, delivers the delta to the registered delta callback on the broker's own thread, as the SDK
+    does. Reported state written back by the device is merged in to self.reported.
+    """
+
+    def __init__(self, delay: float = 0.05):
+        """
+        :param delay: simulated broker delay from shadow update to delta delivery in seconds
+        """
+        self.delay = delay
+        self.reported = {}
+        self.reported_changed = threading.Condition()
+        self._delta = None
+
+    def shadowRegisterDeltaCallback(self, callback):
+        self._delta = callback
+
+    def shadowUpdate(self, payload: str, callback, timeout: int):
+        reported = (json.loads(payload).get("state") or {}).get("reported") or {}
+        with self.reported_changed:
+            self.reported.update(reported)
+            self.reported_changed.notify_all()
+
+    def shadowGet(self, callback, timeout: int):
+        callback(json.dumps({"state": {"reported": self.reported}}), "accepted", None)
+
+    def update_thing_shadow(self, payload: str):
+        desired = json.loads(payload)["state"]["desired"]
+        delta = json.dumps({"state": desired, "timestamp": int(time.time())})
+        threading.Timer(self.delay, self._delta, (delta, None, None)).start()
+
+
+def harness(commands: int = 20, interval: float = 1.0, broker_delay: float = 0.05, num_pixels: int = 643):
+    """Drive traced commands through the control path against a stand-in broker and simulated strip
+
+    The device side is the real DeviceShadowHandler, an asyncio control loop handing events to
+    LightEffect.play() as the controller does, and the render thread showing frames on a simulated strip. The
+    reported trace is read back from the stand-in shadow, as the web UI would read it.
+
+    :param commands: number of EFFECT commands to send
+    :param interval: seconds between commands
+    :param broker_delay: simulated broker delay in seconds
+    :param num_pixels: pixels on the simulated strip
+    :return:
+    """
+    import statistics
+    from ledcontroller.deviceshadowhandler import DeviceShadowHandler
+    from ledcontroller.effects import LightEffect, LockingPixelStrip
+
+    broker = StandInBroker(broker_delay)
+    device = DeviceShadowHandler("harness", "localhost", "", "", "")
+    device.shadow_handler = broker
+    device.connected.set()
+    broker.shadowRegisterDeltaCallback(device.custom_shadow_callback_delta)
+
+    strip = LockingPixelStrip(num_pixels, 18, 800000, 10, False, 255, 0)
+    strip.begin()
+    lights = LightEffect(strip, effect=0)
+    lights.start()
+
+    async def control_loop():
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        device.on_event = lambda event: loop.call_soon_threadsafe(events.put_nowait, event)
+        lights.on_trace = device.on_event
+        while True:
+            event = await events.get()
+            trace = event.get("trace")
+            if event.get("command"):
+                trace.mark("handled")
+                lights.play(effect=event["command"]["effect"], trace=trace)
+            elif event.get("traced"):
+                device.post_trace(event["traced"].report())
+
+    threading.Thread(target=asyncio.run, args=(control_loop(),), daemon=True).start()
+    time.sleep(0.5)
+
+    reports = []
+    for n in range(commands):
+        trace = {"id": uuid.uuid4().hex, "issued": time.time()}
+        effect = ("RainbowCycle", "TestPattern")[n % 2]
+        broker.update_thing_shadow(json.dumps({"state": {"desired": {"command": {
+            "action": "EFFECT", "effect": effect, "trace": trace}}}}))
+        with broker.reported_changed:
+            if broker.reported_changed.wait_for(lambda: broker.reported.get("trace", {}).get("id") == trace["id"],
+                                                timeout=5):
+                reports.append(broker.reported["trace"])
+        time.sleep(interval)
+    lights.stop()
+    lights.join()
+
+    if not reports:
+        print("no traces reported")
+        return
+    print(f"{len(reports)}/{commands} traced commands reported, {num_pixels} pixels, broker delay "
+          f"{broker_delay * 1000:.0f} ms")
+    for stage in STAGES[1:] + ("total",):
+        values = sorted(r["total_ms"] if stage == "total" else r["stages_ms"].get(stage, 0.0) for r in reports)
+        print(f"  {stage:10} median {statistics.median(values):7.1f} ms, max {values[-1]:7.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Command latency tracing tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    harness_parser = commands.add_parser("harness", help="trace commands through a stand-in broker")
+    harness_parser.add_argument("--commands", type=int, default=20)
+    harness_parser.add_argument("--interval", type=float, default=1.0, help="seconds between commands")
+    harness_parser.add_argument("--broker-delay", type=float, default=0.05, help="simulated broker delay, s")
+    harness_parser.add_argument("--pixels", type=int, default=643)
+    args = parser.parse_args()
+    harness(args.commands, args.interval, args.broker_delay, args.pixels)
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""Ingest of pixel frames streamed over UDP by an external renderer
+
+udpstream.py
+
+by Darren Dunford
+
+Two protocols are accepted:
+
+    native  one datagram per frame: 4s magic "WSPX", I sequence number (little endian), then 3 bytes of packed
+            GRB per pixel starting at pixel 0, as written by animation.pack_grb()
+    e131    E1.31 (sACN) data packets, 170 RGB pixels per universe, the first universe holding pixels 0-169
+
+Frames are received in to preallocated buffers and unpacked straight in to the strip buffer with numpy. Under
+overload only the newest queued frame is shown, and frames older than the last one shown are dropped.
+
+Localhost tools:
+
+    python3 -m ledcontroller.udpstream send --fps 50 --seconds 10
+    python3 -m ledcontroller.udpstream benchmark
+"""
+
+import argparse
+import logging
+import select
+import socket
+import struct
+import time
+
+import numpy
+
+from ledcontroller.animation import pack_grb, unpack_grb
+
+LOGGER = logging.getLogger(__name__)
+
+PROTOCOLS = ("native", "e131")
+DEFAULT_PORTS = {"native": 7777, "e131": 5568}
+
+MAGIC = b"WSPX"
+HEADER = struct.Struct("<4sI")
+SEQUENCE_WINDOW = 20  # native frames this far behind the last shown are stale, further behind is a sender restart
+RESTART_GAP = 1.0  # seconds without a frame shown after which any sequence number is accepted, as from a restart
+
+E131_ID = b"ASC-E1.17\x00\x00\x00"
+E131_ROOT_VECTOR = 0x00000004
+E131_FRAMING_VECTOR = 0x00000002
+E131_DATA = 126  # offset of the first DMX slot after the start code
+E131_PIXELS_PER_UNIVERSE = 170
+E131_SEQUENCE_WINDOW = 20  # per E1.31, packets up to 20 behind the last are out of order and discarded
+E131_TERMINATED = 0x40  # options bit set by a source that has stopped sending
+
+MAX_DATAGRAM = 65536
+
+
+def unpack_rgb(packed: numpy.ndarray, out: numpy.ndarray):
+    """Unpack RGB bytes, as sent in DMX slots, in to 24-bit colour values in place
+
+    :param packed: numpy uint8 array of pixel count x 3 RGB bytes
+    :param out: numpy uint32 array of pixel count colour values to write to
+    :return:
+    """
+    numpy.copyto(out, packed[1::3])
+    out <<= 8
+    out |= packed[0::3]
+    out <<= 8
+    out |= packed[2::3]
+
+
+def is_stale(sequence: int, last: int, modulus: int, window: int) -> bool:
+    """Return True if a sequence number repeats or is behind the last accepted one, allowing for wrap around
+
+    :param sequence: sequence number received
+    :param last: last sequence number accepted, or None
+    :param modulus: sequence number range
+    :param window: how far behind counts as stale rather than a restarted sender
+    :return:
+    """
+    return last is not None and (last - sequence) % modulus < window
+
+
+class StreamReceiver:
+    """Non-blocking UDP socket receiving frames in to preallocated buffers"""
+
+    def __init__(self, num_pixels: int, port: int = None, protocol: str = "native", universe: int = 1,
+                 host: str = "0.0.0.0", queued_frames: int = 4):
+        """Open and bind socket
+
+        :param num_pixels: number of pixels on the strip
+        :param port: UDP port, defaults to 7777 for native and 5568 for E1.31
+        :param protocol: "native" or "e131"
+        :param universe: E1.31 universe holding pixels 0-169, following universes hold the following pixels
+        :param host: address to bind to
+        :param queued_frames: kernel receive buffer size in frames, bounding how far behind a backlog can get
+        """
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"unknown stream protocol: {protocol}")
+        self.num_pixels = num_pixels
+        self.protocol = protocol
+        self.universe = universe
+        self.port = port or DEFAULT_PORTS[protocol]
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                queued_frames * max(HEADER.size + num_pixels * 3, 4096))
+        self._socket.setblocking(False)
+        self._socket.bind((host, self.port))
+
+        # two receive buffers, so the newest valid frame is kept while the next datagram is read
+        self._buffers = [bytearray(MAX_DATAGRAM), bytearray(MAX_DATAGRAM)]
+        self._arrays = [numpy.frombuffer(buffer, dtype=numpy.uint8) for buffer in self._buffers]
+        self._spare = 0
+        self._sequence = None
+        self._sequences = {}  # E1.31 sequence number by universe
+
+        self.opened = time.time()
+        self.last_frame_time = None  # time.time() the last frame (or E1.31 packet) was written to the strip
+        self.terminated = False  # set when an E1.31 source signals it has stopped
+        self.stats = {"received": 0, "applied": 0, "superseded": 0, "stale": 0, "invalid": 0}
+
+    def receive(self, out: numpy.ndarray, timeout: float) -> bool:
+        """Wait for frames and write the newest to the strip buffer
+
+        :param out: numpy uint32 strip buffer
+        :param timeout: longest time to wait for a datagram in seconds
+        :return: True if the strip buffer was changed
+        """
+        ready, _, _ = select.select([self._socket], [], [], timeout)
+        if not ready:
+            return False
+        if self.last_frame_time is not None and time.time() - self.last_frame_time > RESTART_GAP:
+            self._sequence = None  # a sender restarted after a pause may resume at any sequence number
+            self._sequences.clear()
+        if self.protocol == "e131":
+            return self._receive_e131(out)
+        return self._receive_native(out)
+
+    def _datagrams(self):
+        """Read queued datagrams, each in to the spare buffer, until none are left
+
+        :return: generator of (buffer index, length)
+        """
+        while True:
+            try:
+                length = self._socket.recv_into(self._buffers[self._spare])
+            except BlockingIOError:
+                return
+            self.stats["received"] += 1
+            yield self._spare, length
+
+    def _receive_native(self, out: numpy.ndarray) -> bool:
+        latest = None
+        for index, length in self._datagrams():
+            buffer = self._buffers[index]
+            if length < HEADER.size or HEADER.unpack_from(buffer)[0] != MAGIC:
+                self.stats["invalid"] += 1
+                continue
+            sequence = HEADER.unpack_from(buffer)[1]
+            if is_stale(sequence, self._sequence, 1 << 32, SEQUENCE_WINDOW):
+                self.stats["stale"] += 1
+                continue
+            if latest is not None:
+                self.stats["superseded"] += 1
+            self._sequence = sequence
+            latest = index, length
+            self._spare ^= 1  # keep this frame, read the next datagram in to the other buffer
+
+        if latest is None:
+            return False
+        index, length = latest
+        count = min((length - HEADER.size) // 3, self.num_pixels)
+        unpack_grb(self._arrays[index][HEADER.size:HEADER.size + count * 3], out[:count])
+        self.stats["applied"] += 1
+        self.last_frame_time = time.time()
+        return True
+
+    def _receive_e131(self, out: numpy.ndarray) -> bool:
+        changed = False
+        for index, length in self._datagrams():
+            buffer = self._buffers[index]
+            if (length <= E131_DATA or buffer[4:16] != E131_ID
+                    or struct.unpack_from(">I", buffer, 18)[0] != E131_ROOT_VECTOR
+                    or struct.unpack_from(">I", buffer, 40)[0] != E131_FRAMING_VECTOR or buffer[125] != 0):
+                self.stats["invalid"] += 1
+                continue
+            if buffer[112] & E131_TERMINATED:
+                self.terminated = True
+                continue
+
+            universe = struct.unpack_from(">H", buffer, 113)[0]
+            first = (universe - self.universe) * E131_PIXELS_PER_UNIVERSE
+            if not 0 <= first < self.num_pixels:
+                continue
+            if is_stale(buffer[111], self._sequences.get(universe), 256, E131_SEQUENCE_WINDOW):
+                self.stats["stale"] += 1
+                continue
+            self._sequences[universe] = buffer[111]
+
+            slots = min(struct.unpack_from(">H", buffer, 123)[0] - 1, length - E131_DATA)
+            count = min(slots // 3, self.num_pixels - first)
+            unpack_rgb(self._arrays[index][E131_DATA:E131_DATA + count * 3], out[first:first + count])
+            self.stats["applied"] += 1
+            changed = True
+
+        if changed:
+            self.last_frame_time = time.time()
+        return changed
+
+    def close(self):
+        self._socket.close()
+
+
+def native_packet(sequence: int, frame: numpy.ndarray) -> bytes:
+    """Build a native protocol datagram
+
+    :param sequence: frame sequence number
+    :param frame: numpy uint32 array of colour values
+    :return:
+    """
+    return HEADER.pack(MAGIC, sequence & 0xFFFFFFFF) + pack_grb(frame)
+
+
+def e131_packets(sequence: int, frame: numpy.ndarray, universe: int = 1):
+    """Build E1.31 data packets carrying a frame, one per universe
+
+    :param sequence: sequence number, the low 8 bits are sent
+    :param frame: numpy uint32 array of colour values
+    :param universe: universe holding pixels 0-169
+    :return: list of datagrams
+    """
+    grb = numpy.frombuffer(pack_grb(frame), dtype=numpy.uint8).reshape(-1, 3)
+    rgb = grb[:, [1, 0, 2]].tobytes()
+    packets = []
+    for k, first in enumerate(range(0, len(frame), E131_PIXELS_PER_UNIVERSE)):
+        slots = rgb[first * 3:(first + E131_PIXELS_PER_UNIVERSE) * 3]
+        packet = bytearray(E131_DATA + len(slots))
+        struct.pack_into(">HH12s", packet, 0, 0x0010, 0, E131_ID)
+        struct.pack_into(">HI16s", packet, 16, 0x7000 | (len(packet) - 16), E131_ROOT_VECTOR, b"ws281x-stream")
+        struct.pack_into(">HI", packet, 38, 0x7000 | (len(packet) - 38), E131_FRAMING_VECTOR)
+        packet[44:108] = b"ws281x".ljust(64, b"\x00")
+        struct.pack_into(">BHBBH", packet, 108, 100, 0, sequence & 0xFF, 0, universe + k)
+        struct.pack_into(">HBBHHH", packet, 115, 0x7000 | (len(packet) - 115), 0x02, 0xA1, 0, 1, len(slots) + 1)
+        packet[E131_DATA:] = slots
+        packets.append(bytes(packet))
+    return packets
+
+
+def send(host: str = "127.0.0.1", port: int = None, protocol: str = "native", fps: float = 50,
+         seconds: float = 10, num_pixels: int = 643):
+    """Send a moving rainbow test stream
+
+    :param host: receiver address
+    :param port: receiver port, defaults to the protocol's default
+    :param protocol: "native" or "e131"
+    :param fps: frames per second, 0 to send as fast as possible
+    :param seconds: how long to send for
+    :param num_pixels: pixels per frame
+    :return: number of frames sent
+    """
+    from ledcontroller.expressions import hsv_to_colors
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = (host, port or DEFAULT_PORTS[protocol])
+    frame = numpy.zeros(num_pixels, dtype=numpy.uint32)
+    position = numpy.arange(num_pixels) / num_pixels
+    start = time.time()
+    sequence = 0
+    while time.time() - start < seconds:
+        hsv_to_colors(position + sequence / 100, 1.0, 1.0, frame)
+        packets = [native_packet(sequence, frame)] if protocol == "native" else e131_packets(sequence, frame)
+        for packet in packets:
+            sock.sendto(packet, address)
+        sequence += 1
+        if fps:
+            time.sleep(max(start + sequence / fps - time.time(), 0))
+    sock.close()
+    return sequence
+
+
+def benchmark(seconds: float = 5, num_pixels: int = 643, protocol: str = "native"):
+    """Stream frames over localhost as fast as possible to a simulated strip with WS281x wire timing
+
+    show() sleeps for the time the frame takes on the wire (30 us per pixel plus 50 us reset), so the frame
+    rate shown should be limited by the wire and not by receiving.
+
+    :param seconds: how long to stream for
+    :param num_pixels: pixels per frame
+    :param protocol: "native" or "e131"
+    :return:
+    """
+    import threading
+    from ledcontroller.simulatedstrip import SimulatedPixelStrip
+
+    wire_time = num_pixels * 30e-6 + 50e-6
+    receiver = StreamReceiver(num_pixels, protocol=protocol, host="127.0.0.1")
+    strip = SimulatedPixelStrip(num_pixels)
+    sender = threading.Thread(target=send, kwargs=dict(protocol=protocol, fps=0, seconds=seconds,
+                                                       num_pixels=num_pixels), daemon=True)
+    sender.start()
+
+    costs = []
+    shown = 0
+    start = time.time()
+    while sender.is_alive():
+        received = time.perf_counter()
+        if receiver.receive(strip.pixel_buffer(), 0.1):
+            costs.append(time.perf_counter() - received)
+            strip.show()
+            time.sleep(wire_time)
+            shown += 1
+    elapsed = time.time() - start
+    receiver.close()
+
+    costs = numpy.array(costs) * 1000
+    print(f"{protocol}, {num_pixels} pixels: {shown / elapsed:.1f} fps shown, wire limit {1 / wire_time:.1f} fps")
+    print(f"receive and unpack per frame: median {numpy.median(costs):.3f} ms, "
+          f"99th percentile {numpy.percentile(costs, 99):.3f} ms")
+    print(", ".join(f"{key} {value}" for key, value in receiver.stats.items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UDP pixel stream tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    send_parser = commands.add_parser("send", help="send a test stream")
+    send_parser.add_argument("--host", default="127.0.0.1")
+    send_parser.add_argument("--port", type=int)
+    send_parser.add_argument("--fps", type=float, default=50, help="frames per second, 0 for as fast as possible")
+    bench_parser = commands.add_parser("benchmark", help="measure frame rate over localhost")
+    for command_parser in (send_parser, bench_parser):
+        command_parser.add_argument("--protocol", choices=PROTOCOLS, default="native")
+        command_parser.add_argument("--seconds", type=float, default=5)
+        command_parser.add_argument("--pixels", type=int, default=643)
+    args = parser.parse_args()
+    if args.command == "send":
+        print(f"sent {send(args.host, args.port, args.protocol, args.fps, args.seconds, args.pixels)} frames")
+    else:
+        benchmark(args.seconds, args.pixels, args.protocol)
@@ -0,0 +1,11 @@
+"""pytest configuration, makes the ledcontroller package importable when tests are run from any directory
+
+conftest.py
+
+by Darren Dunford
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
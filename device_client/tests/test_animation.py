@@ -0,0 +1,96 @@
+"""Animation file encode and decode, with and without delta compression
+
+test_animation.py
+
+by Darren Dunford
+"""
+
+import numpy
+import pytest
+
+from ledcontroller.animation import DELTA_FRAME, Animation, AnimationWriter, bake, pack_grb, render_frames, unpack_grb
+
+NUM_PIXELS = 100
+
+
+def sparse_frames(count: int) -> list:
+    """Frames in which a few pixels change each frame, as a delta compressed file is meant for"""
+    random = numpy.random.default_rng(7)
+    frame = random.integers(0, 1 << 24, NUM_PIXELS, dtype=numpy.uint32)
+    frames = []
+    for _ in range(count):
+        frame = frame.copy()
+        frame[random.integers(0, NUM_PIXELS, 4)] = random.integers(0, 1 << 24, 4, dtype=numpy.uint32)
+        frame[10:14] ^= 0x010101  # a short run
+        frames.append(frame)
+    return frames
+
+
+def write(filename: str, frames: list, **kwargs):
+    with AnimationWriter(filename, 25, NUM_PIXELS, **kwargs) as writer:
+        for frame in frames:
+            writer.write(frame)
+
+
+def test_pack_unpack_round_trip():
+    frame = numpy.array([0x000000, 0xFFFFFF, 0x123456, 0xFF0080], dtype=numpy.uint32)
+    out = numpy.zeros(4, dtype=numpy.uint32)
+    unpack_grb(numpy.frombuffer(pack_grb(frame), dtype=numpy.uint8), out)
+    numpy.testing.assert_array_equal(out, frame)
+
+
+@pytest.mark.parametrize("delta", [False, True])
+def test_frames_round_trip_in_order(tmp_path, delta):
+    frames = sparse_frames(60)
+    filename = str(tmp_path / "sparse.wsa")
+    write(filename, frames, delta=delta, keyframe_interval=25)
+    animation = Animation(filename)
+    try:
+        assert (animation.fps, animation.num_pixels, animation.frame_count) == (25, NUM_PIXELS, 60)
+        deltas = [bool(length & DELTA_FRAME) for _, length in animation._index.tolist()]
+        assert any(deltas) == delta
+        assert not deltas[0] and not deltas[25] and not deltas[50]  # key frames
+        for k, frame in enumerate(frames):
+            numpy.testing.assert_array_equal(animation.seek(k), frame)
+    finally:
+        animation.close()
+
+
+def test_delta_frames_seek_backwards_and_skip_ahead(tmp_path):
+    frames = sparse_frames(60)
+    filename = str(tmp_path / "sparse.wsa")
+    write(filename, frames, delta=True, keyframe_interval=25)
+    animation = Animation(filename)
+    try:
+        for k in (40, 3, 59, 26, 25, 24, 0, 49, 30):
+            numpy.testing.assert_array_equal(animation.seek(k), frames[k])
+    finally:
+        animation.close()
+
+
+def test_delta_file_smaller_for_sparse_changes(tmp_path):
+    frames = sparse_frames(60)
+    write(str(tmp_path / "full.wsa"), frames)
+    write(str(tmp_path / "delta.wsa"), frames, delta=True)
+    assert (tmp_path / "delta.wsa").stat().st_size < (tmp_path / "full.wsa").stat().st_size / 2
+
+
+def test_rejects_other_files(tmp_path):
+    filename = tmp_path / "not.wsa"
+    filename.write_bytes(b"RIFF" + bytes(100))
+    with pytest.raises(ValueError):
+        Animation(str(filename))
+
+
+def test_baked_program_plays_back_as_rendered(tmp_path):
+    program = [{"effect": "RainbowCycle", "duration": 0.5}, {"effect": "Christmas2"}]
+    expected = [frame.copy() for frame in render_frames(program, {}, NUM_PIXELS, 50, 1)]
+    filename = str(tmp_path / "baked.wsa")
+    bake(filename, program, num_pixels=NUM_PIXELS, fps=50, duration=1, delta=True)
+    animation = Animation(filename)
+    try:
+        assert animation.frame_count == len(expected) == 50
+        for k, frame in enumerate(expected):
+            numpy.testing.assert_array_equal(animation.seek(k), frame)
+    finally:
+        animation.close()
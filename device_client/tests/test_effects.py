@@ -0,0 +1,218 @@
+"""Stop-to-dark latency and teardown of registered effects on the simulated strip
+
+test_effects.py
+
+by Darren Dunford
+
+Every effect must leave the strip dark within one frame of the render thread being stopped, or of OFF being
+played, whatever it was doing at the time, and must release anything it holds open once its step ends.
+"""
+
+import os
+import socket
+import threading
+import time
+import wave
+
+import numpy
+import pytest
+
+from ledcontroller.animation import bake
+from ledcontroller.audio import AudioAnalyser
+from ledcontroller.effects import EFFECTS, LightEffect, LockingPixelStrip
+from ledcontroller.udpstream import StreamReceiver, native_packet
+
+NUM_PIXELS = 50
+ONE_FRAME = 1 / 50  # one frame at the default maximum frame rate
+SLACK = 0.01  # allowance for thread scheduling on a loaded machine
+
+EFFECT_NAMES = sorted({cls.name for cls in EFFECTS.values()} - {"PipelineBenchmark"})
+
+
+class RecordingStrip(LockingPixelStrip):
+    """Simulated strip recording the time of every dark frame shown"""
+
+    def __init__(self):
+        super().__init__(NUM_PIXELS, 18, 800000, 10, False, 255, 0)
+        self.dark_at = []
+
+    def show(self):
+        super().show()
+        if not self.pixel_buffer().any():
+            self.dark_at.append(time.time())
+
+
+@pytest.fixture
+def step(request, tmp_path):
+    """Program step running the effect named by the test parameter, with any files or stream it needs"""
+    name = request.param
+    sending = threading.Event()
+    step = {"effect": name}
+    if name == "Playback":
+        step["file"] = str(tmp_path / "rainbow.wsa")
+        bake(step["file"], [{"effect": "RainbowCycle"}], num_pixels=NUM_PIXELS, duration=1)
+    elif name == "MusicSync":
+        step.update({"file": str(tmp_path / "tone.wav"), "channels": 1})
+        samples = (numpy.sin(numpy.arange(44100 * 5) * 2 * numpy.pi * 440 / 44100) * 10000).astype("<i2")
+        with wave.open(step["file"], "wb") as stream:
+            stream.setnchannels(1)
+            stream.setsampwidth(2)
+            stream.setframerate(44100)
+            stream.writeframes(samples.tobytes())
+    elif name == "Expression":
+        step.update({"hue": "x + t", "value": "tri(x * 4 + t)"})
+    elif name == "Stream":
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.bind(("127.0.0.1", 0))
+            step.update({"port": probe.getsockname()[1], "timeout": 30})
+        sending.set()
+        threading.Thread(target=send_frames, args=(step["port"], sending), daemon=True).start()
+    yield step
+    sending.clear()
+
+
+def send_frames(port: int, sending: threading.Event):
+    """Stream lit frames to a Stream effect at 50 fps while sending is set
+
+    :param port: UDP port the effect listens on
+    :param sending: cleared to stop sending
+    :return:
+    """
+    frame = numpy.full(NUM_PIXELS, 0x204080, dtype=numpy.uint32)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+        sequence = 0
+        while sending.is_set():
+            sender.sendto(native_packet(sequence, frame), ("127.0.0.1", port))
+            sequence += 1
+            time.sleep(ONE_FRAME)
+
+
+def dark_latency(strip: RecordingStrip, action) -> float:
+    """Return seconds from calling action until the strip shows a dark frame
+
+    :param strip: strip being rendered to
+    :param action: function stopping or switching the render thread
+    :return:
+    """
+    time.sleep(0.3)  # well in to the effect
+    requested = time.time()
+    action()
+    deadline = requested + 1
+    while time.time() < deadline:
+        dark = [t for t in strip.dark_at if t >= requested]
+        if dark:
+            return dark[0] - requested
+        time.sleep(0.001)
+    pytest.fail("strip not dark within 1 s")
+
+
+def start_lights(step: dict):
+    strip = RecordingStrip()
+    strip.begin()
+    lights = LightEffect(strip, program=[step])
+    lights.start()
+    assert strip.first_frame.wait(2)
+    return strip, lights
+
+
+@pytest.mark.parametrize("step", EFFECT_NAMES, indirect=True)
+def test_dark_within_one_frame_of_stop(step):
+    strip, lights = start_lights(step)
+    try:
+        assert dark_latency(strip, lights.stop) <= ONE_FRAME + SLACK
+    finally:
+        lights.stop()
+        lights.join(1)
+    assert not lights.is_alive()
+
+
+@pytest.mark.parametrize("step", EFFECT_NAMES, indirect=True)
+def test_dark_within_one_frame_of_off(step):
+    strip, lights = start_lights(step)
+    try:
+        assert dark_latency(strip, lambda: lights.play(effect="OFF")) <= ONE_FRAME + SLACK
+    finally:
+        lights.stop()
+        lights.join(1)
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for(condition, timeout: float = 1.0) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def test_stream_releases_port_when_interrupted(monkeypatch):
+    closed = []
+    close = StreamReceiver.close
+    monkeypatch.setattr(StreamReceiver, "close", lambda receiver: closed.append(receiver) or close(receiver))
+    port = free_port()
+    strip = RecordingStrip()
+    strip.begin()
+    lights = LightEffect(strip, program=[{"effect": "Stream", "port": port, "timeout": 30}])
+    lights.start()
+    try:
+        time.sleep(0.2)
+        lights.play(effect="OFF")
+        assert wait_for(lambda: strip.effect == "OFF")
+        assert len(closed) == 1
+
+        # bound without SO_REUSEADDR, so fails while the stream's socket is still open
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as rebind:
+            rebind.bind(("0.0.0.0", port))
+    finally:
+        lights.stop()
+        lights.join(1)
+
+
+def test_stream_unable_to_bind_falls_back_at_once():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as holder:
+        holder.bind(("0.0.0.0", 0))
+        port = holder.getsockname()[1]
+        strip = RecordingStrip()
+        strip.begin()
+        lights = LightEffect(strip, program=[{"effect": "Stream", "port": port}, {"effect": "RainbowCycle"}])
+        lights.start()
+        try:
+            assert wait_for(lambda: strip.effect == "RainbowCycle")
+            assert strip.first_frame.wait(1)
+        finally:
+            lights.stop()
+            lights.join(1)
+
+
+def test_music_sync_closes_pipe_when_interrupted(tmp_path, monkeypatch):
+    closed = []
+    close = AudioAnalyser.close
+    monkeypatch.setattr(AudioAnalyser, "close", lambda analyser: closed.append(analyser) or close(analyser))
+    fifo = str(tmp_path / "audio")
+    os.mkfifo(fifo)
+    strip = RecordingStrip()
+    strip.begin()
+    lights = LightEffect(strip, program=[{"effect": "MusicSync", "pipe": fifo, "channels": 1}])
+    lights.start()
+    try:
+        assert strip.first_frame.wait(2)
+        with open(fifo, "wb", buffering=0) as writer:
+            writer.write(bytes(4096))
+            lights.play(effect="OFF")
+            assert wait_for(lambda: strip.effect == "OFF")
+            assert len(closed) == 1
+
+            # once the effect has closed its end of the pipe the writer is told rather than left blocked
+            with pytest.raises(BrokenPipeError):
+                for _ in range(100):
+                    writer.write(bytes(4096))
+                    time.sleep(0.01)
+    finally:
+        lights.stop()
+        lights.join(1)
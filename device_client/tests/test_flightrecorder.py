@@ -0,0 +1,96 @@
+"""Flight recorder rings, reading back and carrying on a recording after a restart
+
+test_flightrecorder.py
+
+by Darren Dunford
+"""
+
+import numpy
+
+from ledcontroller.flightrecorder import FlightRecorder, FlightRecording
+
+NUM_PIXELS = 30
+
+
+def frame(k: int) -> numpy.ndarray:
+    return (numpy.arange(NUM_PIXELS, dtype=numpy.uint32) * 0x010203 + k) & 0xFFFFFF
+
+
+def test_frames_and_events_read_back(tmp_path):
+    filename = str(tmp_path / "flight.bin")
+    recorder = FlightRecorder(filename, NUM_PIXELS, frame_slots=8, event_slots=4)
+    recorder.record_event("command", 100.0, command={"action": "RUN", "program": "xmas"})
+    for k in range(3):
+        recorder.record_frame(frame(k), 100.0 + k / 50, 200)
+
+    recording = FlightRecording(filename)
+    try:
+        frames = recording.frames()
+        assert [(seq, t, brightness) for seq, t, brightness, _ in frames] == [(1, 100.0, 200), (2, 100.02, 200),
+                                                                             (3, 100.04, 200)]
+        for k, (_, _, _, pixels) in enumerate(frames):
+            numpy.testing.assert_array_equal(pixels, frame(k))
+        assert recording.events() == [(1, 100.0, {"kind": "command", "command": {"action": "RUN",
+                                                                                 "program": "xmas"}})]
+        assert recording.latest() == 100.04
+        assert [seq for seq, _, _, _ in recording.frames(since=100.01)] == [2, 3]
+    finally:
+        recording.close()
+        recorder.close()
+
+
+def test_rings_keep_most_recent(tmp_path):
+    filename = str(tmp_path / "flight.bin")
+    recorder = FlightRecorder(filename, NUM_PIXELS, frame_slots=8, event_slots=4)
+    for k in range(20):
+        recorder.record_frame(frame(k), float(k), 255)
+        recorder.record_event("step", float(k), step_num=k)
+    recorder.close()
+
+    recording = FlightRecording(filename)
+    try:
+        assert [seq for seq, _, _, _ in recording.frames()] == list(range(13, 21))
+        numpy.testing.assert_array_equal(recording.frames()[-1][3], frame(19))
+        assert [event["step_num"] for _, _, event in recording.events()] == [16, 17, 18, 19]
+    finally:
+        recording.close()
+
+
+def test_recording_carried_on_after_restart(tmp_path):
+    filename = str(tmp_path / "flight.bin")
+    recorder = FlightRecorder(filename, NUM_PIXELS, frame_slots=8)
+    recorder.record_frame(frame(0), 1.0, 255)
+    recorder.close()
+
+    recorder = FlightRecorder(filename, NUM_PIXELS, frame_slots=8)
+    recorder.record_frame(frame(1), 2.0, 255)
+    recorder.close()
+    recording = FlightRecording(filename)
+    try:
+        assert [seq for seq, _, _, _ in recording.frames()] == [1, 2]
+    finally:
+        recording.close()
+
+    # a different shape starts a new recording
+    recorder = FlightRecorder(filename, NUM_PIXELS + 1, frame_slots=8)
+    recorder.close()
+    recording = FlightRecording(filename)
+    try:
+        assert recording.frames() == [] and recording.latest() is None
+    finally:
+        recording.close()
+
+
+def test_torn_slot_skipped(tmp_path):
+    filename = str(tmp_path / "flight.bin")
+    recorder = FlightRecorder(filename, NUM_PIXELS, frame_slots=8)
+    for k in range(3):
+        recorder.record_frame(frame(k), float(k), 255)
+    recorder._rings.frame_seq[1] = 0  # as left by a crash part way through rewriting the slot
+    recorder.close()
+
+    recording = FlightRecording(filename)
+    try:
+        assert [seq for seq, _, _, _ in recording.frames()] == [1, 3]
+    finally:
+        recording.close()
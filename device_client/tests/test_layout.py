@@ -0,0 +1,49 @@
+"""Mapping of designs drawn for a reference strip on to strips of other lengths
+
+test_layout.py
+
+by Darren Dunford
+"""
+
+import numpy
+import pytest
+
+from ledcontroller.layout import map_design, positions, reference_index, scale_pixels
+
+
+def test_positions_are_pixel_centres():
+    numpy.testing.assert_allclose(positions(4), [0.125, 0.375, 0.625, 0.875])
+
+
+@pytest.mark.parametrize("num_pixels", [1, 7, 50, 643, 5000])
+def test_reference_index_in_range_and_non_decreasing(num_pixels):
+    reference = reference_index(num_pixels, 50)
+    assert len(reference) == num_pixels
+    assert reference.min() >= 0 and reference.max() <= 49
+    assert (numpy.diff(reference) >= 0).all()
+
+
+def test_reference_index_identity_on_reference_strip():
+    numpy.testing.assert_array_equal(reference_index(643, 643), numpy.arange(643))
+
+
+def test_reference_index_stretches_and_shrinks():
+    numpy.testing.assert_array_equal(reference_index(6, 3), [0, 0, 1, 1, 2, 2])
+    numpy.testing.assert_array_equal(reference_index(3, 6), [1, 3, 5])
+
+
+def test_map_design_on_reference_strip_unchanged():
+    pixels, colours = map_design({4: 0xFF0000, 7: 0x00FF00}, 50, 50)
+    assert pixels.tolist() == [4, 7]
+    assert colours.tolist() == [0xFF0000, 0x00FF00]
+
+
+def test_map_design_on_longer_strip_fills_each_position():
+    pixels, colours = map_design({1: 0x0000FF}, 4, 8)
+    assert pixels.tolist() == [2, 3]
+    assert colours.tolist() == [0x0000FF, 0x0000FF]
+
+
+def test_scale_pixels():
+    assert scale_pixels(25, 50, 643) == 321
+    assert scale_pixels(643, 643, 643) == 643
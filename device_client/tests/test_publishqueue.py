@@ -0,0 +1,131 @@
+"""Merge, supersede, clear and size cap rules of the offline shadow update queue
+
+test_publishqueue.py
+
+by Darren Dunford
+"""
+
+import json
+
+from ledcontroller.deviceshadowhandler import DeviceShadowHandler
+from ledcontroller.publishqueue import CoalescingPublishQueue
+
+
+def reported(**values) -> dict:
+    return {"state": {"reported": values}}
+
+
+def test_empty_queue_takes_nothing():
+    assert CoalescingPublishQueue().take() == []
+
+
+def test_documents_merge_key_by_key():
+    queue = CoalescingPublishQueue()
+    queue.put(reported(status="CONNECTED"))
+    queue.put(reported(cputemp=51.2))
+    queue.put({"state": {"desired": {"command": None}}})
+    assert queue.take() == [{"state": {"reported": {"status": "CONNECTED", "cputemp": 51.2},
+                                       "desired": {"command": None}}}]
+    assert queue.take() == []
+
+
+def test_newer_value_supersedes_older():
+    queue = CoalescingPublishQueue()
+    for temperature in (50.0, 51.0, 52.0):
+        queue.put(reported(cputemp=temperature))
+    assert len(queue) == 1
+    assert queue.take() == [reported(cputemp=52.0)]
+    assert queue.stats()["superseded"] == 2
+
+
+def test_returned_document_keeps_newer_values():
+    queue = CoalescingPublishQueue()
+    queue.put(reported(cputemp=52.0))
+    queue.put(reported(cputemp=50.0, status="OLD"), replace=False)
+    assert queue.take() == [reported(cputemp=52.0, status="OLD")]
+
+
+def test_clear_supersedes_earlier_values():
+    queue = CoalescingPublishQueue()
+    queue.put({"state": {"desired": {"command": {"action": "OFF"}}}})
+    queue.put({"state": {"reported": {"status": "ON"}, "desired": None}})
+    assert queue.take() == [{"state": {"reported": {"status": "ON"}, "desired": None}}]
+    assert queue.stats()["superseded"] == 1
+
+
+def test_clear_is_sent_ahead_of_later_values():
+    queue = CoalescingPublishQueue()
+    queue.put({"state": {"reported": {"status": "ON"}, "desired": None}})
+    queue.put({"state": {"desired": {"command": None}}})
+    assert queue.take() == [{"state": {"desired": None}},
+                            {"state": {"reported": {"status": "ON"}, "desired": {"command": None}}}]
+
+
+def test_returned_clear_stays_ahead_of_values_pending():
+    queue = CoalescingPublishQueue()
+    queue.put({"state": {"desired": {"settings": {"brightness": 40}}}})
+    queue.put({"state": {"desired": None}}, replace=False)
+    assert queue.take() == [{"state": {"desired": None}}, {"state": {"desired": {"settings": {"brightness": 40}}}}]
+
+
+def test_largest_values_dropped_to_fit_cap():
+    queue = CoalescingPublishQueue(max_bytes=100)
+    queue.put(reported(program=["x" * 20] * 2))
+    queue.put(reported(status="ON"))
+    queue.put(reported(trace="y" * 60))
+    taken = queue.take()[0]["state"]["reported"]
+    assert set(taken) == {"status", "trace"}
+    assert queue.stats()["dropped"] == 1
+    assert queue.stats()["dropped_bytes"] == len("program") + len(json.dumps(["x" * 20] * 2))
+
+
+def test_value_larger_than_cap_dropped_on_its_own():
+    queue = CoalescingPublishQueue(max_bytes=50)
+    queue.put(reported(status="ON"))
+    queue.put(reported(trace="y" * 100))
+    assert queue.take() == [reported(status="ON")]
+    assert queue.stats()["dropped"] == 1
+    assert queue.size == 0
+
+
+class RecordingShadow:
+    """Stand in for the SDK shadow handler, recording updates and failing those after fail_after"""
+
+    def __init__(self, fail_after: int = None):
+        self.updates = []
+        self.fail_after = fail_after
+
+    def shadowUpdate(self, payload: str, callback, timeout: int):
+        if self.fail_after is not None and len(self.updates) >= self.fail_after:
+            raise TimeoutError("publish timed out")
+        self.updates.append(json.loads(payload))
+
+
+def offline_handler(shadow: RecordingShadow) -> DeviceShadowHandler:
+    handler = DeviceShadowHandler("thing", "host", "ca", "key", "cert")
+    handler.shadow_handler = shadow
+    handler.status_post("RUNNING")
+    handler.custom_shadow_callback_delta(json.dumps({"state": {"command": {"action": "OFF"}}}), None, None)
+    return handler
+
+
+def test_flush_sends_clear_before_later_values():
+    shadow = RecordingShadow()
+    handler = offline_handler(shadow)
+    handler._flush_offline_queue()
+    assert [update["state"].get("desired") for update in shadow.updates] == [None, {"command": None}]
+    assert shadow.updates[1]["state"]["reported"]["status"] == "RUNNING"
+    assert handler.connected.is_set()
+
+
+def test_failed_flush_requeues_unsent_documents_in_order():
+    shadow = RecordingShadow(fail_after=1)
+    handler = offline_handler(shadow)
+    handler._flush_offline_queue()
+    assert not handler.connected.is_set()
+    assert len(shadow.updates) == 1
+
+    shadow.fail_after = None
+    handler._flush_offline_queue()
+    assert [update["state"].get("desired") for update in shadow.updates] == [None, {"command": None}]
+    assert handler.connected.is_set()
@@ -0,0 +1,117 @@
+"""Program validation, loop and sub-program expansion, and joining a program in progress
+
+test_sequencer.py
+
+by Darren Dunford
+"""
+
+import itertools
+import time
+
+import pytest
+
+from ledcontroller.effects import EFFECTS
+from ledcontroller.sequencer import MAX_NESTING, period, timeline, validate_program
+
+PROGRAMS = {
+    "twinkle": [{"effect": "Christmas1", "duration": 3}, {"effect": "OFF", "duration": 1}],
+    "xmas": [
+        {"effect": "Christmas2", "duration": 5},
+        {"loop": [{"effect": "RainbowCycle", "duration": 2}, {"program": "twinkle", "repeat": 2}], "repeat": 3},
+        {"loop": [{"effect": "LandingStrip", "duration": 1.5}, {"effect": "Halloween", "duration": 0.5}]},
+    ],
+}
+
+
+def effects(program: list, count: int, **kwargs) -> list:
+    return [step["effect"] for step in itertools.islice(timeline(program, PROGRAMS, **kwargs), count)]
+
+
+def naive_join(program: list, seconds: float):
+    """Step through a program one step at a time until the step in progress at seconds
+
+    :return: (step, seconds the step started, steps passed over)
+    """
+    start, passed = 0.0, 0
+    for step in timeline(program, PROGRAMS):
+        if step.get("duration") is None or start + step["duration"] > seconds:
+            return step, start, passed
+        start += step["duration"]
+        passed += 1
+
+
+def test_valid_programs_accepted():
+    for program in PROGRAMS.values():
+        validate_program(program, PROGRAMS, EFFECTS)
+
+
+@pytest.mark.parametrize("program, message", [
+    ([], "non-empty list"),
+    ({"effect": "OFF"}, "non-empty list"),
+    (["OFF"], "must be a dictionary"),
+    ([{"duration": 5}], "no effect, loop or program"),
+    ([{"effect": "NoSuchEffect"}], "unknown effect"),
+    ([{"effect": "OFF", "duration": 0}], "positive number of seconds"),
+    ([{"effect": "OFF", "duration": True}], "positive number of seconds"),
+    ([{"loop": [{"effect": "OFF"}], "repeat": 0}], "positive integer"),
+    ([{"loop": [{"effect": "OFF"}], "repeat": 1.5}], "positive integer"),
+    ([{"loop": []}], "non-empty list"),
+    ([{"program": "missing"}], "unknown sub-program"),
+    ([{"program": ["twinkle"]}], "program name"),
+])
+def test_invalid_programs_rejected(program, message):
+    with pytest.raises(ValueError, match=message):
+        validate_program(program, PROGRAMS, EFFECTS)
+
+
+def test_recursive_sub_program_rejected():
+    programs = {"a": [{"program": "b"}], "b": [{"program": "a"}]}
+    with pytest.raises(ValueError, match=f"more than {MAX_NESTING} deep"):
+        validate_program(programs["a"], programs)
+
+
+def test_loops_and_sub_programs_expand_in_order():
+    assert effects(PROGRAMS["xmas"], 12) == [
+        "Christmas2",
+        "RainbowCycle", "Christmas1", "OFF", "Christmas1", "OFF",
+        "RainbowCycle", "Christmas1", "OFF", "Christmas1", "OFF",
+        "RainbowCycle",
+    ]
+    assert effects(PROGRAMS["xmas"], 20)[16:] == ["LandingStrip", "Halloween", "LandingStrip", "Halloween"]
+
+
+def test_period():
+    assert period(PROGRAMS["twinkle"]) == (4, 2)
+    assert period([{"loop": PROGRAMS["twinkle"], "repeat": 3}]) == (12, 6)
+    assert period([{"program": "twinkle", "repeat": 2}, {"effect": "OFF", "duration": 1}], PROGRAMS) == (9, 5)
+    assert period([{"effect": "OFF"}]) is None
+    assert period([{"loop": PROGRAMS["twinkle"]}]) is None
+
+
+@pytest.mark.parametrize("seconds", [0, 0.25, 4.99, 5, 7, 19.5, 35, 35.01, 36.5, 37, 1000.3, 86400 * 3 + 0.7])
+def test_join_matches_stepping_through(seconds):
+    position = {"seconds": seconds}
+    step = next(timeline(PROGRAMS["xmas"], PROGRAMS, skip=position))
+    expected, started, passed = naive_join(PROGRAMS["xmas"], seconds)
+    assert step == expected
+    assert position["skipped"] == pytest.approx(started)
+    assert position["steps"] == passed
+
+
+def test_join_continues_with_the_following_steps():
+    position = {"seconds": 6}
+    assert effects(PROGRAMS["xmas"], 3, skip=position) == ["RainbowCycle", "Christmas1", "OFF"]
+    assert position["skipped"] == 5
+
+
+def test_join_stops_at_step_without_duration():
+    program = [{"effect": "Christmas2", "duration": 5}, {"effect": "RainbowCycle"}, {"effect": "OFF"}]
+    position = {"seconds": 1000}
+    assert effects(program, 2, skip=position) == ["RainbowCycle", "OFF"]
+    assert position["skipped"] == 5 and position["steps"] == 1
+
+
+def test_join_long_running_program_is_quick():
+    started = time.perf_counter()
+    next(timeline(PROGRAMS["xmas"], PROGRAMS, skip={"seconds": 86400 * 365}))
+    assert time.perf_counter() - started < 0.05  # stepping through would pass over 31 million steps
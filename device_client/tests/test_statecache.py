@@ -0,0 +1,71 @@
+"""Local state file round trip, recovery from a damaged file, and reconciliation with the shadow
+
+test_statecache.py
+
+by Darren Dunford
+"""
+
+import os
+
+from ledcontroller.statecache import StateCache, reconcile
+
+STATE = {"program": "xmas", "start": 1700000000.5, "seed": 42, "settings": {"brightness": 60}, "step": 3}
+
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path / "state.json")
+    assert StateCache(filename).update(**STATE)
+    assert StateCache(filename).load() == STATE
+    assert os.listdir(tmp_path) == ["state.json"]  # no temporary file left behind
+
+
+def test_unchanged_state_not_rewritten(tmp_path):
+    filename = str(tmp_path / "state.json")
+    cache = StateCache(filename)
+    assert cache.update(**STATE)
+    assert not cache.update(step=3)
+    assert cache.update(step=4)
+
+    reloaded = StateCache(filename)
+    reloaded.load()
+    assert not reloaded.update(step=4)
+
+
+def test_missing_file_gives_empty_state(tmp_path):
+    assert StateCache(str(tmp_path / "state.json")).load() == {}
+
+
+def test_damaged_file_gives_empty_state_and_is_replaced(tmp_path):
+    for damaged in ('{"program": "xm', "", "[1, 2]", "\x00\x00\x00"):
+        filename = tmp_path / "state.json"
+        filename.write_text(damaged)
+        cache = StateCache(str(filename))
+        assert cache.load() == {}
+        assert cache.update(**STATE)
+        assert StateCache(str(filename)).load() == STATE
+
+
+def test_unwritable_directory_leaves_old_state(tmp_path):
+    filename = str(tmp_path / "state.json")
+    StateCache(filename).update(**STATE)
+    cache = StateCache(str(tmp_path / "missing" / "state.json"))
+    assert not cache.update(step=9)
+    assert StateCache(filename).load() == STATE
+
+
+def test_reconcile_pending_command_runs():
+    document = {"state": {"desired": {"command": {"action": "OFF"}}, "reported": {"settings": {"brightness": 10}}}}
+    assert reconcile(document, persistent_shadow=True) == {"command": {"action": "OFF"}}
+
+
+def test_reconcile_shadow_settings_only_when_persistent_in_both():
+    document = {"state": {"desired": {"persistentshadow": True, "settings": {"brightness": 10}}}}
+    assert reconcile(document, persistent_shadow=True) == {"settings": {"brightness": 10}}
+    assert reconcile(document, persistent_shadow=False) == {}
+    document["state"]["desired"]["persistentshadow"] = False
+    assert reconcile(document, persistent_shadow=True) == {}
+
+
+def test_reconcile_empty_shadow():
+    assert reconcile({}, persistent_shadow=True) == {}
+    assert reconcile({"state": {"desired": None}}, persistent_shadow=True) == {}
@@ -0,0 +1,88 @@
+"""Sequence handling of the UDP pixel stream receiver
+
+test_udpstream.py
+
+by Darren Dunford
+"""
+
+import socket
+import time
+
+import numpy
+import pytest
+
+from ledcontroller import udpstream
+from ledcontroller.udpstream import SEQUENCE_WINDOW, StreamReceiver, is_stale, native_packet
+
+NUM_PIXELS = 20
+
+
+def test_is_stale():
+    assert not is_stale(5, None, 256, 20)
+    assert is_stale(5, 5, 256, 20)  # repeated
+    assert is_stale(4, 5, 256, 20)  # behind
+    assert not is_stale(6, 5, 256, 20)
+    assert not is_stale(2, 250, 256, 20)  # wrapped round
+    assert is_stale(250, 2, 256, 20)
+    assert not is_stale(100, 200, 256, 20)  # too far behind to be late, a restarted sender
+
+
+@pytest.fixture
+def stream():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    receiver = StreamReceiver(NUM_PIXELS, port=port, host="127.0.0.1")
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    out = numpy.zeros(NUM_PIXELS, dtype=numpy.uint32)
+
+    def send(*sequences) -> bool:
+        """Send a frame of colour sequence for each sequence number, then receive, returning True if shown"""
+        for sequence in sequences:
+            sender.sendto(native_packet(sequence, numpy.full(NUM_PIXELS, sequence % 0xFFFFFF, dtype=numpy.uint32)),
+                          ("127.0.0.1", receiver.port))
+        time.sleep(0.01)
+        return receiver.receive(out, 0.1)
+
+    yield receiver, send, out
+    sender.close()
+    receiver.close()
+
+
+def test_newest_queued_frame_shown(stream):
+    receiver, send, out = stream
+    assert send(1, 2, 3)
+    assert out[0] == 3
+    assert receiver.stats["superseded"] == 2
+
+
+def test_late_frames_dropped(stream):
+    receiver, send, out = stream
+    assert send(10)
+    assert not send(9, 10 - SEQUENCE_WINDOW + 1)
+    assert out[0] == 10
+    assert receiver.stats["stale"] == 2
+
+
+def test_restarted_sender_resumes_at_once(stream):
+    receiver, send, out = stream
+    assert send(5000)
+    assert send(1)
+    assert out[0] == 1
+
+
+def test_restarted_sender_resumes_after_a_pause(stream, monkeypatch):
+    receiver, send, out = stream
+    assert send(10)
+    monkeypatch.setattr(udpstream, "RESTART_GAP", 0.05)
+    time.sleep(0.1)
+    assert send(8)
+    assert out[0] == 8
+
+
+def test_invalid_datagrams_ignored(stream):
+    receiver, send, out = stream
+    receiver._socket.sendto(b"WSPY" + bytes(60), ("127.0.0.1", receiver.port))
+    receiver._socket.sendto(b"WS", ("127.0.0.1", receiver.port))
+    assert not send()
+    assert receiver.stats["invalid"] == 2
@@ -11,6 +11,8 @@ Author: Darren Dunford (djdunford@gmail.com)
 import os
 import json
 import logging
+import time
+import uuid
 
 import boto3
 
@@ -39,6 +41,16 @@ class MissingPathParameterException(Exception):
     pass
 
 
+def new_trace(event):
+    """Return a trace to carry with a command, so the device can report latency at each stage to the shadow
+
+    uses the caller's X-Trace-Id header as the trace id if given
+    """
+    headers = event.get('headers') or {}
+    trace_id = headers.get('X-Trace-Id') or headers.get('x-trace-id') or uuid.uuid4().hex
+    return {"id": str(trace_id)[:64], "issued": time.time()}
+
+
 def off(event, context):
     LOGGER.info("Executing command: OFF")
     LOGGER.debug("Received event: " + json.dumps(event, indent=2))
@@ -51,13 +63,16 @@ def off(event, context):
         raise MissingQueryStringParameterException(ERROR_QUERY_STRING_PARAMETER)  # TODO: check CORS headers on error responses
 
     # publish event to AWSIoT MQTT
-    payload = {"state": {"desired": {"command": {"action": "OFF"}}}}
+    trace = new_trace(event)
+    LOGGER.info(f"Trace id {trace['id']}")
+    payload = {"state": {"desired": {"command": {"action": "OFF", "trace": trace}}}}
     response = iot_data_client.update_thing_shadow(thingName=thing_name, payload=json.dumps(payload))
 
     # TODO interpret response from update_thing_shadow
     streaming_body = response["payload"]
     json_state = json.loads(streaming_body.read())
-    headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*',
+               'Access-Control-Expose-Headers': 'X-Trace-Id', 'X-Trace-Id': trace['id']}
     response = {'statusCode': 200, 'body': json.dumps(json_state), 'headers': headers}
     LOGGER.debug("Sending response: " + json.dumps(response, indent=2))
     return response
@@ -83,13 +98,16 @@ def effect(event, context):
     LOGGER.debug(f"Received thing_name {thing_name} to show effect {effect_name}")
 
     # publish event to AWSIoT MQTT
-    payload = {"state": {"desired": {"command": {"action": "EFFECT", "effect": effect_name}}}}
+    trace = new_trace(event)
+    LOGGER.info(f"Trace id {trace['id']}")
+    payload = {"state": {"desired": {"command": {"action": "EFFECT", "effect": effect_name, "trace": trace}}}}
     response = iot_data_client.update_thing_shadow(thingName=thing_name, payload=json.dumps(payload))
 
     # TODO interpret response from update_thing_shadow
     streaming_body = response["payload"]
     json_state = json.loads(streaming_body.read())
-    headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*',
+               'Access-Control-Expose-Headers': 'X-Trace-Id', 'X-Trace-Id': trace['id']}
     response = {'statusCode': 200, 'body': json.dumps(json_state), 'headers': headers}
     LOGGER.debug("Sending response: " + json.dumps(response, indent=2))
     return response